@@ -2,24 +2,60 @@ import streamlit as st
 import os
 import io
 import re
+import copy
 import json
+import math
+import mmap
+import bisect
+import array
+import time
+import struct
+import calendar
+import random
 import base64
+import binascii
+import hashlib
+import sqlite3
+import queue
+import asyncio
 import zipfile
+import threading
 import urllib.request
 import urllib.parse
 import urllib.error
 import concurrent.futures
+from collections import deque
+from contextlib import closing
 from pathlib import Path
-from openai import OpenAI
+import httpx
+from openai import OpenAI, AsyncOpenAI, APIConnectionError, APITimeoutError
 from china_cities import CHINA_PROVINCES_CITIES
 
 try:
-    from PIL import Image
+    from PIL import Image, features
     from PIL.ExifTags import TAGS, GPSTAGS
     HAS_PIL = True
 except ImportError:
     HAS_PIL = False
 
+try:
+    import numpy as np
+    HAS_NUMPY = True
+except ImportError:
+    HAS_NUMPY = False
+
+try:
+    import boto3
+    HAS_BOTO3 = True
+except ImportError:
+    HAS_BOTO3 = False
+
+try:
+    import h2  # noqa: F401  httpx 的 HTTP/2 支持依赖 h2
+    HAS_HTTP2 = True
+except ImportError:
+    HAS_HTTP2 = False
+
 # RAW 格式后缀集合（索尼 ARW、佳能 CR2/CR3、尼康 NEF 等）
 RAW_EXTENSIONS = {".arw", ".cr2", ".cr3", ".nef", ".nrw", ".dng", ".raf", ".orf", ".rw2", ".pef", ".srw"}
 
@@ -29,39 +65,509 @@ def is_raw_file(filename: str) -> bool:
     return Path(filename).suffix.lower() in RAW_EXTENSIONS
 
 
-def extract_jpeg_from_raw(raw_bytes: bytes) -> bytes:
-    """从 RAW 文件中提取内嵌的 JPEG 预览图（纯 Python，无需额外依赖）。
+# TIFF 字段类型 -> 单个值的字节数
+_TIFF_TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 6: 1, 7: 1, 8: 2, 9: 4, 10: 8, 11: 4, 12: 8, 13: 4}
+# TIFF 魔数：标准 42，奥林巴斯 ORF 用 "RO"/"SR"，松下 RW2 用 0x55
+_TIFF_MAGICS = {42, 0x4F52, 0x5352, 0x55}
+_MAX_IFD_ENTRIES = 1024
+_MAX_IFDS = 64
 
-    大多数相机 RAW 格式（ARW/CR2/NEF/DNG 等）都基于 TIFF 结构，
-    内部嵌有一张全尺寸或接近全尺寸的 JPEG 预览图。
-    本函数通过扫描 JPEG SOI (FFD8) 标记来定位并提取最大的那张 JPEG。
-    """
-    jpeg_candidates = []
-    search_start = 0
+# CR3 (ISO BMFF) 中存放 PRVW 预览图的 uuid box
+_CR3_PREVIEW_UUID = bytes.fromhex("eaf42b5e1c984b88b9fbb7dc406e4d16")
+
+
+def _tiff_header(view: memoryview, base: int = 0) -> tuple:
+    """解析 TIFF 头，返回 (字节序, IFD0 偏移)，不是 TIFF 时返回 (None, 0)"""
+    if len(view) < base + 8:
+        return None, 0
+    byte_order = bytes(view[base:base + 2])
+    if byte_order == b"II":
+        endian = "<"
+    elif byte_order == b"MM":
+        endian = ">"
+    else:
+        return None, 0
+    magic, ifd0_offset = struct.unpack_from(endian + "HI", view, base + 2)
+    if magic not in _TIFF_MAGICS:
+        return None, 0
+    return endian, ifd0_offset
+
+
+def _read_ifd(view: memoryview, base: int, endian: str, ifd_offset: int) -> tuple:
+    """读取一个 IFD，返回 ({tag: (type, count, 数据绝对偏移)}, 下一个 IFD 偏移)"""
+    pos = base + ifd_offset
+    if ifd_offset <= 0 or pos + 2 > len(view):
+        return {}, 0
+    entry_count = struct.unpack_from(endian + "H", view, pos)[0]
+    if entry_count > _MAX_IFD_ENTRIES or pos + 2 + entry_count * 12 + 4 > len(view):
+        return {}, 0
+    entries = {}
+    for index in range(entry_count):
+        entry_pos = pos + 2 + index * 12
+        tag, field_type, count = struct.unpack_from(endian + "HHI", view, entry_pos)
+        type_size = _TIFF_TYPE_SIZES.get(field_type)
+        if type_size is None:
+            continue
+        if type_size * count <= 4:
+            data_pos = entry_pos + 8
+        else:
+            data_pos = base + struct.unpack_from(endian + "I", view, entry_pos + 8)[0]
+        entries[tag] = (field_type, count, data_pos)
+    next_offset = struct.unpack_from(endian + "I", view, pos + 2 + entry_count * 12)[0]
+    return entries, next_offset
+
+
+def _ifd_values(view: memoryview, endian: str, entry: tuple, limit: int = 64) -> tuple:
+    """读取整数/有理数型 IFD 字段的值（有理数返回 float），最多 limit 个"""
+    field_type, count, data_pos = entry
+    count = min(count, limit)
+    formats = {1: "B", 3: "H", 4: "I", 6: "b", 8: "h", 9: "i", 13: "I"}
+    try:
+        if field_type in formats:
+            return struct.unpack_from(f"{endian}{count}{formats[field_type]}", view, data_pos)
+        if field_type in (5, 10):
+            fmt = "I" if field_type == 5 else "i"
+            raw = struct.unpack_from(f"{endian}{count * 2}{fmt}", view, data_pos)
+            return tuple(raw[i] / raw[i + 1] if raw[i + 1] else 0.0 for i in range(0, len(raw), 2))
+    except struct.error:
+        pass
+    return ()
+
+
+def _ifd_text(view: memoryview, entry: tuple) -> str:
+    """读取 ASCII 型 IFD 字段"""
+    _, count, data_pos = entry
+    raw = bytes(view[data_pos:data_pos + min(count, 256)])
+    return raw.split(b"\x00", 1)[0].decode("utf-8", errors="ignore").strip()
+
+
+def _walk_tiff_ifds(view: memoryview, base: int, endian: str, ifd0_offset: int):
+    """遍历 IFD0 链及其 SubIFD（tag 330），逐个产出 IFD 字典"""
+    pending = [ifd0_offset]
+    visited = set()
+    while pending and len(visited) < _MAX_IFDS:
+        offset = pending.pop(0)
+        if offset in visited or offset <= 0:
+            continue
+        visited.add(offset)
+        entries, next_offset = _read_ifd(view, base, endian, offset)
+        if not entries:
+            continue
+        yield entries
+        if 330 in entries:
+            pending.extend(_ifd_values(view, endian, entries[330]))
+        if next_offset:
+            pending.append(next_offset)
+
+
+def _is_decodable_jpeg(view: memoryview, start: int) -> bool:
+    """只读 JPEG 段头判断是否为 Pillow 可解码的 JPEG（排除 CR2/DNG 的无损 JPEG RAW 数据）"""
+    if bytes(view[start:start + 2]) != b"\xff\xd8":
+        return False
+    pos = start + 2
+    end = min(len(view), start + 256 * 1024)
+    while pos + 4 <= end:
+        if view[pos] != 0xFF:
+            return False
+        marker = view[pos + 1]
+        if marker == 0xFF:
+            pos += 1
+            continue
+        # SOF0/1/2：基线/扩展/渐进式，Pillow 可解码；SOF3 等为无损或算术编码
+        if marker in (0xC0, 0xC1, 0xC2):
+            return True
+        if marker in (0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF, 0xDA):
+            return False
+        segment_length = (view[pos + 2] << 8) | view[pos + 3]
+        pos += 2 + segment_length
+    return False
 
+
+def _tiff_preview_regions(view: memoryview, base: int = 0) -> list:
+    """从 TIFF 结构（ARW/CR2/NEF/DNG/PEF/ORF/RW2/SRW）中定位内嵌 JPEG，返回 [(起始, 长度)]"""
+    endian, ifd0_offset = _tiff_header(view, base)
+    if endian is None:
+        return []
+    regions = []
+    for entries in _walk_tiff_ifds(view, base, endian, ifd0_offset):
+        # JPEGInterchangeFormat / JPEGInterchangeFormatLength（NEF/ARW/PEF 的预览图）
+        if 513 in entries and 514 in entries:
+            offsets = _ifd_values(view, endian, entries[513], 1)
+            lengths = _ifd_values(view, endian, entries[514], 1)
+            if offsets and lengths:
+                regions.append((base + offsets[0], lengths[0]))
+        # 单条带 JPEG 压缩的图像（CR2 IFD0 全尺寸 JPEG、DNG 预览 SubIFD）
+        compression = _ifd_values(view, endian, entries[259], 1) if 259 in entries else ()
+        if compression and compression[0] in (6, 7) and 273 in entries and 279 in entries:
+            offsets = _ifd_values(view, endian, entries[273], 2)
+            lengths = _ifd_values(view, endian, entries[279], 2)
+            if len(offsets) == 1 and len(lengths) == 1:
+                regions.append((base + offsets[0], lengths[0]))
+        # RW2 的 JpgFromRaw（tag 0x2E，UNDEFINED 类型，数据即完整 JPEG）
+        if 0x2E in entries:
+            _, count, data_pos = entries[0x2E]
+            regions.append((data_pos, count))
+    return regions
+
+
+def _iter_bmff_boxes(view: memoryview, start: int, end: int):
+    """遍历 ISO BMFF box，产出 (类型, 数据起始, box 结束)"""
+    pos = start
+    while pos + 8 <= end:
+        size, box_type = struct.unpack_from(">I4s", view, pos)
+        header = 8
+        if size == 1 and pos + 16 <= end:
+            size = struct.unpack_from(">Q", view, pos + 8)[0]
+            header = 16
+        elif size == 0:
+            size = end - pos
+        if size < header or pos + size > end:
+            return
+        yield box_type, pos + header, pos + size
+        pos += size
+
+
+def _cr3_preview_regions(view: memoryview) -> list:
+    """从 CR3（ISO BMFF）中定位 JPEG：各 trak 的首个样本（track 1 为全尺寸 JPEG）和 PRVW 预览"""
+    regions = []
+    for box_type, data_start, box_end in _iter_bmff_boxes(view, 0, len(view)):
+        if box_type == b"moov":
+            for trak_type, trak_start, trak_end in _iter_bmff_boxes(view, data_start, box_end):
+                if trak_type != b"trak":
+                    continue
+                stbl = _find_bmff_path(view, trak_start, trak_end, (b"mdia", b"minf", b"stbl"))
+                if not stbl:
+                    continue
+                sample_size = chunk_offset = 0
+                for child_type, child_start, _ in _iter_bmff_boxes(view, *stbl):
+                    if child_type == b"stsz":
+                        fixed_size, sample_count = struct.unpack_from(">II", view, child_start + 4)
+                        sample_size = fixed_size or (
+                            struct.unpack_from(">I", view, child_start + 12)[0] if sample_count else 0
+                        )
+                    elif child_type == b"co64":
+                        chunk_offset = struct.unpack_from(">Q", view, child_start + 8)[0]
+                    elif child_type == b"stco":
+                        chunk_offset = struct.unpack_from(">I", view, child_start + 8)[0]
+                if sample_size and chunk_offset:
+                    regions.append((chunk_offset, sample_size))
+        elif box_type == b"uuid" and bytes(view[data_start:data_start + 16]) == _CR3_PREVIEW_UUID:
+            # uuid(16) + 8 字节未知字段后是 PRVW box，其中 JPEG 紧跟在小段头部之后
+            for prvw_type, prvw_start, prvw_end in _iter_bmff_boxes(view, data_start + 24, box_end):
+                if prvw_type == b"PRVW":
+                    header = bytes(view[prvw_start:min(prvw_end, prvw_start + 64)])
+                    soi = header.find(b"\xff\xd8")
+                    if soi != -1:
+                        regions.append((prvw_start + soi, prvw_end - prvw_start - soi))
+    return regions
+
+
+def _find_bmff_path(view: memoryview, start: int, end: int, path: tuple):
+    """按 box 类型路径逐层查找，返回 (数据起始, 结束) 或 None"""
+    for box_type in path:
+        for child_type, child_start, child_end in _iter_bmff_boxes(view, start, end):
+            if child_type == box_type:
+                start, end = child_start, child_end
+                break
+        else:
+            return None
+    return start, end
+
+
+def _raf_preview_regions(view: memoryview) -> list:
+    """富士 RAF：文件头偏移 84/88 处记录内嵌 JPEG 的偏移和长度（大端）"""
+    if len(view) < 92 or bytes(view[:16]) != b"FUJIFILMCCD-RAW ":
+        return []
+    jpeg_offset, jpeg_length = struct.unpack_from(">II", view, 84)
+    return [(jpeg_offset, jpeg_length)]
+
+
+def _jpeg_end(raw_bytes: bytes, view: memoryview, start: int) -> int:
+    """按段结构跳过 APP/DQT 等段（含 EXIF 内嵌缩略图）找到真正的 EOI，返回结束位置（不含）"""
+    pos = start + 2
+    while pos + 4 <= len(view):
+        if view[pos] != 0xFF:
+            return -1
+        marker = view[pos + 1]
+        if marker == 0xFF:
+            pos += 1
+            continue
+        segment_length = (view[pos + 2] << 8) | view[pos + 3]
+        if marker == 0xDA:
+            eoi_pos = raw_bytes.find(b"\xff\xd9", pos + 2 + segment_length)
+            return eoi_pos + 2 if eoi_pos != -1 else -1
+        pos += 2 + segment_length
+    return -1
+
+
+def _scan_jpeg_regions(raw_bytes: bytes, view: memoryview) -> list:
+    """兜底：扫描 SOI 标记定位 JPEG（用于 ORF/PEF 等预览图藏在 MakerNote 中的格式）"""
+    regions = []
+    search_start = 0
     while True:
-        soi_pos = raw_bytes.find(b'\xff\xd8', search_start)
+        soi_pos = raw_bytes.find(b"\xff\xd8\xff", search_start)
         if soi_pos == -1:
             break
-
-        # 从 SOI 开始找对应的 EOI (FFD9)
-        eoi_pos = raw_bytes.find(b'\xff\xd9', soi_pos + 2)
-        if eoi_pos == -1:
-            break
-
-        jpeg_data = raw_bytes[soi_pos:eoi_pos + 2]
+        end_pos = _jpeg_end(raw_bytes, view, soi_pos)
+        if end_pos == -1:
+            search_start = soi_pos + 2
+            continue
         # 只保留大于 50KB 的 JPEG（过滤缩略图）
-        if len(jpeg_data) > 50 * 1024:
-            jpeg_candidates.append(jpeg_data)
+        if end_pos - soi_pos > 50 * 1024:
+            regions.append((soi_pos, end_pos - soi_pos))
+        search_start = end_pos
+    return regions
+
 
-        search_start = eoi_pos + 2
+def extract_jpeg_from_raw(raw_bytes: bytes) -> memoryview:
+    """从 RAW 文件中提取内嵌的 JPEG 预览图（纯 Python，无需额外依赖）。
 
-    if jpeg_candidates:
+    TIFF 系 RAW（ARW/CR2/NEF/DNG/PEF/ORF/RW2/SRW）按 IFD 结构读取
+    JpgFromRaw / PreviewImage 的偏移和长度，CR3 解析 ISO BMFF box，RAF 读取文件头，
+    只读取几 KB 的头部信息，直接跳到预览图位置。
+    结构化解析找不到时才退回按 JPEG 段结构扫描。
+    返回最大那张可解码 JPEG 的零拷贝 memoryview，找不到时返回 b""。
+    """
+    view = memoryview(raw_bytes)
+    try:
+        if bytes(view[4:8]) == b"ftyp":
+            regions = _cr3_preview_regions(view)
+        elif bytes(view[:16]) == b"FUJIFILMCCD-RAW ":
+            regions = _raf_preview_regions(view)
+        else:
+            regions = _tiff_preview_regions(view)
+    except (struct.error, IndexError, ValueError):
+        regions = []
+
+    valid_regions = [
+        (start, length) for start, length in regions
+        if 0 <= start and length > 0 and start + length <= len(view)
+        and _is_decodable_jpeg(view, start)
+    ]
+    if not valid_regions:
+        valid_regions = [
+            (start, length) for start, length in _scan_jpeg_regions(raw_bytes, view)
+            if _is_decodable_jpeg(view, start)
+        ]
+    if valid_regions:
         # 返回最大的那张（通常是全尺寸预览）
-        return max(jpeg_candidates, key=len)
+        start, length = max(valid_regions, key=lambda region: region[1])
+        return view[start:start + length]
 
     return b""
 
+# CR3 中存放 CMT1-CMT4（TIFF 格式 EXIF）的 uuid box
+_CR3_METADATA_UUID = bytes.fromhex("85c0b687820f11e08111f4ce462b6a48")
+# 元数据读取窗口：先读 64KB，结构超出窗口时再扩大一次
+_METADATA_HEAD_SIZES = (64 * 1024, 512 * 1024)
+# Exif / GPS IFD 指针或字段数据落在已读窗口之外时，按需扩大窗口的上限
+_METADATA_MAX_HEAD_SIZE = 32 * 1024 * 1024
+# 计算窗口需要覆盖的范围时忽略超过该大小的字段（MakerNote、内嵌缩略图等不读取的大块数据）
+_METADATA_MAX_FIELD_SIZE = 256
+
+
+def _read_head(source, offset: int, size: int) -> memoryview:
+    """从字节串或可 seek 的文件流中读取 [offset, offset+size) 区间"""
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return memoryview(source)[offset:offset + size]
+    position = source.tell()
+    try:
+        source.seek(offset)
+        return memoryview(source.read(size))
+    finally:
+        source.seek(position)
+
+
+def _jpeg_exif_base(view: memoryview) -> int:
+    """在 JPEG 段结构中定位 APP1 Exif 段，返回其中 TIFF 头的偏移，找不到返回 -1"""
+    if bytes(view[:2]) != b"\xff\xd8":
+        return -1
+    pos = 2
+    while pos + 4 <= len(view):
+        if view[pos] != 0xFF:
+            return -1
+        marker = view[pos + 1]
+        if marker == 0xFF:
+            pos += 1
+            continue
+        if marker == 0xDA:
+            return -1
+        segment_length = (view[pos + 2] << 8) | view[pos + 3]
+        if marker == 0xE1 and bytes(view[pos + 4:pos + 10]) == b"Exif\x00\x00":
+            return pos + 10
+        pos += 2 + segment_length
+    return -1
+
+
+def _ifd_data_end(entries: dict) -> int:
+    """IFD 中各字段数据的结束位置（不含超过 _METADATA_MAX_FIELD_SIZE 的大块字段）"""
+    end = 0
+    for field_type, count, data_pos in entries.values():
+        size = _TIFF_TYPE_SIZES[field_type] * count
+        if size <= _METADATA_MAX_FIELD_SIZE:
+            end = max(end, data_pos + size)
+    return end
+
+
+def _tiff_ifd_group(view: memoryview, base: int) -> dict:
+    """读取一个 TIFF 块的 IFD0 以及它指向的 Exif IFD / GPS IFD。
+
+    IFD 或字段数据落在 view 之外时，"need" 为读取它们需要的窗口长度（相对 view 起点），
+    由调用方扩大窗口后重新读取。
+    """
+    endian, ifd0_offset = _tiff_header(view, base)
+    if endian is None:
+        return {}
+    group = {}
+    need = 0
+    for role, pointer_tag in (("ifd0", None), ("exif", 34665), ("gps", 34853)):
+        if pointer_tag is None:
+            offset = ifd0_offset
+        elif pointer_tag in group["ifd0"][1]:
+            offsets = _ifd_values(view, endian, group["ifd0"][1][pointer_tag], 1)
+            if not offsets:
+                continue
+            offset = offsets[0]
+        else:
+            continue
+        entries, _ = _read_ifd(view, base, endian, offset)
+        if entries:
+            group[role] = (endian, entries)
+            need = max(need, _ifd_data_end(entries))
+        elif offset > 0 and base + offset + 2 + 12 * _MAX_IFD_ENTRIES + 4 > len(view):
+            # IFD 的条目表可能超出窗口：至少要读到最大条目数对应的长度
+            need = max(need, base + offset + 2 + 12 * _MAX_IFD_ENTRIES + 4)
+        if role == "ifd0" and not entries:
+            return {"need": need} if need else {}
+    if need > len(view):
+        group["need"] = need
+    return group
+
+
+def _cr3_ifd_group(view: memoryview) -> dict:
+    """CR3：CMT1 为 IFD0，CMT2 为 Exif IFD，CMT4 为 GPS IFD，各自是独立的 TIFF 块"""
+    moov = _find_bmff_path(view, 0, len(view), (b"moov",))
+    if not moov:
+        return {}
+    group = {}
+    for box_type, data_start, box_end in _iter_bmff_boxes(view, *moov):
+        if box_type != b"uuid" or bytes(view[data_start:data_start + 16]) != _CR3_METADATA_UUID:
+            continue
+        roles = {b"CMT1": "ifd0", b"CMT2": "exif", b"CMT4": "gps"}
+        for child_type, child_start, _ in _iter_bmff_boxes(view, data_start + 16, box_end):
+            if child_type in roles:
+                endian, ifd_offset = _tiff_header(view, child_start)
+                if endian is not None:
+                    entries, _ = _read_ifd(view, child_start, endian, ifd_offset)
+                    group[roles[child_type]] = (endian, entries)
+    return group
+
+
+def _exif_timestamp(raw_time: str) -> "float | None":
+    """EXIF 时间串（YYYY:MM:DD HH:MM:SS）转为秒数，只用于比较两张照片的拍摄间隔"""
+    try:
+        return float(calendar.timegm(time.strptime(raw_time.strip()[:19], "%Y:%m:%d %H:%M:%S")))
+    except (ValueError, AttributeError):
+        return None
+
+
+def _camera_name(make: str, model: str) -> str:
+    """型号已带厂商名时不重复拼接（如 Canon + Canon EOS R5）"""
+    make, model = make.strip(), model.strip()
+    if make and model.lower().startswith(make.split()[0].lower()):
+        return model
+    return f"{make} {model}".strip()
+
+
+def _metadata_from_ifds(view: memoryview, group: dict) -> dict:
+    """从 IFD0 / Exif IFD / GPS IFD 中提取拍摄时间、GPS、相机、镜头和曝光参数"""
+    result = {
+        "shoot_time": "", "shoot_timestamp": None, "gps_lat": None, "gps_lon": None,
+        "camera": "", "lens": "", "focal_length": None,
+        "exposure_time": "", "f_number": None, "iso": None,
+    }
+    ifd0_endian, ifd0 = group.get("ifd0", ("<", {}))
+    exif_endian, exif = group.get("exif", ("<", {}))
+
+    def text(entries, tag):
+        try:
+            return _ifd_text(view, entries[tag]) if tag in entries else ""
+        except (IndexError, ValueError):
+            return ""
+
+    def number(endian, entries, tag):
+        values = _ifd_values(view, endian, entries[tag], 1) if tag in entries else ()
+        return values[0] if values else None
+
+    for entries, tag in ((exif, 36867), (exif, 36868), (ifd0, 306)):
+        raw_time = text(entries, tag)
+        if raw_time:
+            result["shoot_time"] = raw_time.replace(":", "").replace(" ", "_")[:13]
+            result["shoot_timestamp"] = _exif_timestamp(raw_time)
+            break
+
+    result["camera"] = _camera_name(text(ifd0, 271), text(ifd0, 272))
+    result["lens"] = text(exif, 0xA434)
+    result["focal_length"] = number(exif_endian, exif, 0x920A)
+    result["f_number"] = number(exif_endian, exif, 0x829D)
+    result["iso"] = number(exif_endian, exif, 0x8827)
+    exposure = number(exif_endian, exif, 0x829A)
+    if exposure:
+        result["exposure_time"] = f"1/{round(1 / exposure)}" if exposure < 1 else f"{exposure:g}"
+
+    if "gps" in group:
+        gps_endian, gps = group["gps"]
+
+        def gps_to_decimal(coord_tag, ref_tag):
+            coords = _ifd_values(view, gps_endian, gps[coord_tag], 3) if coord_tag in gps else ()
+            if len(coords) != 3:
+                return None
+            decimal = coords[0] + coords[1] / 60.0 + coords[2] / 3600.0
+            return -decimal if text(gps, ref_tag) in ("S", "W") else decimal
+
+        result["gps_lat"] = gps_to_decimal(2, 1)
+        result["gps_lon"] = gps_to_decimal(4, 3)
+    return result
+
+
+def read_photo_metadata(source) -> dict | None:
+    """只读文件头的 EXIF/GPS 读取器，不解码像素。
+
+    source 可以是字节串或可 seek 的文件流（如 Streamlit UploadedFile），只读取前几十 KB：
+    JPEG 读 APP1 段，TIFF 系 RAW 读 IFD0 / Exif IFD / GPS IFD，CR3 读 CMT box，
+    RAF 跳到内嵌 JPEG 读其 APP1。
+    返回 shoot_time、shoot_timestamp（秒）、gps_lat/gps_lon、camera、lens、focal_length、exposure_time、f_number、iso；
+    无法识别的格式返回 None，由调用方退回 Pillow 读取。
+    Exif / GPS IFD 指针或字段数据超出已读窗口时扩大窗口重新读取（最多到 _METADATA_MAX_HEAD_SIZE），
+    整组都没有读到时退回 _METADATA_HEAD_SIZES 中的下一个窗口。
+    """
+    head_size = _METADATA_HEAD_SIZES[0]
+    while True:
+        try:
+            view = _read_head(source, 0, head_size)
+            if bytes(view[:16]) == b"FUJIFILMCCD-RAW ":
+                jpeg_offset = struct.unpack_from(">I", view, 84)[0]
+                view = _read_head(source, jpeg_offset, head_size)
+            if bytes(view[4:8]) == b"ftyp":
+                group = _cr3_ifd_group(view)
+            else:
+                exif_base = _jpeg_exif_base(view)
+                group = _tiff_ifd_group(view, exif_base if exif_base != -1 else 0)
+        except (struct.error, IndexError, ValueError, OSError):
+            group = {}
+        need = group.pop("need", 0)
+        truncated = len(view) >= head_size
+        if need > len(view) and truncated and head_size < _METADATA_MAX_HEAD_SIZE:
+            # 按 64KB 对齐扩大窗口，覆盖超出的 IFD 和字段数据
+            head_size = min(-(-need // _METADATA_HEAD_SIZES[0]) * _METADATA_HEAD_SIZES[0], _METADATA_MAX_HEAD_SIZE)
+            continue
+        if group:
+            return _metadata_from_ifds(view, group)
+        larger = [size for size in _METADATA_HEAD_SIZES if size > head_size]
+        if not truncated or not larger:
+            return None
+        head_size = larger[0]
+
 # ============================================================
 # 页面配置
 # ============================================================
@@ -1057,98 +1563,359 @@ components.html("""
 
 # 工具函数
 # ============================================================
-def image_bytes_to_pil(image_bytes: bytes, filename: str = "") -> "Image.Image | None":
-    """将图片字节转为 PIL Image，支持 RAW 格式（自动提取内嵌 JPEG）"""
-    if not HAS_PIL:
-        return None
+def _exif_dict_to_info(exif_data: dict) -> dict:
+    """将 Pillow 的 _getexif() 结果转为 {"shoot_time", "shoot_timestamp", "gps_lat", "gps_lon"}，
+    有厂商/型号时另带 camera"""
+    result = {"shoot_time": "", "shoot_timestamp": None, "gps_lat": None, "gps_lon": None}
+    if not exif_data:
+        return result
 
-    # 如果是 RAW 格式，先提取内嵌 JPEG
-    actual_bytes = image_bytes
-    if is_raw_file(filename):
-        jpeg_data = extract_jpeg_from_raw(image_bytes)
-        if jpeg_data:
-            actual_bytes = jpeg_data
-        else:
-            return None
+    for tag_id in (36867, 36868, 306):
+        if tag_id in exif_data:
+            raw_time = exif_data[tag_id]
+            try:
+                cleaned = raw_time.replace(":", "").replace(" ", "_")[:13]
+                result["shoot_time"] = cleaned
+                result["shoot_timestamp"] = _exif_timestamp(raw_time)
+            except (ValueError, AttributeError):
+                pass
+            break
+
+    make, model = exif_data.get(271), exif_data.get(272)
+    if isinstance(make, str) or isinstance(model, str):
+        camera = _camera_name(make if isinstance(make, str) else "", model if isinstance(model, str) else "")
+        if camera:
+            result["camera"] = camera
+
+    gps_info_tag = 34853
+    if gps_info_tag in exif_data:
+        gps_data = exif_data[gps_info_tag]
+
+        def gps_to_decimal(gps_coords, gps_ref):
+            degrees = float(gps_coords[0])
+            minutes = float(gps_coords[1])
+            seconds = float(gps_coords[2])
+            decimal = degrees + minutes / 60.0 + seconds / 3600.0
+            if gps_ref in ("S", "W"):
+                decimal = -decimal
+            return decimal
+
+        if 2 in gps_data and 1 in gps_data:
+            result["gps_lat"] = gps_to_decimal(gps_data[2], gps_data[1])
+        if 4 in gps_data and 3 in gps_data:
+            result["gps_lon"] = gps_to_decimal(gps_data[4], gps_data[3])
+    return result
 
+
+def _draft_box(size: tuple, max_size: int) -> tuple:
+    """按原图比例计算长边为 max_size 的目标框，供 JPEG draft 选择缩放系数"""
+    width, height = size
+    ratio = max_size / max(width, height)
+    return max(1, math.ceil(width * ratio)), max(1, math.ceil(height * ratio))
+
+
+# 发送给 AI 的图片尺寸策略：首轮识别前还不知道鸟在哪里，整张照片统一按 1280px 发送；
+# 低置信度时按首轮返回的 bird_bbox 再发送鸟所在区域的裁剪图，鸟在画面中越小，裁剪图给的像素越多
+AI_IMAGE_MAX_SIZE = 1280
+AI_IMAGE_DETAIL_MAX_SIZE = 1600
+AI_IMAGE_QUALITY = 85
+# 首轮 bird_bbox 面积占画面比例低于该值视为小鸟，二次识别的裁剪图用 AI_IMAGE_DETAIL_MAX_SIZE
+AI_SMALL_BIRD_AREA = 0.05
+AI_CROP_MAX_SIZE = 1280
+AI_CROP_QUALITY = 85
+
+
+def bbox_area_fraction(bbox) -> "float | None":
+    """bird_bbox（0-100 的百分比坐标）占整个画面的面积比例；格式无效时返回 None"""
     try:
-        img = Image.open(io.BytesIO(actual_bytes))
-        return img
-    except Exception:
+        x1, y1, x2, y2 = (float(value) for value in bbox)
+    except (TypeError, ValueError):
+        return None
+    if x2 <= x1 or y2 <= y1:
         return None
+    return (min(x2, 100.0) - max(x1, 0.0)) * (min(y2, 100.0) - max(y1, 0.0)) / 10000
 
 
-def encode_image_to_base64(image_bytes: bytes, max_size: int = 2048, filename: str = "") -> str:
-    """将图片字节编码为 base64 字符串，可选压缩。支持 RAW 格式。"""
-    img = image_bytes_to_pil(image_bytes, filename)
-    if img is not None:
-        try:
-            if img.mode not in ("RGB", "L"):
-                img = img.convert("RGB")
-            width, height = img.size
-            if max(width, height) > max_size:
-                ratio = max_size / max(width, height)
-                new_size = (int(width * ratio), int(height * ratio))
-                img = img.resize(new_size, Image.LANCZOS)
-            buffer = io.BytesIO()
-            img.save(buffer, format="JPEG", quality=85)
-            return base64.b64encode(buffer.getvalue()).decode("utf-8")
-        except Exception:
-            pass
-    return base64.b64encode(image_bytes).decode("utf-8")
+# 发送给 AI 的图片以 data URL 形式组装（前缀和 base64 一次写入同一块缓冲区）
+DATA_URL_PREFIX = "data:image/jpeg;base64,"
+# 分块 base64 编码的块大小（3 的倍数，块之间不会出现填充字符）。
+# 块的编码结果是临时副本，取 12KB 使其对缩略图大小的载荷也可以忽略，编码速度不受影响
+_BASE64_CHUNK = 3 * 4096
 
 
-def extract_exif_info(image_bytes: bytes, filename: str = "") -> dict:
-    """从照片 EXIF 中提取拍摄时间和 GPS 坐标。支持 RAW 格式。"""
-    result = {"shoot_time": "", "gps_lat": None, "gps_lon": None}
-    if not HAS_PIL:
-        return result
+def _encode_jpeg_base64(img: "Image.Image", quality: int, prefix: str = "") -> str:
+    """JPEG 编码并转为 base64 字符串（可带 data URL 前缀）。
 
-    # RAW 格式：先提取内嵌 JPEG 再读 EXIF
-    actual_bytes = image_bytes
-    if is_raw_file(filename):
-        jpeg_data = extract_jpeg_from_raw(image_bytes)
-        if jpeg_data:
-            actual_bytes = jpeg_data
-        else:
-            return result
+    直接在 BytesIO 的内部缓冲区（getbuffer）上分块编码，写入按最终长度一次分配的
+    bytearray，不产生 getvalue() 副本和完整长度的中间 bytes；JPEG 缓冲区在转成 str 之前释放。
+    """
+    buffer = io.BytesIO()
+    img.save(buffer, format="JPEG", quality=quality)
+    head = prefix.encode("ascii")
+    with buffer.getbuffer() as view:
+        size = len(view)
+        out = bytearray(len(head) + 4 * ((size + 2) // 3))
+        out[:len(head)] = head
+        position = len(head)
+        for start in range(0, size, _BASE64_CHUNK):
+            chunk = binascii.b2a_base64(view[start:start + _BASE64_CHUNK], newline=False)
+            out[position:position + len(chunk)] = chunk
+            position += len(chunk)
+    buffer.close()
+    return out.decode("ascii")
+
+
+class ImageContext:
+    """单张照片的解码上下文：容器只解析一次、像素只解码一次。
+
+    EXIF、AI 编码图、缩略图、结果卡片预览图都从同一次解码派生并缓存，
+    避免同一张照片（尤其是 25-60MB 的 RAW）被 Pillow 反复打开、反复扫描。
+    JPEG 利用 DCT 域缩放（1/2、1/4、1/8）直接解码到不小于 decode_max_size 的尺寸，
+    2400 万像素以上的原图无需解码全部像素。
+    处理完成后调用 release() 释放解码像素，只保留小尺寸预览图。
+    """
 
-    try:
-        img = Image.open(io.BytesIO(actual_bytes))
-        exif_data = img._getexif()
-        if not exif_data:
-            return result
-
-        for tag_id in (36867, 36868, 306):
-            if tag_id in exif_data:
-                raw_time = exif_data[tag_id]
+    PREVIEW_MAX_SIZE = 1200
+
+    def __init__(self, image_bytes: bytes, filename: str = "", decode_max_size: int = 2048):
+        self.image_bytes = image_bytes
+        self.filename = filename
+        self.decode_max_size = decode_max_size
+        self._source_bytes = None
+        self._opened = None
+        self._image = None
+        self._failed = False
+        self._exif_info = None
+        self._preview = None
+        self._bird_previews = {}
+        self._renditions = {}
+
+    @property
+    def source_bytes(self) -> bytes:
+        """可被 Pillow 解码的字节：RAW 取内嵌 JPEG（只提取一次），其余为原始字节"""
+        if self._source_bytes is None:
+            if is_raw_file(self.filename):
+                self._source_bytes = extract_jpeg_from_raw(self.image_bytes)
+            else:
+                self._source_bytes = self.image_bytes
+        return self._source_bytes
+
+    def _open(self) -> "Image.Image | None":
+        """打开图片容器（只读文件头，不解码像素）"""
+        if self._opened is None and not self._failed:
+            if not HAS_PIL or not self.source_bytes:
+                self._failed = True
+                return None
+            try:
+                self._opened = Image.open(io.BytesIO(self.source_bytes))
+            except Exception:
+                self._failed = True
+        return self._opened
+
+    def image(self) -> "Image.Image | None":
+        """解码后的 RGB/L 图像（只解码一次，长边不小于 decode_max_size 或原图尺寸）"""
+        if self._image is None:
+            img = self._open()
+            if img is None:
+                return None
+            try:
+                if self.decode_max_size and max(img.size) > self.decode_max_size:
+                    # 仅 JPEG 支持 draft，其他格式为空操作
+                    img.draft(None, _draft_box(img.size, self.decode_max_size))
+                if img.mode not in ("RGB", "L"):
+                    img = img.convert("RGB")
+                else:
+                    img.load()
+                self._image = img
+            except Exception:
+                self._failed = True
+                return None
+        return self._image
+
+    def exif_info(self) -> dict:
+        """拍摄时间、GPS、相机和曝光参数（只读文件头，不解析预览图、不解码像素）"""
+        if self._exif_info is None:
+            result = read_photo_metadata(self.image_bytes)
+            if result is None or (is_raw_file(self.filename) and not result["shoot_time"]
+                                  and result["gps_lat"] is None):
+                # PNG/HEIC/WebP 等格式、以及 IFD0 没有 EXIF 的 RAW 交给 Pillow 读取（同样不解码像素）
+                result = result or {"shoot_time": "", "shoot_timestamp": None, "gps_lat": None, "gps_lon": None}
+                img = self._open()
+                if img is not None:
+                    try:
+                        result.update(_exif_dict_to_info(img._getexif()))
+                    except Exception:
+                        pass
+            self._exif_info = result
+        return dict(self._exif_info)
+
+    def _resized(self, max_width: int = 0, max_size: int = 0) -> "Image.Image | None":
+        img = self.image()
+        if img is None:
+            return None
+        width, height = img.size
+        if max_width and width > max_width:
+            ratio = max_width / width
+            return img.resize((max_width, int(height * ratio)), Image.LANCZOS)
+        if max_size and max(width, height) > max_size:
+            ratio = max_size / max(width, height)
+            return img.resize((int(width * ratio), int(height * ratio)), Image.LANCZOS)
+        return img
+
+    def _jpeg_base64(self, key: tuple, img_factory, quality: int, prefix: str = "") -> str:
+        if key not in self._renditions:
+            encoded = ""
+            try:
+                img = img_factory()
+                if img is not None:
+                    encoded = _encode_jpeg_base64(img, quality, prefix)
+            except Exception:
+                encoded = ""
+            self._renditions[key] = encoded
+        return self._renditions[key]
+
+    @staticmethod
+    def ai_payload_size(bbox=None) -> int:
+        """发送给 AI 的长边尺寸：没有首轮 bird_bbox 时为 AI_IMAGE_MAX_SIZE；
+        首轮标出的鸟面积占比低于 AI_SMALL_BIRD_AREA 时为 AI_IMAGE_DETAIL_MAX_SIZE"""
+        area = bbox_area_fraction(bbox) if bbox else None
+        if area is not None and area < AI_SMALL_BIRD_AREA:
+            return AI_IMAGE_DETAIL_MAX_SIZE
+        return AI_IMAGE_MAX_SIZE
+
+    def ai_base64(self, max_size: int = 0) -> str:
+        """发送给 AI 的 base64 JPEG（长边不超过 max_size，为 0 时为整张照片的 ai_payload_size()）。
+        解码失败时退回原始字节。"""
+        return self.ai_data_url(max_size)[len(DATA_URL_PREFIX):]
+
+    def ai_data_url(self, max_size: int = 0) -> str:
+        """发送给 AI 的图片 data URL（可直接放进 image_url，无需再拼接字符串）"""
+        max_size = max_size or self.ai_payload_size()
+        encoded = self._jpeg_base64(
+            ("ai", max_size), lambda: self._resized(max_size=max_size), AI_IMAGE_QUALITY, DATA_URL_PREFIX,
+        )
+        return encoded or DATA_URL_PREFIX + base64.b64encode(self.image_bytes).decode("ascii")
+
+    def _bird_crop(self, bbox: list, max_size: int, annotate: bool = False) -> "Image.Image | None":
+        """按 bbox 裁剪出鸟所在区域（长边不超过 max_size）。
+
+        重新打开原图，按裁剪区域需要的分辨率做 DCT 域缩放后解码，裁剪图的清晰度
+        不受 decode_max_size 限制。annotate 为 True 时在缩小后的裁剪图上标注 AI 识别区域。
+        鸟已占满画面（crop_to_bird 不裁剪）时返回 None。
+        """
+        img = Image.open(io.BytesIO(self.source_bytes))
+        full_size = img.size
+        x1, y1, x2, y2 = (float(value) for value in bbox)
+        bird_long_side = max((x2 - x1) * full_size[0], (y2 - y1) * full_size[1]) / 100
+        if bird_long_side > max_size:
+            img.draft(None, _draft_box(full_size, max_size * max(full_size) / bird_long_side))
+        if img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        box = bird_crop_box(img.size, bbox)
+        if box is None:
+            return None
+        cropped = img.crop(box)
+        if max(cropped.size) > max_size:
+            cropped.thumbnail((max_size, max_size), Image.LANCZOS)
+        if annotate:
+            # bbox 换算为裁剪区域内的百分比坐标，标注框按展示尺寸绘制
+            left, top, right, bottom = box
+            crop_bbox = [
+                (img.width * x1 / 100 - left) * 100 / (right - left),
+                (img.height * y1 / 100 - top) * 100 / (bottom - top),
+                (img.width * x2 / 100 - left) * 100 / (right - left),
+                (img.height * y2 / 100 - top) * 100 / (bottom - top),
+            ]
+            cropped = draw_bird_bbox(cropped, crop_bbox)
+        return cropped
+
+    def bird_crop_data_url(self, bbox: list, max_size: int = AI_CROP_MAX_SIZE) -> str:
+        """鸟所在区域的高清裁剪图 data URL，用于低置信度时的二次识别。无法裁剪时返回空字符串"""
+        if not bbox or len(bbox) != 4 or not HAS_PIL or not self.source_bytes:
+            return ""
+        return self._jpeg_base64(
+            ("crop", tuple(bbox), max_size), lambda: self._bird_crop(bbox, max_size), AI_CROP_QUALITY,
+            DATA_URL_PREFIX,
+        )
+
+    def thumbnail_base64(self, max_width: int = 480) -> str:
+        """缩略图 base64（保留完整画面，宽度不超过 max_width）"""
+        return self._jpeg_base64(("thumb", max_width), lambda: self._resized(max_width=max_width), 80)
+
+    def thumbnail_bytes(self, max_width: int = 480) -> bytes:
+        """写入图片存储的缩略图二进制（IMAGE_STORE_FORMAT 编码，宽度不超过 max_width）。失败返回空字节"""
+        key = ("thumb-bytes", max_width)
+        if key not in self._renditions:
+            data = b""
+            try:
+                img = self._resized(max_width=max_width)
+                if img is not None:
+                    buffer = io.BytesIO()
+                    img.save(buffer, format=IMAGE_STORE_FORMAT, quality=80)
+                    data = buffer.getvalue()
+            except Exception:
+                data = b""
+            self._renditions[key] = data
+        return self._renditions[key]
+
+    def dhash(self) -> "int | None":
+        """64 位差值感知哈希（9x8 灰度缩略图相邻像素比较），用于连拍相似帧检测"""
+        if "dhash" not in self._renditions:
+            value = None
+            img = self.image()
+            if img is not None:
                 try:
-                    cleaned = raw_time.replace(":", "").replace(" ", "_")[:13]
-                    result["shoot_time"] = cleaned
-                except (ValueError, AttributeError):
-                    pass
-                break
+                    pixels = list(img.convert("L").resize((9, 8), Image.BILINEAR).getdata())
+                    value = 0
+                    for row in range(8):
+                        for col in range(8):
+                            left = pixels[row * 9 + col]
+                            right = pixels[row * 9 + col + 1]
+                            value = (value << 1) | (1 if left > right else 0)
+                except Exception:
+                    value = None
+            self._renditions["dhash"] = value
+        return self._renditions["dhash"]
+
+    def preview(self) -> "Image.Image | None":
+        """结果卡片用的预览图（长边不超过 PREVIEW_MAX_SIZE），release() 后仍保留"""
+        if self._preview is None:
+            try:
+                self._preview = self._resized(max_size=self.PREVIEW_MAX_SIZE)
+            except Exception:
+                self._preview = None
+        return self._preview
+
+    def bird_preview(self, bbox) -> "Image.Image | None":
+        """结果卡片用的鸟区域预览图（标注 AI 识别区域），release() 后仍保留。
+
+        从原图按裁剪区域需要的分辨率解码后裁剪、再缩小到 PREVIEW_MAX_SIZE，
+        不在 1200px 的 preview() 上裁剪放大。没有 bbox 时返回 preview()；
+        鸟已占满画面时在 preview() 上标注。
+        """
+        if not bbox or len(bbox) != 4:
+            return self.preview()
+        key = tuple(bbox)
+        if key not in self._bird_previews:
+            image = None
+            try:
+                if HAS_PIL and self.source_bytes:
+                    image = self._bird_crop(bbox, self.PREVIEW_MAX_SIZE, annotate=True)
+                if image is None and self.preview() is not None:
+                    image = draw_bird_bbox(self.preview(), bbox)
+            except Exception:
+                image = self.preview()
+            self._bird_previews[key] = image
+        return self._bird_previews[key]
 
-        gps_info_tag = 34853
-        if gps_info_tag in exif_data:
-            gps_data = exif_data[gps_info_tag]
-
-            def gps_to_decimal(gps_coords, gps_ref):
-                degrees = float(gps_coords[0])
-                minutes = float(gps_coords[1])
-                seconds = float(gps_coords[2])
-                decimal = degrees + minutes / 60.0 + seconds / 3600.0
-                if gps_ref in ("S", "W"):
-                    decimal = -decimal
-                return decimal
-
-            if 2 in gps_data and 1 in gps_data:
-                result["gps_lat"] = gps_to_decimal(gps_data[2], gps_data[1])
-            if 4 in gps_data and 3 in gps_data:
-                result["gps_lon"] = gps_to_decimal(gps_data[4], gps_data[3])
-    except Exception:
-        pass
-    return result
+    def release(self) -> None:
+        """释放解码像素、容器和编码缓存，只保留预览图（含鸟区域预览图）和 EXIF"""
+        self.preview()
+        self.exif_info()
+        self._image = None
+        self._opened = None
+        self._source_bytes = None
+        self._renditions.clear()
 
 
 def reverse_geocode(latitude: float, longitude: float) -> str:
@@ -1179,11 +1946,358 @@ def reverse_geocode(latitude: float, longitude: float) -> str:
     return ""
 
 
-def _build_context_block(exif_info: dict) -> tuple:
-    """构建地理位置和季节辅助信息，返回 (context_block, season)"""
-    context_block = ""
+# ============================================================
+# AI 客户端（进程级复用 HTTP 连接池）
+# ============================================================
+DASHSCOPE_BASE_URL = "https://dashscope.aliyuncs.com/compatible-mode/v1"
+# 单进程内所有会话共享的连接池上限（keep-alive 连接保留 60 秒，复用 TLS 会话）
+AI_HTTP_MAX_CONNECTIONS = 32
+AI_HTTP_MAX_KEEPALIVE = 16
+AI_HTTP_KEEPALIVE_EXPIRY = 60.0
+
+
+@st.cache_resource(show_spinner=False)
+def get_ai_client(api_key: str, base_url: str = DASHSCOPE_BASE_URL) -> OpenAI:
+    """按 (api_key, base_url) 返回进程级共享的 OpenAI 兼容客户端。
+
+    所有会话、所有线程共用同一个 httpx 连接池，避免每张照片都重新 TLS 握手。
+    安装了 h2 时启用 HTTP/2 多路复用。OpenAI 客户端本身是线程安全的。
+    """
+    http_client = httpx.Client(
+        http2=HAS_HTTP2,
+        limits=httpx.Limits(
+            max_connections=AI_HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=AI_HTTP_MAX_KEEPALIVE,
+            keepalive_expiry=AI_HTTP_KEEPALIVE_EXPIRY,
+        ),
+        timeout=httpx.Timeout(120.0, connect=10.0),
+    )
+    return OpenAI(api_key=api_key, base_url=base_url, http_client=http_client)
+
+
+@st.cache_resource(show_spinner=False)
+def get_ai_loop() -> asyncio.AbstractEventLoop:
+    """进程级后台事件循环（守护线程中常驻），所有会话的异步 AI 调用都在这里执行"""
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="birdeye-ai-loop", daemon=True).start()
+    return loop
+
+
+def run_in_ai_loop(coro):
+    """在后台事件循环中执行协程并同步等待结果（供非事件循环线程调用）"""
+    return asyncio.run_coroutine_threadsafe(coro, get_ai_loop()).result()
+
+
+@st.cache_resource(show_spinner=False)
+def get_async_ai_client(api_key: str, base_url: str = DASHSCOPE_BASE_URL) -> AsyncOpenAI:
+    """get_ai_client 的异步版本，只能在 get_ai_loop() 的事件循环中使用"""
+    http_client = httpx.AsyncClient(
+        http2=HAS_HTTP2,
+        limits=httpx.Limits(
+            max_connections=AI_HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=AI_HTTP_MAX_KEEPALIVE,
+            keepalive_expiry=AI_HTTP_KEEPALIVE_EXPIRY,
+        ),
+        timeout=httpx.Timeout(120.0, connect=10.0),
+    )
+    # 重试由 resilient_chat_completion 统一控制，关闭 SDK 内置重试以免叠加
+    return AsyncOpenAI(api_key=api_key, base_url=base_url, http_client=http_client, max_retries=0)
+
+
+@st.cache_resource(show_spinner=False)
+def get_image_executor() -> concurrent.futures.ThreadPoolExecutor:
+    """进程级图片处理线程池（Pillow 解码/缩放/编码时释放 GIL，可真正并行）"""
+    return concurrent.futures.ThreadPoolExecutor(
+        max_workers=min(4, os.cpu_count() or 1), thread_name_prefix="birdeye-image",
+    )
+
+
+# DashScope 调用限流（进程级，所有会话共享）：令牌桶限制请求速率，AIMD 调整并发上限
+AI_RATE_LIMIT_QPS = float(os.environ.get("BIRDEYE_AI_QPS", "2"))
+AI_RATE_LIMIT_BURST = 4
+AI_CONCURRENCY_INITIAL = 3
+AI_CONCURRENCY_MIN = 1
+AI_CONCURRENCY_MAX = 12
+# 延迟超过历史均值的该倍数时视为“延迟不稳定”，暂停加性增长
+AI_LATENCY_TOLERANCE = 1.5
+# 保留最近多少次成功请求的延迟（用于计算 p95）
+AI_LATENCY_WINDOW = 200
+
+# 失败重试：超时 / 连接错误 / 429 / 5xx 按“全抖动”指数退避重试
+AI_RETRY_MAX_ATTEMPTS = int(os.environ.get("BIRDEYE_AI_RETRIES", "3"))
+AI_RETRY_BASE_DELAY = 1.0
+AI_RETRY_MAX_DELAY = 20.0
+# 对冲请求：首个请求超过 p95 延迟仍未返回时再发一个，取先返回者
+AI_HEDGE_ENABLED = os.environ.get("BIRDEYE_AI_HEDGE", "1") != "0"
+AI_HEDGE_MIN_SAMPLES = 20
+AI_HEDGE_MIN_DELAY = 3.0
+
+
+class AdaptiveRateLimiter:
+    """令牌桶 + AIMD 并发控制器（只在 get_ai_loop() 的事件循环中使用）。
+
+    - 每次请求需要一个令牌（速率 rate，容量 burst）和一个并发名额（limit）
+    - 请求成功且延迟稳定：并发上限 +1/limit（约每轮 +1），速率缓慢恢复
+    - 遇到 429 / 5xx / 超时：并发上限和速率减半
+    """
+
+    def __init__(self, rate: float, burst: int, initial_limit: int, min_limit: int, max_limit: int):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = float(initial_limit)
+        self._tokens = float(burst)
+        self._last_refill = time.monotonic()
+        self._in_flight = 0
+        self._waiting = 0
+        self._condition = asyncio.Condition()
+        self._wait_ewma = 0.0
+        self._latency_ewma = None
+        self._backoff_count = 0
+        self._last_backoff = 0.0
+        self._latencies = deque(maxlen=AI_LATENCY_WINDOW)
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+
+    async def acquire(self) -> float:
+        """等待一个令牌和并发名额，返回排队耗时（秒）"""
+        started = time.monotonic()
+        self._waiting += 1
+        try:
+            async with self._condition:
+                while True:
+                    delay = None
+                    if self._in_flight < int(self.limit):
+                        self._refill()
+                        if self._tokens >= 1:
+                            self._tokens -= 1
+                            self._in_flight += 1
+                            break
+                        delay = (1 - self._tokens) / self.rate
+                    try:
+                        await asyncio.wait_for(self._condition.wait(), delay)
+                    except asyncio.TimeoutError:
+                        pass
+        finally:
+            self._waiting -= 1
+        waited = time.monotonic() - started
+        self._wait_ewma = 0.8 * self._wait_ewma + 0.2 * waited
+        return waited
+
+    async def release(self, latency: float | None, backoff: bool = False) -> None:
+        """归还并发名额，并按本次结果调整并发上限和速率（latency 为 None 表示请求被取消，不参与调整）"""
+        async with self._condition:
+            self._in_flight -= 1
+            if latency is None and not backoff:
+                self._condition.notify_all()
+                return
+            now = time.monotonic()
+            if backoff:
+                self._backoff_count += 1
+                # 同一批并发请求同时失败只算一次拥塞，一个延迟窗口内最多减半一次
+                if now - self._last_backoff < (self._latency_ewma or 1.0):
+                    self._condition.notify_all()
+                    return
+                self._last_backoff = now
+                self.limit = max(self.min_limit, self.limit / 2)
+                self.rate = max(self.max_rate / 8, self.rate / 2)
+                print(f"[限流] 触发退避：并发上限 {self.limit:.1f}，速率 {self.rate:.2f}/s")
+            else:
+                self._latencies.append(latency)
+                if self._latency_ewma is None or latency <= self._latency_ewma * AI_LATENCY_TOLERANCE:
+                    self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+                    self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+                self._latency_ewma = latency if self._latency_ewma is None else (
+                    0.8 * self._latency_ewma + 0.2 * latency
+                )
+            self._condition.notify_all()
+
+    def latency_p95(self) -> float | None:
+        """最近成功请求延迟的 p95，样本不足时返回 None"""
+        if len(self._latencies) < AI_HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(self._latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+
+    def metrics(self) -> dict:
+        """当前限流状态（供日志/界面展示）"""
+        return {
+            "limit": round(self.limit, 2),
+            "in_flight": self._in_flight,
+            "queue_depth": self._waiting,
+            "rate": round(self.rate, 2),
+            "avg_wait_seconds": round(self._wait_ewma, 3),
+            "avg_latency_seconds": round(self._latency_ewma or 0.0, 3),
+            "backoff_count": self._backoff_count,
+            "latency_p95_seconds": round(self.latency_p95() or 0.0, 3),
+        }
+
+
+@st.cache_resource(show_spinner=False)
+def get_ai_rate_limiter() -> AdaptiveRateLimiter:
+    """进程级共享的 DashScope 限流器"""
+    return AdaptiveRateLimiter(
+        AI_RATE_LIMIT_QPS, AI_RATE_LIMIT_BURST,
+        AI_CONCURRENCY_INITIAL, AI_CONCURRENCY_MIN, AI_CONCURRENCY_MAX,
+    )
+
+
+def _is_backoff_error(exc: Exception) -> bool:
+    """429 / 5xx / 超时说明服务端过载，需要退避"""
+    status_code = getattr(exc, "status_code", None)
+    if status_code is not None:
+        return status_code == 429 or status_code >= 500
+    return isinstance(exc, (APITimeoutError, httpx.TimeoutException))
+
+
+async def _stream_chat_text(client: AsyncOpenAI, json_stream: "IncrementalJSONParser", **kwargs) -> str:
+    """流式调用 chat.completions.create，边接收边喂给增量 JSON 解析器，返回完整文本"""
+    json_stream.reset()
+    stream = await client.chat.completions.create(
+        stream=True, stream_options={"include_usage": True}, **kwargs,
+    )
+    parts = []
+    try:
+        async for chunk in stream:
+            # 开启 include_usage 后，最后一个分片只携带 token 用量
+            if getattr(chunk, "usage", None):
+                json_stream.usage = chunk.usage
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                parts.append(delta)
+                json_stream.feed(delta)
+                if json_stream.stop_requested:
+                    break
+    finally:
+        # 提前结束时关闭连接，服务端随即停止生成
+        await stream.close()
+    return "".join(parts)
+
+
+async def limited_chat_completion(client: AsyncOpenAI, sent_event: asyncio.Event | None = None,
+                                  json_stream: "IncrementalJSONParser | None" = None, **kwargs):
+    """经过进程级限流器调用 chat.completions.create（拿到名额、请求发出时置位 sent_event）。
+
+    传入 json_stream 时改为流式调用，返回完整文本而不是 ChatCompletion。
+    """
+    limiter = get_ai_rate_limiter()
+    await limiter.acquire()
+    if sent_event is not None:
+        sent_event.set()
+    started = time.monotonic()
+    backoff = False
+    latency = None
+    try:
+        if json_stream is None:
+            response = await client.chat.completions.create(**kwargs)
+        else:
+            response = await _stream_chat_text(client, json_stream, **kwargs)
+        latency = time.monotonic() - started
+        return response
+    except Exception as exc:
+        backoff = _is_backoff_error(exc)
+        raise
+    finally:
+        await limiter.release(latency, backoff=backoff)
+
+
+def _is_retryable_error(exc: Exception) -> bool:
+    """超时、连接错误、429、5xx 可以重试；400/401 等请求本身的问题不重试"""
+    status_code = getattr(exc, "status_code", None)
+    if status_code is not None:
+        return status_code == 429 or status_code >= 500
+    return isinstance(exc, (APIConnectionError, httpx.TransportError))
+
+
+def _retry_delay(exc: Exception, attempt: int) -> float:
+    """全抖动指数退避；服务端给出 Retry-After 时以它为下限"""
+    delay = random.uniform(0, min(AI_RETRY_MAX_DELAY, AI_RETRY_BASE_DELAY * (2 ** attempt)))
+    response = getattr(exc, "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    try:
+        delay = max(delay, min(AI_RETRY_MAX_DELAY, float(retry_after)))
+    except (TypeError, ValueError):
+        pass
+    return delay
+
+
+async def _hedged_chat_completion(client: AsyncOpenAI, **kwargs):
+    """首个请求超过 p95 延迟仍未返回时发出对冲请求，取先成功返回的结果"""
+    limiter = get_ai_rate_limiter()
+    first_sent = asyncio.Event()
+    first = asyncio.create_task(limited_chat_completion(client, sent_event=first_sent, **kwargs))
+    hedge_after = limiter.latency_p95() if AI_HEDGE_ENABLED else None
+    # 流式请求已经在逐步返回内容，两路流也无法共用一个解析器，不做对冲
+    if hedge_after is None or kwargs.get("json_stream") is not None:
+        return await first
+    hedge_after = max(hedge_after, AI_HEDGE_MIN_DELAY)
+    # p95 从请求真正发出时开始计时，排队时间不算
+    sent_waiter = asyncio.create_task(first_sent.wait())
+    await asyncio.wait({first, sent_waiter}, return_when=asyncio.FIRST_COMPLETED)
+    sent_waiter.cancel()
+    done, _ = await asyncio.wait({first}, timeout=hedge_after)
+    # 已有请求在排队时说明配额紧张，不再额外发请求
+    if done or limiter.metrics()["queue_depth"] > 0:
+        return await first
+
+    print(f"[对冲请求] 首个请求超过 p95（{hedge_after:.1f}s），发出对冲请求")
+    pending = {first, asyncio.create_task(limited_chat_completion(client, **kwargs))}
+    first_error = None
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                first_error = first_error or task.exception()
+        raise first_error
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def resilient_chat_completion(client: AsyncOpenAI, **kwargs):
+    """带限流、重试和对冲请求的 chat.completions.create"""
+    for attempt in range(AI_RETRY_MAX_ATTEMPTS):
+        try:
+            return await _hedged_chat_completion(client, **kwargs)
+        except Exception as exc:
+            if attempt + 1 >= AI_RETRY_MAX_ATTEMPTS or not _is_retryable_error(exc):
+                raise
+            delay = _retry_delay(exc, attempt)
+            print(f"[重试] 第 {attempt + 1} 次调用失败（{type(exc).__name__}），{delay:.1f}s 后重试")
+            await asyncio.sleep(delay)
+
+
+# 地点/季节约束下的识别逻辑（批量识别时多张图片共用一份）
+_CONTEXT_RULES = (
+    "\n你必须严格按照以下逻辑进行识别：\n"
+    "1. 先根据外形特征初步判断可能的鸟种（列出2-3个候选种）\n"
+    "2. 然后逐一检查每个候选种在该地区、该季节是否有分布记录\n"
+    "3. 排除在该地区该季节不可能出现的鸟种\n"
+    "4. 从剩余候选种中选择最匹配的\n"
+    "候鸟的季节性分布尤其重要：夏候鸟只在繁殖季出现，冬候鸟只在越冬季出现，"
+    "旅鸟只在迁徙季短暂停留。"
+)
+
+
+def _context_facts(exif_info: dict) -> tuple:
+    """拍摄地点、坐标、时间、季节等事实信息（每项一行），返回 (facts, season)"""
+    facts = ""
     season = ""
     location_name = exif_info.get("geocoded_location", "")
+    if isinstance(location_name, dict):
+        # reverse_geocode 返回 {"province", "city", "district"}
+        location_name = "".join(
+            location_name.get(key, "") for key in ("province", "city", "district")
+        )
 
     if exif_info.get("shoot_time"):
         raw_time = exif_info["shoot_time"]
@@ -1199,26 +2313,23 @@ def _build_context_block(exif_info: dict) -> tuple:
             else:
                 season = "冬季（越冬期，12-2月）"
 
-    if location_name or season or (exif_info.get("gps_lat") and exif_info.get("gps_lon")):
-        context_block = "\n\n【关键约束 - 必须结合以下信息缩小候选鸟种范围】\n"
-        if location_name:
-            context_block += f"拍摄地点：{location_name}\n"
-        if exif_info.get("gps_lat") and exif_info.get("gps_lon"):
-            context_block += f"GPS坐标：北纬{abs(exif_info['gps_lat']):.4f}°，东经{abs(exif_info['gps_lon']):.4f}°\n"
-        if exif_info.get("shoot_time"):
-            context_block += f"拍摄时间：{exif_info['shoot_time']}\n"
-        if season:
-            context_block += f"季节：{season}\n"
-        context_block += (
-            "\n你必须严格按照以下逻辑进行识别：\n"
-            "1. 先根据外形特征初步判断可能的鸟种（列出2-3个候选种）\n"
-            "2. 然后逐一检查每个候选种在该地区、该季节是否有分布记录\n"
-            "3. 排除在该地区该季节不可能出现的鸟种\n"
-            "4. 从剩余候选种中选择最匹配的\n"
-            "候鸟的季节性分布尤其重要：夏候鸟只在繁殖季出现，冬候鸟只在越冬季出现，"
-            "旅鸟只在迁徙季短暂停留。"
-        )
+    if location_name:
+        facts += f"拍摄地点：{location_name}\n"
+    if exif_info.get("gps_lat") and exif_info.get("gps_lon"):
+        facts += f"GPS坐标：北纬{abs(exif_info['gps_lat']):.4f}°，东经{abs(exif_info['gps_lon']):.4f}°\n"
+    if exif_info.get("shoot_time"):
+        facts += f"拍摄时间：{exif_info['shoot_time']}\n"
+    if season:
+        facts += f"季节：{season}\n"
+    return facts, season
 
+
+def _build_context_block(exif_info: dict) -> tuple:
+    """构建地理位置和季节辅助信息，返回 (context_block, season)"""
+    facts, season = _context_facts(exif_info)
+    if not facts:
+        return "", season
+    context_block = "\n\n【关键约束 - 必须结合以下信息缩小候选鸟种范围】\n" + facts + _CONTEXT_RULES
     return context_block, season
 
 
@@ -1277,200 +2388,1468 @@ def _phase1_candidates(client, image_base64: str, context_block: str) -> list:
         ],
     )
 
-    result_text = response.choices[0].message.content.strip()
-    json_match = re.search(r'\{.*\}', result_text, re.DOTALL)
-    if json_match:
-        try:
-            parsed = json.loads(json_match.group())
-            return parsed.get("candidates", []), parsed.get("excluded_species", []), parsed.get("observed_features", "")
-        except (json.JSONDecodeError, ValueError):
-            pass
+    parsed = _extract_json_from_text(response.choices[0].message.content or "")
+    if parsed:
+        return parsed.get("candidates", []), parsed.get("excluded_species", []), parsed.get("observed_features", "")
     return [], [], ""
 
 
-def _extract_json_from_text(text: str) -> dict | None:
-    """从 AI 返回的文本中提取 JSON 对象"""
-    cleaned = text.strip()
-    if cleaned.startswith("```"):
-        lines = cleaned.split("\n")
-        lines = [line for line in lines if not line.strip().startswith("```")]
-        cleaned = "\n".join(lines)
-    json_match = re.search(r'\{.*\}', cleaned, re.DOTALL)
-    if json_match:
+# JSON 提取只关心这几种字符：引号、转义符和括号
+_JSON_SIGNIFICANT_RE = re.compile(r'["\\{}\[\]]')
+_JSON_OPENERS = {dict: "{", list: "["}
+_JSON_DECODER = json.JSONDecoder()
+
+
+def _scan_json_block(text: str, start: int) -> int:
+    """从 start 处的 { 或 [ 开始单遍扫描（识别字符串和转义），返回配对闭括号之后的下标；
+    直到文本结束都没有闭合（输出被截断）时返回 -1"""
+    depth = 0
+    in_string = False
+    skip_to = -1
+    for match in _JSON_SIGNIFICANT_RE.finditer(text, start):
+        i = match.start()
+        if i < skip_to:
+            continue
+        ch = match.group()
+        if in_string:
+            if ch == "\\":
+                skip_to = i + 2  # 跳过被转义的字符
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch in "{[":
+            depth += 1
+        elif ch in "}]":
+            depth -= 1
+            if depth == 0:
+                return i + 1
+    return -1
+
+
+def _repair_json(fragment: str):
+    """宽松修复：去掉 } ] 前多余的逗号和重复的逗号；输出被截断时补齐引号和括号，
+    补齐仍无法解析就依次回退到前几个逗号处截断。修复失败返回 None"""
+    out = []
+    stack = []
+    cut_points = []  # [(截断位置, 当时未闭合的括号)]
+    in_string = False
+    escape = False
+    for ch in fragment:
+        if in_string:
+            if escape:
+                escape = False
+            elif ch == "\\":
+                escape = True
+            elif ch == '"':
+                in_string = False
+            out.append(ch)
+            continue
+        if ch == '"':
+            in_string = True
+        elif ch in "{[":
+            stack.append("}" if ch == "{" else "]")
+        elif ch in "}]":
+            while out and out[-1].isspace():
+                out.pop()
+            if out and out[-1] == ",":
+                out.pop()
+            if stack:
+                stack.pop()
+        elif ch == ",":
+            previous = next((c for c in reversed(out) if not c.isspace()), "")
+            if previous in (",", "[", "{"):
+                continue  # 重复的逗号和括号后的逗号直接丢弃
+            cut_points.append((len(out), "".join(reversed(stack))))
+        out.append(ch)
+
+    # 完整补齐：未闭合的字符串和括号补上，悬空的逗号/冒号去掉或补 null
+    tail = "".join(out) + ('"' if in_string and not escape else "")
+    tail = tail.rstrip()
+    if tail.endswith(","):
+        tail = tail[:-1]
+    elif tail.endswith(":"):
+        tail += " null"
+    attempts = [tail + "".join(reversed(stack))]
+    attempts += ["".join(out[:pos]) + closers for pos, closers in reversed(cut_points[-5:])]
+    for attempt in attempts:
         try:
-            return json.loads(json_match.group())
-        except (json.JSONDecodeError, ValueError):
-            return None
+            return json.loads(attempt)
+        except ValueError:
+            continue
     return None
 
-def identify_bird(image_base64: str, api_key: str, exif_info: dict) -> dict:
-    """单阶段鸟类识别 + 摄影评分（使用 qwen-vl-max-latest）
 
-    通过强化版思维链 prompt 引导 AI 先逐项观察特征、列候选、排除，再做最终判断。
-    单次调用完成，兼顾速度和准确率。
+def _extract_json_from_text(text: str, expect: type = dict):
+    """从 AI 返回的文本中提取 JSON 对象（expect=list 时提取数组）。
+
+    从第一个 { 开始严格解析（代码块标记、说明文字、其后的第二个 JSON 块都会被忽略）；
+    失败时单遍扫描出括号配对的块（识别字符串内的括号），修复多余逗号和被截断的输出。
+    有多个块时取第一个能解析的。
     """
-    client = OpenAI(
-        api_key=api_key,
-        base_url="https://dashscope.aliyuncs.com/compatible-mode/v1",
-    )
+    opener = _JSON_OPENERS[expect]
+    start = text.find(opener)
+    while start != -1:
+        try:
+            # 严格解析：只解析从 start 开始的一个 JSON 值，忽略其后的文本
+            parsed, end = _JSON_DECODER.raw_decode(text, start)
+        except ValueError:
+            end = _scan_json_block(text, start)
+            parsed = _repair_json(text[start:] if end == -1 else text[start:end])
+        if isinstance(parsed, expect):
+            return parsed
+        if end == -1:
+            break
+        start = text.find(opener, end)
+    return None
 
-    context_block, season = _build_context_block(exif_info)
 
-    fail_result = {
-        "chinese_name": "未知鸟类", "english_name": "unknown",
-        "order_chinese": "未知目", "order_english": "Unknown",
-        "family_chinese": "未知科", "family_english": "Unknown",
-        "confidence": "low", "score": 0,
-        "score_sharpness": 0, "score_composition": 0,
-        "score_lighting": 0, "score_background": 0,
-        "score_pose": 0, "score_artistry": 0,
-        "score_comment": "识别失败",
-        "identification_basis": "",
-        "bird_description": "",
-    }
+class IncrementalJSONParser:
+    """流式 JSON 对象解析器：逐块喂入模型输出，顶层字段一完整就回调 on_field(key, value)。
 
-    try:
-        response = client.chat.completions.create(
-            model="qwen-vl-max-latest",
-            temperature=0.1,
-            messages=[
-                {
-                    "role": "system",
-                    "content": (
-                        "你是一位专精中国鸟类的顶级鸟类学家和鸟类摄影评审专家。"
-                        "你熟悉《中国鸟类野外手册》《中国鸟类分类与分布名录》中记录的所有鸟种，"
-                        "精通中国境内1400余种鸟类的辨识要点、分布范围和季节性变化。"
-                        "你能根据细微的羽色差异区分中国常见的易混淆种（如柳莺类、鹀类、鸫类、鹟类等）。"
-                        "同时你精通鸟类摄影的评判标准，评分非常严格，只有真正出色的照片才能获得高分。"
-                    ),
-                },
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "image_url",
-                            "image_url": {"url": f"data:image/jpeg;base64,{image_base64}"},
-                        },
-                        {
-                            "type": "text",
-                            "text": (
-                                "请完成以下任务：\n\n"
-                                "## 任务一：鸟种识别（严格按步骤执行）\n"
-                                "这张照片拍摄于中国境内。\n\n"
-                                "**步骤1 - 逐项特征观察（必须每项都描述）：**\n"
-                                "- 体型：大小（与麻雀/鸽子/乌鸦对比）、体型比例\n"
-                                "- 喙：形状（锥形/钩形/细长/扁平）、长度、粗细、颜色\n"
-                                "- 头部：冠羽有无、眉纹（颜色/粗细）、贯眼纹、眼圈、头顶色\n"
-                                "- 上体：背部羽色、翼斑有无及颜色、腰色\n"
-                                "- 下体：喉/胸/腹/胁部颜色和斑纹\n"
-                                "- 尾羽：长短、形状（方尾/圆尾/叉尾）、颜色\n"
-                                "- 腿脚颜色\n"
-                                "- 栖息环境\n\n"
-                                "**步骤2 - 列出3个候选种并逐一比对：**\n"
-                                "对每个候选种说明：哪些特征支持、哪些不符、在该地区该季节是否有分布。\n\n"
-                                "**步骤3 - 最终判定：**\n"
-                                "从候选种中选出最匹配的，说明决定性的区分依据。\n\n"
-                                "## 任务二：鸟的位置标注\n"
-                                "估算鸟在图片中的位置，用百分比坐标 [x1, y1, x2, y2]（0-100）。\n"
-                                "边界框应紧密包围整只鸟。多只鸟时标注最显眼的。\n\n"
-                                "## 任务三：专业摄影评分\n"
-                                "以国际鸟类摄影大赛的标准严格评分。\n\n"
-                                "**【核心评分方法 - 必须严格遵守】**\n"
-                                "每个维度从该维度满分的50%开始，根据优缺点加减分：\n"
-                                "- 有明显优点：+1到+3分\n"
-                                "- 有明显缺点：-1到-5分\n"
-                                "- 有严重缺陷：直接降到该维度满分的20%以下\n"
-                                "- 只有极其出色才能超过该维度满分的80%\n\n"
-                                "**1. 主体清晰度（0-20分，起始10分）**\n"
-                                "鸟眼锐利+2/模糊-3；羽毛纤毫毕现+3/模糊-3；运动模糊-2到-4\n\n"
-                                "**2. 构图与美感（0-20分，起始10分）**\n"
-                                "三分法/黄金分割+2；居中平庸-2；主体裁切-3到-5\n\n"
-                                "**3. 光线与色彩（0-20分，起始10分）**\n"
-                                "黄金时段+3；正午顶光-2；过曝/欠曝-3\n\n"
-                                "**4. 背景与环境（0-15分，起始7分）**\n"
-                                "奶油虚化+3；杂乱-3；干扰元素-2到-4\n\n"
-                                "**5. 姿态与瞬间（0-15分，起始7分）**\n"
-                                "行为瞬间+3到+5；普通静立不加分；背对/遮挡-2到-4\n\n"
-                                "**6. 艺术性与故事感（0-10分，起始3分）**\n"
-                                "纯记录照2-3分；有氛围4-5分；有意境6-7分；8+需强烈共鸣\n\n"
-                                "**总分分布：** 90+百里挑一；75-89优秀约10%；55-74大多数；40-54有不足；<40很差\n\n"
-                                "**反作弊：总分>80时重新审视每个分项，不确定则降2-3分。**\n\n"
-                                "只返回一个 JSON 对象，不要返回其他内容。\n"
-                                "{\n"
-                                '  "chinese_name": "最终确定的中文种名（相似度最高的）",\n'
-                                '  "english_name": "英文种名",\n'
-                                '  "order_chinese": "目中文名",\n'
-                                '  "order_english": "目英文名",\n'
-                                '  "family_chinese": "科中文名",\n'
-                                '  "family_english": "科英文名",\n'
-                                '  "confidence": "high/medium/low",\n'
-                                '  "candidates": [\n'
-                                '    {"chinese_name": "第1候选种中文名", "english_name": "英文名", "similarity": 85, "reason": "支持该种的关键特征（15字以内）"},\n'
-                                '    {"chinese_name": "第2候选种中文名", "english_name": "英文名", "similarity": 60, "reason": "支持该种的关键特征（15字以内）"},\n'
-                                '    {"chinese_name": "第3候选种中文名", "english_name": "英文名", "similarity": 30, "reason": "支持该种的关键特征（15字以内）"}\n'
-                                '  ],\n'
-                                '  "identification_basis": "最终选择该种的关键依据，以及排除其他候选种的理由（30字以内）",\n'
-                                '  "excluded_similar_species": "排除的易混淆种及理由（如：非白头鹎，因缺少红色臀部）",\n'
-                                '  "bird_description": "该鸟种详细介绍（100-150字），含外形、习性、生境、分布、常见程度",\n'
-                                '  "bird_bbox": [x1, y1, x2, y2],\n'
-                                '  "score": 0,\n'
-                                '  "score_sharpness": 0,\n'
-                                '  "score_composition": 0,\n'
-                                '  "score_lighting": 0,\n'
-                                '  "score_background": 0,\n'
-                                '  "score_pose": 0,\n'
-                                '  "score_artistry": 0,\n'
-                                '  "score_comment": "照片点评（30字以内）"\n'
-                                "}\n\n"
-                                "要求：\n"
-                                "1. 必须精确到具体鸟种，目和科使用正确分类学名称\n"
-                                "2. 如果无法识别，chinese_name 填 \"未知鸟类\"\n"
-                                "3. score 必须等于6个分项之和\n"
-                                "4. 每个分项必须根据照片实际情况独立评判\n"
-                                "5. identification_basis 必须说明为何选择该种而非其他候选种\n"
-                                "6. excluded_similar_species 必须列出至少1个排除的易混淆种及理由\n"
-                                "7. candidates 必须包含2-3个候选鸟种，按 similarity 从高到低排列\n"
-                                "8. similarity 为0-100的整数，表示该候选种与照片中鸟的匹配程度，所有候选种的 similarity 之和不需要等于100\n"
-                                "9. chinese_name 必须与 candidates 中 similarity 最高的候选种一致"
-                                f"{context_block}"
-                            ),
-                        },
-                    ],
-                },
-            ],
-        )
-    except Exception as api_error:
-        import traceback
-        traceback.print_exc()
-        fail_result["score_comment"] = f"AI 接口调用失败: {type(api_error).__name__}: {str(api_error)[:100]}"
-        return fail_result
+    只扫描新到达的字符（整体线性时间），会跳过对象前后的 ``` 代码块标记等杂项文本。
+    已到达的文本按块存入列表，不做字符串累加（累加每次都要复制全部已收到的输出）；
+    当前字段和整个对象的文本在完整时才拼接一次。
+    """
 
-    try:
-        result_text = response.choices[0].message.content.strip()
-    except (AttributeError, IndexError) as parse_error:
-        fail_result["score_comment"] = f"AI 返回数据异常: {parse_error}"
-        return fail_result
+    def __init__(self, on_field=None):
+        self.on_field = on_field
+        self.reset()
+
+    def reset(self) -> None:
+        """重新开始解析（请求重试时调用）"""
+        self.fields = {}
+        self.usage = None
+        self.complete = False
+        # 回调中置位后停止接收剩余输出（后续字段可从缓存补齐时提前结束生成）
+        self.stop_requested = False
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._object_parts = []  # 顶层对象从 { 开始已收到的文本块
+        self._member_parts = []  # 当前顶层字段此前各块中的文本
+
+    def feed(self, chunk: str) -> None:
+        if self.complete:
+            return
+        # 本块中当前对象、当前字段的起点（对象开始前为 None）
+        object_start = member_start = 0 if self._depth else None
+        end = len(chunk)
+        for i, ch in enumerate(chunk):
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+            elif self._depth == 0:
+                # 顶层对象之外的文本（代码块标记、说明文字）直接跳过
+                if ch == "{":
+                    self._depth = 1
+                    object_start, member_start = i, i + 1
+            elif ch == '"':
+                self._in_string = True
+            elif ch in "{[":
+                self._depth += 1
+            elif ch in "}]":
+                self._depth -= 1
+                if self._depth == 0:
+                    self._emit_member(chunk[member_start:i])
+                    self.complete = True
+                    end = i + 1
+                    break
+            elif ch == "," and self._depth == 1:
+                self._emit_member(chunk[member_start:i])
+                member_start = i + 1
+        if object_start is not None:
+            self._object_parts.append(chunk[object_start:end])
+            if not self.complete:
+                self._member_parts.append(chunk[member_start:])
+
+    def _emit_member(self, tail: str) -> None:
+        self._member_parts.append(tail)
+        member = "".join(self._member_parts).strip()
+        self._member_parts = []
+        if not member:
+            return
+        try:
+            item = json.loads("{" + member + "}")
+        except ValueError:
+            return
+        for key, value in item.items():
+            self.fields[key] = value
+            if self.on_field:
+                try:
+                    self.on_field(key, value)
+                except Exception as exc:
+                    print(f"[流式解析] 字段回调失败: {type(exc).__name__}: {exc}")
 
-    parsed = _extract_json_from_text(result_text)
-    if not parsed:
-        fail_result["score_comment"] = "AI 返回内容中未找到有效 JSON"
-        return fail_result
-
-    # 校正评分
-    dimension_keys = [
-        ("score_sharpness", 20), ("score_composition", 20),
-        ("score_lighting", 20), ("score_background", 15),
-        ("score_pose", 15), ("score_artistry", 10),
+    def result(self) -> dict | None:
+        """完整对象解析结果；输出被截断或无法解析时返回 None"""
+        if not self.complete:
+            return None
+        try:
+            parsed = json.loads("".join(self._object_parts))
+        except ValueError:
+            return self.fields or None
+        return parsed if isinstance(parsed, dict) else None
+
+# ============================================================
+# 本地持久化缓存（SQLite，跨会话、跨进程共享）
+# ============================================================
+LOCAL_CACHE_DIR = Path(os.environ.get("BIRDEYE_CACHE_DIR", Path(__file__).parent / ".cache"))
+LOCAL_CACHE_DB = LOCAL_CACHE_DIR / "birdeye_cache.sqlite3"
+IDENTIFY_CACHE_TTL_SECONDS = 30 * 86400
+IDENTIFY_CACHE_MAX_ENTRIES = 5000
+# 修改识别 prompt 或模型时递增，使旧缓存自动失效
+IDENTIFY_CACHE_VERSION = "qwen-vl-max-latest/v3"
+# 鸟种知识缓存：目/科、英文名、介绍等只取决于鸟种的字段，按鸟种中文名存储，跨照片复用
+SPECIES_TAXONOMY_KEYS = ("order_chinese", "order_english", "family_chinese", "family_english")
+SPECIES_KNOWLEDGE_KEYS = ("english_name",) + SPECIES_TAXONOMY_KEYS + ("bird_description", "identification_basis")
+
+
+def _local_cache_connect() -> sqlite3.Connection:
+    """打开本地缓存库（每次调用新建连接，线程/进程间通过 SQLite 文件锁安全共享）"""
+    LOCAL_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(LOCAL_CACHE_DB, timeout=10)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS identify_cache ("
+        "key TEXT PRIMARY KEY, result TEXT NOT NULL, "
+        "created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_identify_cache_accessed ON identify_cache (accessed_at)")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS species_knowledge ("
+        "species TEXT PRIMARY KEY, data TEXT NOT NULL, updated_at REAL NOT NULL)"
+    )
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS range_observations ("
+        "species TEXT NOT NULL, province TEXT NOT NULL, month INTEGER NOT NULL, "
+        "source TEXT NOT NULL, count INTEGER NOT NULL, "
+        "PRIMARY KEY (species, province, month, source))"
+    )
+    return conn
+
+
+def identify_cache_key(image_base64: str, context_block: str) -> str:
+    """识别结果的内容寻址 key：AI 图片载荷 + 地点/季节上下文 + prompt 版本"""
+    digest = hashlib.sha256()
+    digest.update(IDENTIFY_CACHE_VERSION.encode("utf-8"))
+    digest.update(b"\x00")
+    digest.update(context_block.encode("utf-8"))
+    digest.update(b"\x00")
+    # data URL 与裸 base64 得到相同的 key；分块哈希，不复制整个载荷
+    start = len(DATA_URL_PREFIX) if image_base64.startswith(DATA_URL_PREFIX) else 0
+    for offset in range(start, len(image_base64), 1 << 20):
+        digest.update(image_base64[offset:offset + (1 << 20)].encode("ascii", errors="ignore"))
+    return digest.hexdigest()
+
+
+def identify_cache_get(key: str) -> dict | None:
+    """读取未过期的缓存识别结果，命中时刷新访问时间（LRU）"""
+    now = time.time()
+    try:
+        with closing(_local_cache_connect()) as conn, conn:
+            row = conn.execute(
+                "SELECT result FROM identify_cache WHERE key = ? AND created_at > ?",
+                (key, now - IDENTIFY_CACHE_TTL_SECONDS),
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE identify_cache SET accessed_at = ? WHERE key = ?", (now, key))
+            return json.loads(row[0])
+    except (sqlite3.Error, OSError, ValueError) as exc:
+        print(f"[识别缓存] 读取失败: {exc}")
+        return None
+
+
+def identify_cache_put(key: str, result: dict) -> None:
+    """写入识别结果，并按 TTL 和最大条数（最久未访问优先）淘汰旧记录"""
+    now = time.time()
+    try:
+        with closing(_local_cache_connect()) as conn, conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO identify_cache (key, result, created_at, accessed_at) "
+                "VALUES (?, ?, ?, ?)",
+                (key, json.dumps(result, ensure_ascii=False), now, now),
+            )
+            conn.execute(
+                "DELETE FROM identify_cache WHERE created_at <= ?",
+                (now - IDENTIFY_CACHE_TTL_SECONDS,),
+            )
+            conn.execute(
+                "DELETE FROM identify_cache WHERE key IN ("
+                "SELECT key FROM identify_cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                (IDENTIFY_CACHE_MAX_ENTRIES,),
+            )
+    except (sqlite3.Error, OSError, TypeError, ValueError) as exc:
+        print(f"[识别缓存] 写入失败: {exc}")
+
+
+def _species_fields_from_result(result: dict) -> dict:
+    """从一次识别结果中取出只与鸟种有关的字段（识别依据因照片而异，不取）"""
+    fields = {}
+    for key in SPECIES_KNOWLEDGE_KEYS:
+        value = result.get(key)
+        if key == "identification_basis" or not isinstance(value, str):
+            continue
+        value = value.strip()
+        if value and not value.startswith("未知") and value.lower() not in ("unknown", "英文种名"):
+            fields[key] = value
+    return fields
+
+
+def species_knowledge_get(species: str) -> dict | None:
+    """读取鸟种知识缓存（同步 SQLite 访问，在事件循环中需经 asyncio.to_thread 调用）"""
+    try:
+        with closing(_local_cache_connect()) as conn:
+            row = conn.execute(
+                "SELECT data FROM species_knowledge WHERE species = ?", (species.strip(),)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+    except (sqlite3.Error, OSError, ValueError) as exc:
+        print(f"[鸟种知识] 读取失败: {exc}")
+        return None
+
+
+def species_knowledge_put(species: str, fields: dict) -> None:
+    """合并写入鸟种知识（空值不覆盖已有内容）"""
+    species = (species or "").strip()
+    fields = {key: value for key, value in fields.items() if key in SPECIES_KNOWLEDGE_KEYS and value}
+    if not species or species.startswith("未知") or not fields:
+        return
+    try:
+        with closing(_local_cache_connect()) as conn, conn:
+            row = conn.execute(
+                "SELECT data FROM species_knowledge WHERE species = ?", (species,)
+            ).fetchone()
+            data = json.loads(row[0]) if row else {}
+            data.update(fields)
+            conn.execute(
+                "INSERT OR REPLACE INTO species_knowledge (species, data, updated_at) VALUES (?, ?, ?)",
+                (species, json.dumps(data, ensure_ascii=False), time.time()),
+            )
+    except (sqlite3.Error, OSError, TypeError, ValueError) as exc:
+        print(f"[鸟种知识] 写入失败: {exc}")
+
+
+@st.cache_resource(show_spinner=False)
+def start_species_knowledge_seed() -> bool:
+    """进程启动时在后台线程中执行一次 _seed_species_knowledge，不阻塞页面和 AI 事件循环"""
+    threading.Thread(target=_seed_species_knowledge, name="birdeye-knowledge-seed", daemon=True).start()
+    return True
+
+
+def _seed_species_knowledge() -> None:
+    """用已缓存的历史识别结果补齐鸟种知识（只补缺，不覆盖）"""
+    try:
+        with closing(_local_cache_connect()) as conn, conn:
+            known = {row[0] for row in conn.execute("SELECT species FROM species_knowledge")}
+            seeded = {}
+            for (result_json,) in conn.execute("SELECT result FROM identify_cache"):
+                try:
+                    result = json.loads(result_json)
+                except ValueError:
+                    continue
+                species = str(result.get("chinese_name", "")).strip()
+                fields = _species_fields_from_result(result)
+                if species and species not in known and all(fields.get(k) for k in SPECIES_TAXONOMY_KEYS):
+                    seeded.setdefault(species, {}).update(fields)
+            now = time.time()
+            conn.executemany(
+                "INSERT OR IGNORE INTO species_knowledge (species, data, updated_at) VALUES (?, ?, ?)",
+                [(species, json.dumps(data, ensure_ascii=False), now) for species, data in seeded.items()],
+            )
+        if seeded:
+            print(f"[鸟种知识] 从历史识别结果补充 {len(seeded)} 个鸟种")
+    except (sqlite3.Error, OSError) as exc:
+        print(f"[鸟种知识] 初始化失败: {exc}")
+
+
+# ============================================================
+# 离线鸟种分类索引（随应用分发的 china_birds.tsv，不依赖网络和模型）
+# ============================================================
+TAXONOMY_INDEX_PATH = Path(__file__).parent / "china_birds.tsv"
+_TAXONOMY_COLUMNS = (
+    "chinese_name", "english_name", "scientific_name",
+    "order_chinese", "order_english", "family_chinese", "family_english",
+)
+
+
+def _taxonomy_key(name: str) -> str:
+    """名称归一化：忽略大小写、撇号、连字符和多余空白（Magpie-Robin = magpie robin）"""
+    name = re.sub(r"['’`]", "", name or "")
+    return re.sub(r"[\s\-_]+", " ", name).strip().casefold()
+
+
+class SpeciesTaxonomyIndex:
+    """内存映射的鸟种分类索引：按中文名 / 英文名 / 学名 / 别名精确查询，或按前缀搜索。
+
+    内存中只保留「归一化名称 → 行偏移」，记录内容按需从 mmap 中解析。
+    正式名称优先于别名（别名与其他鸟种的正式名称冲突时以正式名称为准）。
+    """
+
+    def __init__(self, path: Path):
+        with open(path, "rb") as index_file:
+            self._data = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._offsets = {}
+        alias_offsets = []
+        self.species_count = 0
+        offset = 0
+        for line in iter(self._data.readline, b""):
+            if line.strip() and not line.startswith(b"#"):
+                fields = line.decode("utf-8").rstrip("\r\n").split("\t")
+                self.species_count += 1
+                for name in fields[:3]:
+                    self._offsets.setdefault(_taxonomy_key(name), offset)
+                if len(fields) > 7:
+                    alias_offsets.extend((alias, offset) for alias in fields[7].split("|") if alias)
+            offset += len(line)
+        for alias, alias_offset in alias_offsets:
+            self._offsets.setdefault(_taxonomy_key(alias), alias_offset)
+        self._offsets.pop("", None)
+        self._sorted_keys = sorted(self._offsets)
+
+    def _record(self, offset: int) -> dict:
+        end = self._data.find(b"\n", offset)
+        line = self._data[offset:end if end != -1 else len(self._data)].decode("utf-8").rstrip("\r")
+        fields = line.split("\t")
+        record = dict(zip(_TAXONOMY_COLUMNS, fields))
+        record["aliases"] = [alias for alias in fields[7].split("|") if alias] if len(fields) > 7 else []
+        return record
+
+    def lookup(self, name: str) -> dict | None:
+        """按任意名称（中文名 / 英文名 / 学名 / 别名）精确查询"""
+        offset = self._offsets.get(_taxonomy_key(name))
+        return self._record(offset) if offset is not None else None
+
+    def search_prefix(self, prefix: str, limit: int = 10) -> list:
+        """前缀搜索（二分定位），同一鸟种只返回一次"""
+        key = _taxonomy_key(prefix)
+        if not key:
+            return []
+        results = []
+        seen_offsets = set()
+        for name_key in self._sorted_keys[bisect.bisect_left(self._sorted_keys, key):]:
+            if not name_key.startswith(key) or len(results) >= limit:
+                break
+            offset = self._offsets[name_key]
+            if offset not in seen_offsets:
+                seen_offsets.add(offset)
+                results.append(self._record(offset))
+        return results
+
+
+@st.cache_resource(show_spinner=False)
+def get_taxonomy_index() -> SpeciesTaxonomyIndex | None:
+    """进程级共享的分类索引（首次使用时加载），文件缺失时返回 None"""
+    try:
+        index = SpeciesTaxonomyIndex(TAXONOMY_INDEX_PATH)
+    except (OSError, ValueError) as exc:
+        print(f"[分类索引] 加载失败: {exc}")
+        return None
+    print(f"[分类索引] 已加载 {index.species_count} 个鸟种")
+    return index
+
+
+def lookup_species(name: str) -> dict | None:
+    """离线查询鸟种（任意名称），索引不可用或未收录时返回 None"""
+    index = get_taxonomy_index()
+    return index.lookup(name) if index is not None and name else None
+
+
+def canonicalize_species_result(result: dict) -> dict:
+    """用离线分类索引校验并规范化 AI 输出：统一种名，目/科以索引为准。
+
+    taxonomy_verified 表示鸟种是否在索引中找到（未收录的鸟种保留 AI 原始输出）。
+    """
+    entry = lookup_species(str(result.get("chinese_name", ""))) or lookup_species(
+        str(result.get("english_name", ""))
+    )
+    if entry:
+        for key in _TAXONOMY_COLUMNS:
+            result[key] = entry[key]
+    result["taxonomy_verified"] = entry is not None
+
+    for candidate in result.get("candidates") or []:
+        if not isinstance(candidate, dict):
+            continue
+        candidate_entry = lookup_species(str(candidate.get("chinese_name", ""))) or lookup_species(
+            str(candidate.get("english_name", ""))
+        )
+        if candidate_entry:
+            candidate["chinese_name"] = candidate_entry["chinese_name"]
+            candidate["english_name"] = candidate_entry["english_name"]
+    return result
+
+
+# ============================================================
+# 分布先验（鸟种 × 省份 × 月份 出现网格），用于候选种重排序和分布异常提示
+# ============================================================
+RANGE_PRIOR_PROVINCES = tuple(CHINA_PROVINCES_CITIES)
+# 当月有记录 / 相邻月份有记录 / 该省其他月份有记录 / 该省无记录
+RANGE_PRIOR_PRESENT = 1.0
+RANGE_PRIOR_ADJACENT_MONTH = 0.6
+RANGE_PRIOR_OTHER_MONTH = 0.3
+RANGE_PRIOR_ABSENT = 0.05
+# 省份记录总数少于该值时数据不足，不做判断（先验为 1）
+RANGE_PRIOR_MIN_PROVINCE_RECORDS = 30
+# 首选鸟种先验低于该值时提示“不在常见分布范围”
+RANGE_PRIOR_FLAG_THRESHOLD = 0.1
+
+
+def record_range_observations(rows: list, source: str) -> None:
+    """写入出现记录 [(鸟种, 省份, 月份1-12, 数量)]。
+
+    source="photo" 时数量累加（用户照片识别结果）；其他来源（如 "ebird"）取最大值，
+    同一批数据重复写入不会重复计数。
+    """
+    rows = [
+        (species, province, int(month), source, int(count or 1))
+        for species, province, month, count in rows
+        if species and province in RANGE_PRIOR_PROVINCES and 1 <= int(month or 0) <= 12
     ]
+    if not rows:
+        return
+    update = "count + excluded.count" if source == "photo" else "MAX(count, excluded.count)"
+    try:
+        with closing(_local_cache_connect()) as conn, conn:
+            conn.executemany(
+                "INSERT INTO range_observations (species, province, month, source, count) "
+                "VALUES (?, ?, ?, ?, ?) ON CONFLICT (species, province, month, source) "
+                f"DO UPDATE SET count = {update}",
+                rows,
+            )
+    except (sqlite3.Error, OSError) as exc:
+        print(f"[分布先验] 写入失败: {exc}")
+
+
+def record_ebird_range_observations(bird_species: list, province: str, name_translations: dict) -> None:
+    """把探索页查到的 eBird 近期观测记入出现网格（中文名优先用离线分类索引规范化）"""
+    province = match_province_in_data(province)
+    rows = []
+    for bird in bird_species:
+        date = str(bird.get("observation_date", ""))
+        if not date[5:7].isdigit():
+            continue
+        entry = lookup_species(bird.get("scientific_name", "")) or lookup_species(bird.get("common_name", ""))
+        species = entry["chinese_name"] if entry else name_translations.get(bird.get("common_name", ""))
+        rows.append((species, province, int(date[5:7]), bird.get("obs_count", 1)))
+    record_range_observations(rows, "ebird")
+
+
+class RangePrior:
+    """鸟种 × 省份 × 月份 的出现先验网格（扁平数组，下标 (鸟种 * 省份数 + 省份) * 12 + 月份）。
+
+    构建时按出现记录预先算好平滑后的先验值，查询只是一次数组取值；
+    安装了 NumPy 时整批候选种用向量化方式打分。
+    """
+
+    def __init__(self, observations: list):
+        self.species_index = {}
+        province_index = {name: i for i, name in enumerate(RANGE_PRIOR_PROVINCES)}
+        counts = {}
+        province_totals = [0] * len(RANGE_PRIOR_PROVINCES)
+        for species, province, month, count in observations:
+            p = province_index.get(province)
+            if p is None or not 1 <= month <= 12:
+                continue
+            s = self.species_index.setdefault(species, len(self.species_index))
+            counts[(s, p, month - 1)] = counts.get((s, p, month - 1), 0) + count
+            province_totals[p] += count
+        self.province_index = province_index
+        self.dense_provinces = [total >= RANGE_PRIOR_MIN_PROVINCE_RECORDS for total in province_totals]
+
+        shape = (len(self.species_index), len(RANGE_PRIOR_PROVINCES), 12)
+        if HAS_NUMPY:
+            present = np.zeros(shape, dtype=bool)
+            for (s, p, m) in counts:
+                present[s, p, m] = True
+            adjacent = np.roll(present, 1, axis=2) | np.roll(present, -1, axis=2)
+            any_month = present.any(axis=2, keepdims=True)
+            grid = np.where(present, RANGE_PRIOR_PRESENT, np.where(
+                adjacent, RANGE_PRIOR_ADJACENT_MONTH, np.where(
+                    any_month, RANGE_PRIOR_OTHER_MONTH, RANGE_PRIOR_ABSENT)))
+            grid[:, ~np.array(self.dense_provinces, dtype=bool), :] = 1.0
+            self.grid = grid.astype(np.float32).ravel()
+        else:
+            self.grid = array.array("f", [1.0]) * (shape[0] * shape[1] * 12)
+            for s in range(shape[0]):
+                for p in range(shape[1]):
+                    if not self.dense_provinces[p]:
+                        continue
+                    base = (s * shape[1] + p) * 12
+                    months = [(s, p, m) in counts for m in range(12)]
+                    for m in range(12):
+                        if months[m]:
+                            value = RANGE_PRIOR_PRESENT
+                        elif months[m - 1] or months[(m + 1) % 12]:
+                            value = RANGE_PRIOR_ADJACENT_MONTH
+                        elif any(months):
+                            value = RANGE_PRIOR_OTHER_MONTH
+                        else:
+                            value = RANGE_PRIOR_ABSENT
+                        self.grid[base + m] = value
+
+    def _cell(self, species: str, province: str) -> int | None:
+        s = self.species_index.get(species)
+        p = self.province_index.get(province)
+        if s is None or p is None:
+            return None
+        return (s * len(RANGE_PRIOR_PROVINCES) + p) * 12
+
+    def prior(self, species: str, province: str, month: int | None = None) -> float:
+        """单个鸟种的先验；鸟种或省份没有数据时为 1（不影响排序）。月份未知时取全年最大值"""
+        base = self._cell(species, province)
+        if base is None:
+            return 1.0
+        if month:
+            return float(self.grid[base + month - 1])
+        return float(max(self.grid[base:base + 12]))
+
+    def score_batch(self, rows: list) -> list:
+        """批量打分。rows: [(province, month, [(鸟种, 相似度), ...]), ...]
+
+        返回与 rows 对应的 [[(先验, 相似度 × 先验), ...], ...]。
+        """
+        flat = [
+            (self._cell(species, province), month, similarity)
+            for province, month, candidates in rows
+            for species, similarity in candidates
+        ]
+        if HAS_NUMPY and flat and all(month for _, month, _ in flat):
+            cells = np.array([-1 if base is None else base + month - 1 for base, month, _ in flat])
+            similarities = np.array([similarity for _, _, similarity in flat], dtype=np.float32)
+            # 只对有数据的格子取值；网格为空（全新安装、还没有出现记录）时全部为 1
+            priors = np.ones(len(flat), dtype=np.float32)
+            known = cells >= 0
+            priors[known] = self.grid[cells[known]]
+            scores = similarities * priors
+            pairs = list(zip(priors.tolist(), scores.tolist()))
+        else:
+            pairs = []
+            for (province, month, candidates) in rows:
+                for species, similarity in candidates:
+                    prior = self.prior(species, province, month)
+                    pairs.append((prior, similarity * prior))
+        results = []
+        position = 0
+        for _, _, candidates in rows:
+            results.append(pairs[position:position + len(candidates)])
+            position += len(candidates)
+        return results
+
+
+@st.cache_resource(ttl=600, show_spinner=False)
+def get_range_prior() -> RangePrior:
+    """进程级分布先验（每 10 分钟按最新出现记录重建）"""
+    try:
+        with closing(_local_cache_connect()) as conn:
+            observations = conn.execute(
+                "SELECT species, province, month, SUM(count) FROM range_observations "
+                "GROUP BY species, province, month"
+            ).fetchall()
+    except (sqlite3.Error, OSError) as exc:
+        print(f"[分布先验] 读取失败: {exc}")
+        observations = []
+    return RangePrior(observations)
+
+
+def apply_range_prior(results: list, province: str, month: int | None) -> None:
+    """按 相似度 × 分布先验 重排每个结果的 candidates，并标记不在常见分布范围内的首选鸟种。
+
+    只修改结果本身（写入 range_prior / range_warning 字段），不改动 AI 给出的首选鸟种，
+    由用户在候选列表中确认。
+    """
+    province = match_province_in_data(province)
+    if not province or not results:
+        return
+    prior_model = get_range_prior()
+    rows = []
+    for result in results:
+        candidates = [c for c in result.get("candidates") or [] if isinstance(c, dict)]
+        result["candidates"] = candidates
+        rows.append((province, month, [
+            (str(c.get("chinese_name", "")), float(c.get("similarity", 0) or 0)) for c in candidates
+        ]))
+    for result, row_scores in zip(results, prior_model.score_batch(rows)):
+        for candidate, (prior, score) in zip(result["candidates"], row_scores):
+            candidate["range_prior"] = round(prior, 2)
+            candidate["rank_score"] = round(score, 2)
+        result["candidates"].sort(key=lambda c: c["rank_score"], reverse=True)
+        pick_prior = prior_model.prior(str(result.get("chinese_name", "")), province, month)
+        result["range_prior"] = round(pick_prior, 2)
+        if pick_prior < RANGE_PRIOR_FLAG_THRESHOLD:
+            when = f"{month}月" if month else ""
+            result["range_warning"] = f"{province}{when}少有该鸟种记录，请核对候选种"
+        else:
+            result.pop("range_warning", None)
+
+
+# 识别和评分 prompt 共用的任务描述（连拍相似帧只评分时复用同一套评分标准）
+_BBOX_TASK_PROMPT = (
+    "估算鸟在图片中的位置，用百分比坐标 [x1, y1, x2, y2]（0-100）。\n"
+    "边界框应紧密包围整只鸟。多只鸟时标注最显眼的。\n\n"
+)
+
+_SCORING_TASK_PROMPT = (
+    "以国际鸟类摄影大赛的标准严格评分。\n\n"
+    "**【核心评分方法 - 必须严格遵守】**\n"
+    "每个维度从该维度满分的50%开始，根据优缺点加减分：\n"
+    "- 有明显优点：+1到+3分\n"
+    "- 有明显缺点：-1到-5分\n"
+    "- 有严重缺陷：直接降到该维度满分的20%以下\n"
+    "- 只有极其出色才能超过该维度满分的80%\n\n"
+    "**1. 主体清晰度（0-20分，起始10分）**\n"
+    "鸟眼锐利+2/模糊-3；羽毛纤毫毕现+3/模糊-3；运动模糊-2到-4\n\n"
+    "**2. 构图与美感（0-20分，起始10分）**\n"
+    "三分法/黄金分割+2；居中平庸-2；主体裁切-3到-5\n\n"
+    "**3. 光线与色彩（0-20分，起始10分）**\n"
+    "黄金时段+3；正午顶光-2；过曝/欠曝-3\n\n"
+    "**4. 背景与环境（0-15分，起始7分）**\n"
+    "奶油虚化+3；杂乱-3；干扰元素-2到-4\n\n"
+    "**5. 姿态与瞬间（0-15分，起始7分）**\n"
+    "行为瞬间+3到+5；普通静立不加分；背对/遮挡-2到-4\n\n"
+    "**6. 艺术性与故事感（0-10分，起始3分）**\n"
+    "纯记录照2-3分；有氛围4-5分；有意境6-7分；8+需强烈共鸣\n\n"
+    "**总分分布：** 90+百里挑一；75-89优秀约10%；55-74大多数；40-54有不足；<40很差\n\n"
+    "**反作弊：总分>80时重新审视每个分项，不确定则降2-3分。**\n\n"
+)
+
+# 评分维度及满分
+_SCORE_DIMENSIONS = [
+    ("score_sharpness", 20), ("score_composition", 20),
+    ("score_lighting", 20), ("score_background", 15),
+    ("score_pose", 15), ("score_artistry", 10),
+]
+
+
+def _normalize_scores(parsed: dict) -> None:
+    """校正评分：各分项截断到 [0, 满分]，总分重新按分项求和"""
     total = 0
-    for key, max_val in dimension_keys:
+    for key, max_val in _SCORE_DIMENSIONS:
         val = max(0, min(max_val, int(parsed.get(key, 0))))
         parsed[key] = val
         total += val
     parsed["score"] = total
+
+
+# 识别档位：fast 只返回鸟种/候选/位置/评分（输出 token 少、速度快），介绍和识别依据按需再取；
+# full 为单次调用返回全部字段
+IDENTIFY_TIER = os.environ.get("BIRDEYE_IDENTIFY_TIER", "fast")
+IDENTIFY_MODEL = "qwen-vl-max-latest"
+# 按需获取鸟种介绍 / 识别要点的纯文本模型（不需要看图）
+SPECIES_DETAIL_MODEL = os.environ.get("BIRDEYE_DETAIL_MODEL", "qwen-plus")
+
+
+def _identify_output_spec(detail: bool, batch: bool = False) -> str:
+    """识别 prompt 的输出格式部分。detail=False 时省略介绍、识别依据、排除理由等长文本字段；
+    batch=True 时要求返回 {"results": [...]}，每张图片一个对象并带图片编号"""
+    detail_fields = (
+        '  "identification_basis": "最终选择该种的关键依据，以及排除其他候选种的理由（30字以内）",\n'
+        '  "excluded_similar_species": "排除的易混淆种及理由（如：非白头鹎，因缺少红色臀部）",\n'
+    ) if detail else ""
+    description_field = (
+        ',\n  "bird_description": "该鸟种详细介绍（100-150字），含外形、习性、生境、分布、常见程度"\n'
+    ) if detail else "\n"
+    rules = [
+        "必须精确到具体鸟种，目和科使用正确分类学名称",
+        "如果无法识别，chinese_name 填 \"未知鸟类\"",
+        "score 必须等于6个分项之和",
+        "每个分项必须根据照片实际情况独立评判",
+    ]
+    if detail:
+        rules += [
+            "identification_basis 必须说明为何选择该种而非其他候选种",
+            "excluded_similar_species 必须列出至少1个排除的易混淆种及理由",
+        ]
+    rules += [
+        "candidates 必须包含2-3个候选鸟种，按 similarity 从高到低排列",
+        "similarity 为0-100的整数，表示该候选种与照片中鸟的匹配程度，所有候选种的 similarity 之和不需要等于100",
+        "chinese_name 必须与 candidates 中 similarity 最高的候选种一致",
+    ]
+    if batch:
+        rules.append("results 必须按图片编号顺序为每张图片各返回一个对象，image_index 为图片编号")
+        header = (
+            '只返回一个 JSON 对象 {"results": [...]}，不要返回其他内容。'
+            "results 中每张图片一个对象，格式如下：\n"
+            "{\n"
+            '  "image_index": 1,\n'
+        )
+    else:
+        header = "只返回一个 JSON 对象，不要返回其他内容。\n{\n"
+    return (
+        f"{header}"
+        '  "chinese_name": "最终确定的中文种名（相似度最高的）",\n'
+        '  "english_name": "英文种名",\n'
+        '  "confidence": "high/medium/low",\n'
+        '  "candidates": [\n'
+        '    {"chinese_name": "第1候选种中文名", "english_name": "英文名", "similarity": 85, "reason": "支持该种的关键特征（15字以内）"},\n'
+        '    {"chinese_name": "第2候选种中文名", "english_name": "英文名", "similarity": 60, "reason": "支持该种的关键特征（15字以内）"},\n'
+        '    {"chinese_name": "第3候选种中文名", "english_name": "英文名", "similarity": 30, "reason": "支持该种的关键特征（15字以内）"}\n'
+        '  ],\n'
+        '  "bird_bbox": [x1, y1, x2, y2],\n'
+        f"{detail_fields}"
+        '  "score": 0,\n'
+        '  "score_sharpness": 0,\n'
+        '  "score_composition": 0,\n'
+        '  "score_lighting": 0,\n'
+        '  "score_background": 0,\n'
+        '  "score_pose": 0,\n'
+        '  "score_artistry": 0,\n'
+        '  "score_comment": "照片点评（30字以内）",\n'
+        '  "order_chinese": "目中文名",\n'
+        '  "order_english": "目英文名",\n'
+        '  "family_chinese": "科中文名",\n'
+        '  "family_english": "科英文名"'
+        f"{description_field}"
+        "}\n\n"
+        "要求：\n"
+        + "\n".join(f"{number}. {rule}" for number, rule in enumerate(rules, 1))
+    )
+
+
+# AI 调用统计（进程级）：按档位累计调用次数、token 数和耗时，用于对比各档位的开销
+@st.cache_resource(show_spinner=False)
+def get_ai_call_stats() -> dict:
+    return {"lock": threading.Lock(), "tiers": {}}
+
+
+def record_ai_call(tier: str, latency: float, usage=None, images: int = 1, failed: bool = False,
+                   payload_bytes: int = 0, results: list = ()) -> None:
+    """记录一次 AI 调用的耗时和 token 用量（usage 为 OpenAI 兼容的 usage 对象）。
+
+    images 为本次调用处理的照片数（批量识别 > 1）；failed 表示调用失败或输出无法解析；
+    payload_bytes 为本次发送的图片 base64 字节数；results 为解析出的识别结果，
+    累计其置信度和最高候选相似度，与图片大小放在一起对比（调小图片是否降低了识别准确度）。
+    输入 token 中命中服务端上下文缓存的部分取自 usage.prompt_tokens_details.cached_tokens。
+    """
+    prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+    completion_tokens = getattr(usage, "completion_tokens", 0) or 0
+    cached_tokens = getattr(getattr(usage, "prompt_tokens_details", None), "cached_tokens", 0) or 0
+    if usage is not None:
+        print(f"[AI 调用] {tier}：输入 {prompt_tokens} token（缓存命中 {cached_tokens}），"
+              f"输出 {completion_tokens} token，耗时 {latency:.1f}s")
+    stats = get_ai_call_stats()
+    with stats["lock"]:
+        entry = stats["tiers"].setdefault(tier, {
+            "calls": 0, "images": 0, "failures": 0, "cache_hits": 0, "payload_bytes": 0,
+            "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0, "latency_seconds": 0.0,
+            "refined": 0, "improved": 0, "rated": 0, "high_confidence": 0, "similarity_sum": 0,
+        })
+        entry["calls"] += 1
+        entry["images"] += images
+        entry["failures"] += int(failed)
+        entry["cache_hits"] += int(cached_tokens > 0)
+        entry["latency_seconds"] += latency
+        entry["payload_bytes"] += payload_bytes
+        entry["prompt_tokens"] += prompt_tokens
+        entry["cached_tokens"] += cached_tokens
+        entry["completion_tokens"] += completion_tokens
+        for result in results:
+            if isinstance(result, dict) and result.get("chinese_name") not in (None, "", "未知鸟类"):
+                confidence, similarity = _identification_strength(result)
+                entry["rated"] += 1
+                entry["high_confidence"] += int(confidence == _CONFIDENCE_RANK["high"])
+                entry["similarity_sum"] += similarity
+
+
+def record_refinement(tier: str, improved: bool) -> None:
+    """记录一次低置信度二次识别的结果（improved 表示裁剪图的识别置信度更高并被采用）"""
+    stats = get_ai_call_stats()
+    with stats["lock"]:
+        entry = stats["tiers"].get(tier)
+        if entry is not None:
+            entry["refined"] += 1
+            entry["improved"] += int(improved)
+
+
+def ai_call_stats_summary() -> list:
+    """各档位每张照片平均 token 用量与耗时、前缀缓存命中率和调用失败率，供界面对比各档位的开销"""
+    stats = get_ai_call_stats()
+    with stats["lock"]:
+        tiers = copy.deepcopy(stats["tiers"])
+    summary = []
+    for tier, entry in sorted(tiers.items()):
+        calls = entry["calls"] or 1
+        images = entry["images"] or 1
+        summary.append({
+            "档位": tier,
+            "调用次数": entry["calls"],
+            "照片数": entry["images"],
+            "每张输入 token": round(entry["prompt_tokens"] / images),
+            "每张输出 token": round(entry["completion_tokens"] / images),
+            "缓存命中率": f"{entry['cache_hits'] / calls:.0%}",
+            "缓存 token 占比": f"{entry['cached_tokens'] / (entry['prompt_tokens'] or 1):.0%}",
+            "每张图片 KB": round(entry["payload_bytes"] / images / 1024),
+            "高置信度率": f"{entry['high_confidence'] / entry['rated']:.0%}" if entry["rated"] else "-",
+            "平均最高相似度": round(entry["similarity_sum"] / entry["rated"], 1) if entry["rated"] else "-",
+            "每张耗时(秒)": round(entry["latency_seconds"] / images, 2),
+            "失败率": f"{entry['failures'] / calls:.0%}",
+            "二次识别改善率": f"{entry['improved'] / entry['refined']:.0%}" if entry["refined"] else "-",
+        })
+    return summary
+
+
+_IDENTIFY_SYSTEM_PROMPT = (
+    "你是一位专精中国鸟类的顶级鸟类学家和鸟类摄影评审专家。"
+    "你熟悉《中国鸟类野外手册》《中国鸟类分类与分布名录》中记录的所有鸟种，"
+    "精通中国境内1400余种鸟类的辨识要点、分布范围和季节性变化。"
+    "你能根据细微的羽色差异区分中国常见的易混淆种（如柳莺类、鹀类、鸫类、鹟类等）。"
+    "同时你精通鸟类摄影的评判标准，评分非常严格，只有真正出色的照片才能获得高分。"
+)
+
+# 识别 + 位置标注 + 评分的任务说明（单张、批量识别共用）
+_IDENTIFY_TASK_PROMPT = (
+    "## 任务一：鸟种识别（严格按步骤执行）\n"
+    "这张照片拍摄于中国境内。\n\n"
+    "**步骤1 - 逐项特征观察（必须每项都描述）：**\n"
+    "- 体型：大小（与麻雀/鸽子/乌鸦对比）、体型比例\n"
+    "- 喙：形状（锥形/钩形/细长/扁平）、长度、粗细、颜色\n"
+    "- 头部：冠羽有无、眉纹（颜色/粗细）、贯眼纹、眼圈、头顶色\n"
+    "- 上体：背部羽色、翼斑有无及颜色、腰色\n"
+    "- 下体：喉/胸/腹/胁部颜色和斑纹\n"
+    "- 尾羽：长短、形状（方尾/圆尾/叉尾）、颜色\n"
+    "- 腿脚颜色\n"
+    "- 栖息环境\n\n"
+    "**步骤2 - 列出3个候选种并逐一比对：**\n"
+    "对每个候选种说明：哪些特征支持、哪些不符、在该地区该季节是否有分布。\n\n"
+    "**步骤3 - 最终判定：**\n"
+    "从候选种中选出最匹配的，说明决定性的区分依据。\n\n"
+    "## 任务二：鸟的位置标注\n"
+    f"{_BBOX_TASK_PROMPT}"
+    "## 任务三：专业摄影评分\n"
+    f"{_SCORING_TASK_PROMPT}"
+)
+
+
+# 连拍相似帧只评分（不识别鸟种）
+_SCORE_ONLY_SYSTEM_PROMPT = "你是一位鸟类摄影评审专家，评分非常严格，只有真正出色的照片才能获得高分。"
+_SCORE_ONLY_TASK_PROMPT = (
+    "请完成以下任务（无需识别鸟种）：\n\n"
+    "## 任务一：鸟的位置标注\n"
+    f"{_BBOX_TASK_PROMPT}"
+    "## 任务二：专业摄影评分\n"
+    f"{_SCORING_TASK_PROMPT}"
+    "只返回一个 JSON 对象，不要返回其他内容。\n"
+    "{\n"
+    '  "bird_bbox": [x1, y1, x2, y2],\n'
+    '  "score_sharpness": 0,\n'
+    '  "score_composition": 0,\n'
+    '  "score_lighting": 0,\n'
+    '  "score_background": 0,\n'
+    '  "score_pose": 0,\n'
+    '  "score_artistry": 0,\n'
+    '  "score_comment": "照片点评（30字以内）"\n'
+    "}"
+)
+
+# 固定前缀是否加显式缓存标记（DashScope 显式缓存，需模型支持）；默认依赖服务端的隐式前缀缓存
+PROMPT_CACHE_EXPLICIT = os.environ.get("BIRDEYE_PROMPT_CACHE", "") == "explicit"
+
+
+def _render_prompt_templates() -> dict:
+    """预渲染各类调用的固定 prompt 前缀：{名称: (系统提示, 任务说明)}，名称与 AI 调用统计的档位一致"""
+    templates = {}
+    for tier in ("fast", "full"):
+        detail = tier != "fast"
+        templates[f"identify-{tier}"] = (
+            _IDENTIFY_SYSTEM_PROMPT,
+            f"请完成以下任务：\n\n{_IDENTIFY_TASK_PROMPT}{_identify_output_spec(detail)}",
+        )
+        templates[f"batch-{tier}"] = (
+            _IDENTIFY_SYSTEM_PROMPT,
+            "接下来给出若干张照片，每张照片前有图片编号及该照片的拍摄信息。"
+            "每张照片独立完成以下任务，必须结合各自的拍摄地点和季节缩小候选鸟种范围：\n\n"
+            f"{_IDENTIFY_TASK_PROMPT}{_identify_output_spec(detail, batch=True)}",
+        )
+    templates["score-only"] = (_SCORE_ONLY_SYSTEM_PROMPT, _SCORE_ONLY_TASK_PROMPT)
+    templates["detail"] = (
+        "你是一位专精中国鸟类的鸟类学家，熟悉《中国鸟类野外手册》。",
+        "介绍下面给出的鸟种。只返回一个 JSON 对象，不要返回其他内容。\n"
+        "{\n"
+        '  "bird_description": "该鸟种详细介绍（100-150字），含外形、习性、生境、分布、常见程度",\n'
+        '  "identification_basis": "野外识别要点，以及与最易混淆种的区分特征（30字以内）"\n'
+        "}",
+    )
+    return templates
+
+
+PROMPT_TEMPLATES = _render_prompt_templates()
+
+
+def _prompt_messages(template: str, variable_content: list) -> list:
+    """组装消息：固定前缀（系统提示 + 任务说明）在前，图片和拍摄信息等可变内容在后，
+    相同前缀的请求可以命中服务端的上下文缓存"""
+    system_prompt, task_prompt = PROMPT_TEMPLATES[template]
+    task_block = {"type": "text", "text": task_prompt}
+    if PROMPT_CACHE_EXPLICIT:
+        task_block["cache_control"] = {"type": "ephemeral"}
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": [task_block] + variable_content},
+    ]
+
+
+def _image_content(image_base64: str) -> dict:
+    """图片消息块；传入的已是 data URL（ImageContext.ai_data_url）时直接使用，不再拼接复制"""
+    url = image_base64 if image_base64.startswith("data:") else DATA_URL_PREFIX + image_base64
+    return {"type": "image_url", "image_url": {"url": url}}
+
+
+def _identify_fail_result(comment: str) -> dict:
+    """识别失败时返回的占位结果"""
+    return {
+        "chinese_name": "未知鸟类", "english_name": "unknown",
+        "order_chinese": "未知目", "order_english": "Unknown",
+        "family_chinese": "未知科", "family_english": "Unknown",
+        "confidence": "low", "score": 0,
+        "score_sharpness": 0, "score_composition": 0,
+        "score_lighting": 0, "score_background": 0,
+        "score_pose": 0, "score_artistry": 0,
+        "score_comment": comment,
+        "identification_basis": "",
+        "bird_description": "",
+    }
+
+
+def _species_knowledge_for(name: str) -> dict:
+    """按规范种名查鸟种知识缓存"""
+    entry = lookup_species(name)
+    return species_knowledge_get(entry["chinese_name"] if entry else name) or {}
+
+
+async def _finalize_identify_result(parsed: dict, knowledge: dict, species_keys: tuple,
+                                    cache_key: str, learn: bool = True) -> dict:
+    """用鸟种知识补齐字段、按离线分类索引规范化、校正评分并写入识别缓存。
+
+    learn=False（输出被提前截断）时不把本次结果写回鸟种知识。
+    """
+    if knowledge:
+        for key in species_keys:
+            parsed[key] = knowledge[key] if knowledge.get(key) else parsed.get(key, "")
+        for key in ("english_name", "bird_description", "identification_basis"):
+            if not parsed.get(key) and knowledge.get(key):
+                parsed[key] = knowledge[key]
+    # 种名和目/科最终以离线分类索引为准
+    canonicalize_species_result(parsed)
+    if learn:
+        await asyncio.to_thread(
+            species_knowledge_put, str(parsed.get("chinese_name", "")), _species_fields_from_result(parsed),
+        )
+
+    _normalize_scores(parsed)
+    await asyncio.to_thread(identify_cache_put, cache_key, parsed)
     return parsed
 
 
+def identify_bird(image_base64: str, api_key: str, exif_info: dict) -> dict:
+    """identify_bird_async 的同步入口（在后台事件循环中执行，不可在事件循环线程内调用）"""
+    return run_in_ai_loop(identify_bird_async(image_base64, api_key, exif_info))
+
+
+async def identify_bird_async(image_base64: str, api_key: str, exif_info: dict, on_field=None,
+                              tier: str = None, stats_tier: str = None) -> dict:
+    """单阶段鸟类识别 + 摄影评分（使用 qwen-vl-max-latest）
+
+    通过强化版思维链 prompt 引导 AI 先逐项观察特征、列候选、排除，再做最终判断。
+    单次调用完成，兼顾速度和准确率。结果以流式返回，每个顶层字段生成完毕就回调
+    on_field(key, value)，鸟种名、候选种、位置排在介绍和评分之前，可以提前展示。
+    tier 为 "fast" 时不生成介绍和识别依据，由 fetch_species_detail 按需获取。
+    stats_tier 为 AI 调用统计中的档位名（默认 identify-{tier}）。
+    image_base64 可以是裸 base64，也可以是 ImageContext.ai_data_url 返回的 data URL。
+    """
+    client = get_async_ai_client(api_key)
+    tier = tier or IDENTIFY_TIER
+    detail = tier != "fast"
+    stats_tier = stats_tier or f"identify-{tier}"
+    payload_bytes = len(image_base64)
+
+    context_block, season = _build_context_block(exif_info)
+
+    # 同一张照片（同一地点/季节上下文、同一档位）识别过就直接复用，跨会话、跨用户共享
+    cache_key = identify_cache_key(image_base64, f"{tier}\n{context_block}")
+    cached_result = await asyncio.to_thread(identify_cache_get, cache_key)
+    if cached_result:
+        return cached_result
+
+    # 鸟种名一生成就查鸟种知识缓存；目/科（及介绍）已知时，评分字段结束后即停止生成，
+    # 剩余字段用缓存补齐，既减少输出 token，也让同一鸟种在不同照片上的结果一致
+    # 查询在线程池中进行（SQLite 是同步 IO），不阻塞共享事件循环中其他会话的流式输出
+    knowledge_lookup = {}
+    species_keys = SPECIES_TAXONOMY_KEYS + (("bird_description",) if detail else ())
+
+    def _on_field(key, value):
+        if key == "chinese_name" and isinstance(value, str) and value:
+            knowledge_lookup["task"] = asyncio.ensure_future(asyncio.to_thread(_species_knowledge_for, value))
+        elif key == "score_comment":
+            task = knowledge_lookup.get("task")
+            # 查询尚未完成就不提前停止，照常生成剩余字段
+            if task and task.done() and not task.exception() and all(
+                    task.result().get(k) for k in species_keys):
+                json_stream.stop_requested = True
+        if on_field:
+            on_field(key, value)
+
+    json_stream = IncrementalJSONParser(_on_field)
+    started = time.monotonic()
+    try:
+        result_text = await resilient_chat_completion(
+            client,
+            json_stream=json_stream,
+            model=IDENTIFY_MODEL,
+            temperature=0.1,
+            messages=_prompt_messages(f"identify-{tier}", [_image_content(image_base64)] + (
+                [{"type": "text", "text": context_block.strip()}] if context_block else []
+            )),
+        )
+    except Exception as api_error:
+        import traceback
+        traceback.print_exc()
+        record_ai_call(stats_tier, time.monotonic() - started, failed=True, payload_bytes=payload_bytes)
+        return _identify_fail_result(f"AI 接口调用失败: {type(api_error).__name__}: {str(api_error)[:100]}")
+
+    if not result_text.strip():
+        record_ai_call(stats_tier, time.monotonic() - started, json_stream.usage, failed=True,
+                       payload_bytes=payload_bytes)
+        return _identify_fail_result("AI 返回数据异常: 内容为空")
+
+    if json_stream.stop_requested:
+        parsed = dict(json_stream.fields)
+    else:
+        parsed = json_stream.result() or _extract_json_from_text(result_text)
+    record_ai_call(stats_tier, time.monotonic() - started, json_stream.usage, failed=not parsed,
+                   payload_bytes=payload_bytes, results=[parsed] if parsed else ())
+    if not parsed:
+        return _identify_fail_result("AI 返回内容中未找到有效 JSON")
+
+    knowledge = {}
+    if "task" in knowledge_lookup:
+        try:
+            knowledge = await knowledge_lookup["task"]
+        except Exception as exc:
+            print(f"[鸟种知识] 查询失败: {exc}")
+    return await _finalize_identify_result(
+        parsed, knowledge, species_keys, cache_key, learn=not json_stream.stop_requested,
+    )
+
+
+# 批量识别：一次请求携带多张照片，系统 prompt 和任务说明只发送一次。
+# 批大小 ≤ 1 时关闭（默认），每张照片单独流式识别
+IDENTIFY_BATCH_SIZE = int(os.environ.get("BIRDEYE_IDENTIFY_BATCH", "1"))
+# 攒批等待时间（秒）：第一张照片提交后最多等这么久，凑不满一批也发出
+IDENTIFY_BATCH_LINGER = 1.0
+
+
+async def identify_birds_batch_async(items: list, api_key: str, tier: str = None) -> list:
+    """批量识别多张照片。items: [(image_base64, exif_info), ...]，返回与 items 对应的结果列表。
+
+    已缓存的照片直接复用；其余照片合并为一次请求，模型返回按图片编号排列的结果数组。
+    整批解析失败或某张照片缺少结果时，这些照片退回单张识别。
+    """
+    tier = tier or IDENTIFY_TIER
+    detail = tier != "fast"
+    species_keys = SPECIES_TAXONOMY_KEYS + (("bird_description",) if detail else ())
+
+    results = [None] * len(items)
+    pending = []  # [(下标, cache_key, 拍摄信息)]
+    for index, (image_base64, exif_info) in enumerate(items):
+        context_block, _ = _build_context_block(exif_info)
+        cache_key = identify_cache_key(image_base64, f"{tier}\n{context_block}")
+        results[index] = await asyncio.to_thread(identify_cache_get, cache_key)
+        if not results[index]:
+            pending.append((index, cache_key, _context_facts(exif_info)[0]))
+
+    if len(pending) > 1:
+        content = []
+        for number, (index, _, facts) in enumerate(pending, 1):
+            content.append({"type": "text", "text": f"图片{number}：" + (f"\n{facts}" if facts else "")})
+            content.append(_image_content(items[index][0]))
+        content.append({
+            "type": "text",
+            "text": f"以上共 {len(pending)} 张照片。"
+                    + (_CONTEXT_RULES if any(facts for _, _, facts in pending) else ""),
+        })
+        started = time.monotonic()
+        parsed_items = {}
+        usage = None
+        try:
+            response = await resilient_chat_completion(
+                get_async_ai_client(api_key),
+                model=IDENTIFY_MODEL,
+                temperature=0.1,
+                messages=_prompt_messages(f"batch-{tier}", content),
+            )
+            usage = response.usage
+            parsed = _extract_json_from_text(response.choices[0].message.content or "") or {}
+            for item in parsed.get("results") or []:
+                if not isinstance(item, dict) or not isinstance(item.get("chinese_name"), str):
+                    continue
+                try:
+                    number = int(item.pop("image_index", 0))
+                except (TypeError, ValueError):
+                    continue
+                if 1 <= number <= len(pending):
+                    parsed_items[number - 1] = item
+        except Exception as api_error:
+            print(f"[批量识别] {len(pending)} 张照片请求失败: {type(api_error).__name__}: {api_error}")
+        record_ai_call(f"batch-{tier}", time.monotonic() - started, usage,
+                       images=len(pending), failed=len(parsed_items) < len(pending),
+                       payload_bytes=sum(len(items[index][0]) for index, _, _ in pending),
+                       results=list(parsed_items.values()))
+        if len(parsed_items) < len(pending):
+            print(f"[批量识别] {len(pending) - len(parsed_items)}/{len(pending)} 张照片缺少结果，退回单张识别")
+
+        for position, (index, cache_key, _) in enumerate(pending):
+            parsed = parsed_items.get(position)
+            if parsed:
+                knowledge = await asyncio.to_thread(_species_knowledge_for, parsed["chinese_name"])
+                results[index] = await _finalize_identify_result(parsed, knowledge, species_keys, cache_key)
+
+    missing = [index for index, result in enumerate(results) if not result]
+    fallback = await asyncio.gather(*(
+        identify_bird_async(items[index][0], api_key, items[index][1], tier=tier) for index in missing
+    ))
+    for index, result in zip(missing, fallback):
+        results[index] = result
+    return results
+
+
+class IdentifyBatcher:
+    """流水线中的攒批器：把短时间内陆续提交的识别请求合并成批量识别。
+
+    凑满 batch_size 张，或第一张等待超过 IDENTIFY_BATCH_LINGER 秒，就发出一批。
+    只能在事件循环内使用。
+    """
+
+    def __init__(self, api_key: str, batch_size: int = IDENTIFY_BATCH_SIZE, tier: str = None):
+        self.api_key = api_key
+        self.batch_size = batch_size
+        self.tier = tier
+        self.pending = []  # [(image_base64, exif_info, future)]
+        self.flush_handle = None
+        self.tasks = set()
+
+    async def identify(self, image_base64: str, exif_info: dict) -> dict:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((image_base64, exif_info, future))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+        elif self.flush_handle is None:
+            self.flush_handle = loop.call_later(IDENTIFY_BATCH_LINGER, self.flush)
+        return await future
+
+    def flush(self) -> None:
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        batch, self.pending = self.pending, []
+        if batch:
+            task = asyncio.get_running_loop().create_task(self._run(batch))
+            # 保留任务引用，避免被垃圾回收
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def _run(self, batch: list) -> None:
+        try:
+            results = await identify_birds_batch_async(
+                [(image_base64, exif_info) for image_base64, exif_info, _ in batch], self.api_key, self.tier,
+            )
+        except Exception as exc:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(exc)
+            return
+        for (_, _, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+
+# 连拍识别：dHash 汉明距离不超过该值视为同一连拍序列中的相似帧（64 位中约 10%）
+BURST_HAMMING_THRESHOLD = 6
+# 同一连拍序列中相邻两帧的拍摄时间间隔上限（秒）；画面相似但隔得更久的照片可能已经换了一只鸟
+BURST_MAX_INTERVAL = 3.0
+# 相似帧沿用代表帧的鸟种识别结果，只替换为自己的评分和位置
+_BURST_OWN_KEYS = ("bird_bbox", "score_comment") + tuple(key for key, _ in _SCORE_DIMENSIONS) + ("score",)
+
+
+def cluster_burst_frames(hashes: list, shoot_times: list, cameras: list) -> list:
+    """按感知哈希、拍摄时间和相机型号把连拍相似帧聚类。
+
+    三个列表与照片一一对应：hashes 为 dHash，shoot_times 为 EXIF 拍摄时间（秒），cameras 为相机型号。
+    只有画面相似（汉明距离 ≤ BURST_HAMMING_THRESHOLD）、同一台相机、且拍摄时间与序列中已有帧
+    相差不超过 BURST_MAX_INTERVAL 的帧才并入序列。相似帧会沿用代表帧的鸟种，
+    因此缺少哈希、拍摄时间或相机型号的帧一律单独成组，宁可多识别一次也不错配。
+    返回与 hashes 等长的列表，每项为该帧所属序列代表帧（首帧）的下标。
+    """
+    leaders = []
+    spans = {}  # 代表帧下标 → [序列最早拍摄时间, 最晚拍摄时间]
+    assignment = []
+    for index, frame_hash in enumerate(hashes):
+        leader_index = index
+        shoot_time, camera = shoot_times[index], cameras[index]
+        if frame_hash is not None and shoot_time is not None and camera:
+            for candidate in leaders:
+                earliest, latest = spans[candidate]
+                if (cameras[candidate] == camera
+                        and earliest - BURST_MAX_INTERVAL <= shoot_time <= latest + BURST_MAX_INTERVAL
+                        and bin(frame_hash ^ hashes[candidate]).count("1") <= BURST_HAMMING_THRESHOLD):
+                    leader_index = candidate
+                    spans[candidate] = [min(earliest, shoot_time), max(latest, shoot_time)]
+                    break
+            if leader_index == index:
+                leaders.append(index)
+                spans[index] = [shoot_time, shoot_time]
+        assignment.append(leader_index)
+    return assignment
+
+
+def score_bird_photo(image_base64: str, api_key: str) -> dict | None:
+    """score_bird_photo_async 的同步入口（不可在事件循环线程内调用）"""
+    return run_in_ai_loop(score_bird_photo_async(image_base64, api_key))
+
+
+async def score_bird_photo_async(image_base64: str, api_key: str) -> dict | None:
+    """只做摄影评分 + 鸟的位置标注（连拍相似帧使用，不重复识别鸟种）。失败返回 None。"""
+    cache_key = identify_cache_key(image_base64, "__score_only__")
+    cached_result = await asyncio.to_thread(identify_cache_get, cache_key)
+    if cached_result:
+        return cached_result
+
+    client = get_async_ai_client(api_key)
+    started = time.monotonic()
+    try:
+        response = await resilient_chat_completion(
+            client,
+            model=IDENTIFY_MODEL,
+            temperature=0.1,
+            messages=_prompt_messages("score-only", [_image_content(image_base64)]),
+        )
+        record_ai_call("score-only", time.monotonic() - started, response.usage,
+                       payload_bytes=len(image_base64))
+        parsed = _extract_json_from_text(response.choices[0].message.content.strip())
+    except Exception as exc:
+        print(f"[连拍评分] 调用失败: {type(exc).__name__}: {exc}")
+        return None
+    if not parsed:
+        return None
+    _normalize_scores(parsed)
+    await asyncio.to_thread(identify_cache_put, cache_key, parsed)
+    return parsed
+
+
+# 低置信度二次识别：置信度为 low 或最高相似度低于该值时，再发送鸟所在区域的高清裁剪图识别一次
+REFINE_SIMILARITY_THRESHOLD = 50
+# 二次识别结果只替换与鸟种相关的字段，评分和位置仍以整张照片为准
+_REFINE_SPECIES_KEYS = (
+    "chinese_name", "english_name", "scientific_name", "confidence", "candidates",
+    "identification_basis", "excluded_similar_species", "bird_description", "taxonomy_verified",
+) + SPECIES_TAXONOMY_KEYS
+_CONFIDENCE_RANK = {"low": 0, "medium": 1, "high": 2}
+
+
+def _identification_strength(result: dict) -> tuple:
+    """(置信度等级, 最高候选相似度)，用于比较两次识别结果"""
+    similarities = [
+        c.get("similarity", 0) or 0 for c in result.get("candidates") or [] if isinstance(c, dict)
+    ]
+    return _CONFIDENCE_RANK.get(result.get("confidence"), 0), max(similarities, default=0)
+
+
+def needs_refinement(result: dict) -> bool:
+    """首轮识别是否需要用裁剪图复核（识别失败或没有位置框时不复核）"""
+    if result.get("chinese_name") == "未知鸟类" or not result.get("bird_bbox"):
+        return False
+    confidence, similarity = _identification_strength(result)
+    return confidence == 0 or similarity < REFINE_SIMILARITY_THRESHOLD
+
+
+async def refine_with_bird_crop_async(result: dict, image_ctx: ImageContext, api_key: str,
+                                      exif_info: dict) -> dict:
+    """低置信度二次识别：按首轮的 bird_bbox 裁剪出鸟的高清局部图再识别，
+    置信度更高时采用其鸟种相关字段（标记 refined="crop"），否则保留首轮结果"""
+    bbox = result.get("bird_bbox")
+    crop_base64 = await asyncio.get_running_loop().run_in_executor(
+        get_image_executor(), image_ctx.bird_crop_data_url, bbox, image_ctx.ai_payload_size(bbox),
+    )
+    if not crop_base64:
+        return result
+    tier = IDENTIFY_TIER
+    refined = await identify_bird_async(crop_base64, api_key, exif_info, tier=tier, stats_tier=f"crop-{tier}")
+    improved = (refined.get("chinese_name") != "未知鸟类"
+                and _identification_strength(refined) > _identification_strength(result))
+    record_refinement(f"crop-{tier}", improved)
+    print(f"[二次识别] {result.get('chinese_name')} → {refined.get('chinese_name')}，"
+          f"{'采用' if improved else '保留首轮结果'}")
+    if not improved:
+        return result
+    merged = dict(result)
+    for key in _REFINE_SPECIES_KEYS:
+        if key in refined:
+            merged[key] = copy.deepcopy(refined[key])
+    merged["refined"] = "crop"
+    return merged
+
+
+def merge_burst_result(leader_result: dict, frame_scores: dict) -> dict:
+    """相似帧结果 = 代表帧的鸟种识别 + 本帧自己的评分和位置"""
+    merged = copy.deepcopy({k: v for k, v in leader_result.items() if not k.startswith("_")})
+    for key in _BURST_OWN_KEYS:
+        merged.pop(key, None)
+        if key in frame_scores:
+            merged[key] = frame_scores[key]
+    return merged
+
+
+@st.cache_data(ttl=86400, show_spinner=False, max_entries=2000)
+def fetch_species_detail(chinese_name: str, english_name: str, api_key: str) -> dict:
+    """按需获取鸟种介绍和识别要点（fast 档位识别结果在卡片展开时调用）。
+
+    优先读取本地鸟种知识缓存，同一鸟种只请求一次。失败时抛出异常（不缓存）。
+    """
+    known = species_knowledge_get(chinese_name) or {}
+    if known.get("bird_description"):
+        return {
+            "bird_description": known["bird_description"],
+            "identification_basis": known.get("identification_basis", ""),
+        }
+    detail = run_in_ai_loop(fetch_species_detail_async(chinese_name, english_name, api_key))
+    if not detail:
+        # st.cache_data 会缓存返回值，失败时抛出异常避免把空结果缓存下来
+        raise RuntimeError(f"获取鸟种介绍失败: {chinese_name}")
+    species_knowledge_put(chinese_name, detail)
+    return detail
+
+
+async def fetch_species_detail_async(chinese_name: str, english_name: str, api_key: str) -> dict:
+    """纯文本调用：返回 {"bird_description", "identification_basis"}，失败返回空 dict"""
+    client = get_async_ai_client(api_key)
+    started = time.monotonic()
+    try:
+        response = await resilient_chat_completion(
+            client,
+            model=SPECIES_DETAIL_MODEL,
+            temperature=0.3,
+            messages=_prompt_messages("detail", [
+                {"type": "text", "text": f"鸟种：{chinese_name}（{english_name}）"},
+            ]),
+        )
+        record_ai_call("detail", time.monotonic() - started, response.usage)
+        parsed = _extract_json_from_text(response.choices[0].message.content.strip())
+    except Exception as exc:
+        print(f"[鸟种介绍] 调用失败: {type(exc).__name__}: {exc}")
+        return {}
+    if not parsed:
+        return {}
+    return {
+        "bird_description": str(parsed.get("bird_description", "")),
+        "identification_basis": str(parsed.get("identification_basis", "")),
+    }
+
+
 def draw_bird_bbox(img: "Image.Image", bbox: list, color=(102, 126, 234), thickness: int = 3, opacity: float = 0.15) -> "Image.Image":
     """在原图上绘制半透明高亮框标注 AI 识别的鸟的位置。
 
@@ -1543,10 +3922,7 @@ def get_seasonal_bird_recommendations(api_key: str, city: str, month: int) -> li
     month_name = month_names[month] if 1 <= month <= 12 else ""
 
     try:
-        client = OpenAI(
-            api_key=api_key,
-            base_url="https://dashscope.aliyuncs.com/compatible-mode/v1",
-        )
+        client = get_ai_client(api_key)
         response = client.chat.completions.create(
             model="qwen-plus",
             temperature=0.7,
@@ -1579,12 +3955,9 @@ def get_seasonal_bird_recommendations(api_key: str, city: str, month: int) -> li
                 },
             ],
         )
-        result_text = response.choices[0].message.content.strip()
-        json_match = re.search(r'\[.*\]', result_text, re.DOTALL)
-        if json_match:
-            parsed = json.loads(json_match.group())
-            if isinstance(parsed, list) and len(parsed) > 0:
-                return parsed[:6]
+        parsed = _extract_json_from_text(response.choices[0].message.content or "", expect=list)
+        if parsed:
+            return parsed[:6]
     except Exception as exc:
         print(f"[季节推荐] 生成失败: {exc}")
     return []
@@ -2002,29 +4375,33 @@ def fetch_ebird_popular_nearby(latitude: float, longitude: float,
 
 @st.cache_data(ttl=7200, show_spinner=False)
 def translate_ebird_species(species_list: list, ebird_api_key: str,
-                            _cache_version: int = 3) -> dict:
+                            _cache_version: int = 4) -> dict:
     """通过 eBird taxonomy API 获取鸟种的官方简体中文名。缓存 2 小时。
 
+    先查离线分类索引（按学名、英文名），索引未收录的鸟种才请求 eBird，
     使用 locale=zh_SIM 参数直接从 eBird 获取简体中文名，比 AI 翻译更准确可靠。
     返回 {english_name: chinese_name} 映射。
     _cache_version: 缓存版本号，修改此值可强制刷新旧缓存。
     """
-    if not species_list or not ebird_api_key:
+    if not species_list:
         return {}
 
-    # 收集所有 species_code
+    # 收集索引未收录鸟种的 species_code
+    translations = {}
     code_to_english = {}
     for species in species_list:
         code = species.get("species_code", "")
         english_name = species.get("common_name", "")
-        if code and english_name:
+        entry = lookup_species(species.get("scientific_name", "")) or lookup_species(english_name)
+        if entry and english_name:
+            translations[english_name] = entry["chinese_name"]
+        elif code and english_name:
             code_to_english[code] = english_name
-    if not code_to_english:
-        return {}
+    if not code_to_english or not ebird_api_key:
+        return translations
 
     # eBird taxonomy API 支持逗号分隔的多个 species code
     species_codes = ",".join(code_to_english.keys())
-    translations = {}
     try:
         url = (
             f"https://api.ebird.org/v2/ref/taxonomy/ebird?"
@@ -2329,7 +4706,16 @@ def import_species_to_db(user_nickname: str, species_list: list,
     if not new_species:
         return 0, len(species_list), ""
 
-    # 对于只有英文名没有中文名的鸟种，批量翻译
+    # 只有英文名没有中文名的鸟种，先查离线分类索引（按学名、英文名）
+    for species in new_species:
+        if not species.get("chinese_name"):
+            entry = lookup_species(species.get("scientific_name", "")) or lookup_species(
+                species.get("common_name", "")
+            )
+            if entry:
+                species["chinese_name"] = entry["chinese_name"]
+
+    # 索引未收录的再用 AI 批量翻译
     need_translate = [s for s in new_species if not s.get("chinese_name") and s.get("common_name")]
     if need_translate and api_key:
         name_pairs = []
@@ -2341,10 +4727,7 @@ def import_species_to_db(user_nickname: str, species_list: list,
             for common, scientific in name_pairs[:30]
         )
         try:
-            client = OpenAI(
-                api_key=api_key,
-                base_url="https://dashscope.aliyuncs.com/compatible-mode/v1",
-            )
+            client = get_ai_client(api_key)
             response = client.chat.completions.create(
                 model="qwen-plus",
                 temperature=0.1,
@@ -2367,10 +4750,8 @@ def import_species_to_db(user_nickname: str, species_list: list,
                     },
                 ],
             )
-            result_text = response.choices[0].message.content.strip()
-            json_match = re.search(r'\{.*\}', result_text, re.DOTALL)
-            if json_match:
-                translations = json.loads(json_match.group())
+            translations = _extract_json_from_text(response.choices[0].message.content or "")
+            if translations:
                 for species in need_translate:
                     translated = translations.get(species["common_name"], "")
                     if translated:
@@ -2391,35 +4772,25 @@ def import_species_to_db(user_nickname: str, species_list: list,
             "score": 0,
             "identification_basis": f"从外部平台导入 | {species.get('scientific_name', '')}",
         }
-        url = f"{base_url}/rest/v1/bird_records"
-        headers = {
-            "apikey": db_key,
-            "Authorization": f"Bearer {db_key}",
-            "Content-Type": "application/json",
-            "Prefer": "return=minimal",
-        }
-        data = json.dumps(record).encode("utf-8")
-        req = urllib.request.Request(url, data=data, headers=headers, method="POST")
         try:
-            with urllib.request.urlopen(req, timeout=10) as resp:
-                if resp.status in (200, 201):
-                    imported_count += 1
+            resp = supabase_http("POST", "bird_records", body=record, prefer="return=minimal",
+                                 timeout=10, override_url=base_url, override_key=db_key)
+            if resp.status_code in (200, 201):
+                imported_count += 1
+            else:
+                print(f"[导入] 写入 {chinese_name} 失败: HTTP {resp.status_code} {resp.text[:200]}")
         except Exception as exc:
             print(f"[导入] 写入 {chinese_name} 失败: {exc}")
 
     skipped_count = len(species_list) - imported_count
     return imported_count, skipped_count, ""
 
-def crop_to_bird(img: "Image.Image", bbox: list, padding_ratio: float = 0.15) -> "Image.Image":
-    """根据 AI 返回的百分比 bounding box 裁剪图片，聚焦到鸟的区域。
-
-    bbox 格式: [x1, y1, x2, y2]，值为 0-100 的百分比。
-    padding_ratio: 在 bbox 外围额外保留的比例（避免裁太紧）。
-    """
+def bird_crop_box(size: tuple, bbox: list, padding_ratio: float = 0.15) -> "tuple | None":
+    """crop_to_bird 的裁剪区域（像素坐标）；bbox 无效或鸟已占满画面（无需裁剪）时返回 None"""
     if not bbox or len(bbox) != 4:
-        return img
+        return None
 
-    width, height = img.size
+    width, height = size
     x1_pct, y1_pct, x2_pct, y2_pct = bbox
 
     # 百分比转像素
@@ -2430,7 +4801,7 @@ def crop_to_bird(img: "Image.Image", bbox: list, padding_ratio: float = 0.15) ->
 
     # 确保坐标有效
     if x2 <= x1 or y2 <= y1:
-        return img
+        return None
 
     # 添加 padding（让鸟不要贴边）
     box_width = x2 - x1
@@ -2447,13 +4818,23 @@ def crop_to_bird(img: "Image.Image", bbox: list, padding_ratio: float = 0.15) ->
     crop_area = (crop_x2 - crop_x1) * (crop_y2 - crop_y1)
     total_area = width * height
     if crop_area > total_area * 0.85:
-        return img
+        return None
 
-    return img.crop((crop_x1, crop_y1, crop_x2, crop_y2))
+    return crop_x1, crop_y1, crop_x2, crop_y2
+
+
+def crop_to_bird(img: "Image.Image", bbox: list, padding_ratio: float = 0.15) -> "Image.Image":
+    """根据 AI 返回的百分比 bounding box 裁剪图片，聚焦到鸟的区域。
+
+    bbox 格式: [x1, y1, x2, y2]，值为 0-100 的百分比。
+    padding_ratio: 在 bbox 外围额外保留的比例（避免裁太紧）。
+    """
+    box = bird_crop_box(img.size, bbox, padding_ratio)
+    return img.crop(box) if box else img
 
 
 # ============================================================
-# 数据库相关函数（通过 Supabase REST API，无需额外依赖）
+# 数据库相关函数（通过 Supabase REST API，所有请求共用一个连接池）
 # ============================================================
 # 模块级缓存，确保子线程可以安全读取（必须在函数定义之前初始化）
 _SUPABASE_URL_CACHE = None
@@ -2473,101 +4854,377 @@ def _supabase_config():
     except (KeyError, FileNotFoundError):
         return None, None
 
-def _supabase_request(method: str, endpoint: str, body: dict = None,
-                      params: str = "", override_url: str = None,
-                      override_key: str = None):
-    """通用 Supabase REST API 请求（线程安全，不调用 Streamlit API）。
-    可通过 override_url/override_key 直接传入配置，用于子线程调用。
+SUPABASE_HTTP_MAX_CONNECTIONS = 10
+SUPABASE_HTTP_KEEPALIVE_EXPIRY = 30.0
+SUPABASE_HTTP_TIMEOUT = 30.0
+SUPABASE_MAX_RETRIES = 2           # 幂等请求遇到网关错误 / 网络中断时的重试次数
+SUPABASE_RETRY_BACKOFF = 0.3       # 重试退避基数（秒），第 n 次重试等待 base * 2^n
+_SUPABASE_RETRY_STATUS = {502, 503, 504}
+_SUPABASE_IDEMPOTENT_METHODS = {"GET", "HEAD", "PATCH", "DELETE"}
+
+
+@st.cache_resource(show_spinner=False)
+def get_supabase_http_client(base_url: str, api_key: str) -> httpx.Client:
+    """按 (url, key) 返回进程级共享的 Supabase REST 客户端。
+
+    连接池有上限并保持长连接（安装 h2 时启用 HTTP/2），gzip 响应由 httpx 自动协商和解压；
+    建连失败由传输层重试。httpx.Client 是线程安全的，识别流水线的子线程可直接共用。
+    """
+    transport = httpx.HTTPTransport(
+        http2=HAS_HTTP2,
+        retries=SUPABASE_MAX_RETRIES,
+        limits=httpx.Limits(
+            max_connections=SUPABASE_HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=SUPABASE_HTTP_MAX_CONNECTIONS,
+            keepalive_expiry=SUPABASE_HTTP_KEEPALIVE_EXPIRY,
+        ),
+    )
+    return httpx.Client(
+        base_url=f"{base_url.rstrip('/')}/rest/v1/",
+        headers={
+            "apikey": api_key,
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json",
+        },
+        timeout=httpx.Timeout(SUPABASE_HTTP_TIMEOUT, connect=10.0),
+        transport=transport,
+    )
+
+
+def supabase_http(method: str, endpoint: str, params: str = "", body=None,
+                  prefer: str = "return=representation", timeout: float = None,
+                  override_url: str = None, override_key: str = None):
+    """通过共享连接池发送一次 Supabase REST 请求，返回 httpx.Response（不检查状态码）。
+
+    配置缺失时返回 None。GET / PATCH / DELETE 等幂等请求遇到 502/503/504 或网络中断时按退避重试，
+    POST 只在连接尚未建立时由传输层重试，避免重复插入；重试用尽后抛出 httpx 异常。
+    """
+    if override_url and override_key:
+        base_url, api_key = override_url, override_key
+    else:
+        base_url, api_key = _supabase_config()
+    if not base_url or not api_key:
+        print(f"[Supabase] 配置缺失，跳过 {method} {endpoint}")
+        return None
+
+    client = get_supabase_http_client(base_url, api_key)
+    url = f"{endpoint}?{params}" if params else endpoint
+    content = json.dumps(body).encode("utf-8") if body else None
+    retries = SUPABASE_MAX_RETRIES if method in _SUPABASE_IDEMPOTENT_METHODS else 0
+    for attempt in range(retries + 1):
+        try:
+            resp = client.request(
+                method, url, content=content, headers={"Prefer": prefer},
+                timeout=timeout if timeout is not None else httpx.USE_CLIENT_DEFAULT,
+            )
+        except httpx.TransportError:
+            if attempt >= retries:
+                raise
+        else:
+            if resp.status_code not in _SUPABASE_RETRY_STATUS or attempt >= retries:
+                return resp
+        time.sleep(SUPABASE_RETRY_BACKOFF * (2 ** attempt))
+
+
+def _supabase_request(method: str, endpoint: str, body: dict = None,
+                      params: str = "", override_url: str = None,
+                      override_key: str = None):
+    """通用 Supabase REST API 请求（线程安全，不调用 Streamlit API），返回解析后的 JSON。
+    可通过 override_url/override_key 直接传入配置，用于子线程调用。
+    """
+    try:
+        resp = supabase_http(method, endpoint, params=params, body=body,
+                             override_url=override_url, override_key=override_key)
+    except Exception as exc:
+        print(f"[Supabase] {method} {endpoint} 异常: {type(exc).__name__}: {exc}")
+        return None
+    if resp is None:
+        return None
+    if resp.status_code >= 400:
+        print(f"[Supabase] {method} {endpoint} 失败: {resp.status_code} {resp.text[:200]}")
+        return None
+
+    response_body = resp.text
+    print(f"[Supabase] {method} {endpoint} 状态码: {resp.status_code} 响应长度: {len(response_body)}")
+    try:
+        # POST 插入成功时返回 201，即使响应体为空也视为成功
+        if method == "POST" and resp.status_code in (200, 201):
+            if response_body:
+                return json.loads(response_body)
+            return {"_inserted": True}
+        if response_body:
+            return json.loads(response_body)
+        return None
+    except ValueError as exc:
+        print(f"[Supabase] {method} {endpoint} 响应解析失败: {exc}")
+        return None
+
+def get_supabase_client():
+    """检查 Supabase 是否可用，返回 True/False（兼容原有调用方式）。
+    同时在主线程中预加载配置到缓存。
+    """
+    base_url, api_key = _supabase_config()
+    return True if (base_url and api_key) else None
+
+
+# ============================================================
+# 图片存储（缩略图 / 大图以二进制对象存放，数据库只保存 key）
+# ============================================================
+# 本地存储默认放在 static/images 下，由 Streamlit 静态文件服务直接提供给浏览器
+LOCAL_IMAGE_STORE_DIR = Path(__file__).parent / "static" / "images"
+LOCAL_IMAGE_STORE_URL = "app/static/images"
+# 浏览器端图片格式：Pillow 支持 WebP 时用 WebP（同等质量比 JPEG 小约 25-30%）
+IMAGE_STORE_FORMAT = "WEBP" if HAS_PIL and features.check("webp") else "JPEG"
+IMAGE_STORE_EXTENSION = "webp" if IMAGE_STORE_FORMAT == "WEBP" else "jpg"
+_IMAGE_CONTENT_TYPES = {"webp": "image/webp", "jpg": "image/jpeg"}
+
+
+def image_content_key(data: bytes, extension: str) -> str:
+    """内容寻址 key：sha256 前两位作为目录分散文件，相同图片只存一份"""
+    digest = hashlib.sha256(data).hexdigest()
+    return f"{digest[:2]}/{digest}.{extension}"
+
+
+class LocalImageStore:
+    """本地文件系统图片存储。root 在 static 目录下时浏览器可直接按 URL 读取"""
+
+    def __init__(self, root: Path, url_prefix: str = ""):
+        self.root = Path(root)
+        self.url_prefix = url_prefix
+
+    def put(self, data: bytes, extension: str) -> str:
+        key = image_content_key(data, extension)
+        path = self.root / key
+        if not path.exists():
+            path.parent.mkdir(parents=True, exist_ok=True)
+            # 先写临时文件再改名，并发写入同一张图片时不会读到半个文件
+            tmp_path = path.with_suffix(f".{threading.get_ident()}.tmp")
+            tmp_path.write_bytes(data)
+            os.replace(tmp_path, path)
+        return key
+
+    def get(self, key: str) -> bytes | None:
+        try:
+            return (self.root / key).read_bytes()
+        except OSError:
+            return None
+
+    def url(self, key: str) -> str:
+        # 文件不在本实例（例如由其他实例写入）时不给 URL，由调用方回退到其他来源
+        if not self.url_prefix or not (self.root / key).is_file():
+            return ""
+        return f"{self.url_prefix}/{key}"
+
+
+class S3ImageStore:
+    """S3 兼容对象存储（AWS S3 / MinIO / 阿里云 OSS 等，需要 boto3）。
+
+    配置了 public_url（公开读的桶或 CDN 域名）时浏览器直接按 URL 读取，否则由应用代取。
+    """
+
+    def __init__(self, bucket: str, endpoint_url: str = "", access_key: str = "",
+                 secret_key: str = "", region: str = "", public_url: str = ""):
+        self.bucket = bucket
+        self.public_url = public_url.rstrip("/")
+        self.client = boto3.client(
+            "s3",
+            endpoint_url=endpoint_url or None,
+            aws_access_key_id=access_key or None,
+            aws_secret_access_key=secret_key or None,
+            region_name=region or None,
+        )
+
+    def put(self, data: bytes, extension: str) -> str:
+        key = image_content_key(data, extension)
+        self.client.put_object(
+            Bucket=self.bucket, Key=key, Body=data,
+            ContentType=_IMAGE_CONTENT_TYPES.get(extension, "application/octet-stream"),
+            # 内容寻址的对象永不变化，允许浏览器和 CDN 长期缓存
+            CacheControl="public, max-age=31536000, immutable",
+        )
+        return key
+
+    def get(self, key: str) -> bytes | None:
+        try:
+            return self.client.get_object(Bucket=self.bucket, Key=key)["Body"].read()
+        except Exception as exc:
+            print(f"[图片存储] 读取 {key} 失败: {type(exc).__name__}: {exc}")
+            return None
+
+    def url(self, key: str) -> str:
+        return f"{self.public_url}/{key}" if self.public_url else ""
+
+
+def _image_store_setting(name: str, default: str = "") -> str:
+    """图片存储配置：优先 st.secrets，其次环境变量"""
+    try:
+        return str(st.secrets[name])
+    except (KeyError, FileNotFoundError):
+        return os.environ.get(name, default)
+
+
+@st.cache_resource(show_spinner=False)
+def get_image_store():
+    """进程级图片存储。IMAGE_STORE=s3 且安装了 boto3 时使用对象存储，否则使用本地文件系统"""
+    if _image_store_setting("IMAGE_STORE") == "s3":
+        if HAS_BOTO3:
+            return S3ImageStore(
+                bucket=_image_store_setting("IMAGE_STORE_BUCKET"),
+                endpoint_url=_image_store_setting("IMAGE_STORE_ENDPOINT"),
+                access_key=_image_store_setting("IMAGE_STORE_ACCESS_KEY"),
+                secret_key=_image_store_setting("IMAGE_STORE_SECRET_KEY"),
+                region=_image_store_setting("IMAGE_STORE_REGION"),
+                public_url=_image_store_setting("IMAGE_STORE_PUBLIC_URL"),
+            )
+        print("[图片存储] 未安装 boto3，退回本地文件系统存储")
+    local_dir = _image_store_setting("IMAGE_STORE_DIR")
+    if local_dir:
+        # 自定义目录不在 static 下，浏览器无法直接访问，由应用代取
+        return LocalImageStore(Path(local_dir))
+    return LocalImageStore(LOCAL_IMAGE_STORE_DIR, LOCAL_IMAGE_STORE_URL)
+
+
+@st.cache_data(ttl=86400, show_spinner=False, max_entries=500)
+def _stored_image_data_url(key: str) -> str:
+    """存储中图片的 data URL（对象按内容寻址、永不变化，可以长期缓存）"""
+    data = get_image_store().get(key)
+    if not data:
+        return ""
+    content_type = _IMAGE_CONTENT_TYPES.get(key.rsplit(".", 1)[-1], "image/jpeg")
+    return f"data:{content_type};base64,{base64.b64encode(data).decode('ascii')}"
+
+
+def image_src(key: str) -> str:
+    """<img src> 可用的地址：存储可公开访问时直接给 URL（浏览器单独请求并缓存），否则为 data URL"""
+    if not key:
+        return ""
+    return get_image_store().url(key) or _stored_image_data_url(key)
+
+
+@st.cache_data(ttl=300, show_spinner=False)
+def _legacy_inline_images(record_ids: tuple, column: str) -> dict:
+    """旧版内联在 bird_records 中的 base64 图片 {id: base64}，用于尚未迁移的记录。
+
+    旧列已按 schema.sql 删除时查询失败，返回空映射。
     """
-    if override_url and override_key:
-        base_url, api_key = override_url, override_key
-    else:
-        base_url, api_key = _supabase_config()
-    if not base_url or not api_key:
-        print(f"[Supabase] 配置缺失，跳过 {method} {endpoint}")
-        return None
+    if not record_ids:
+        return {}
+    ids = ",".join(urllib.parse.quote(str(record_id)) for record_id in record_ids)
+    result = _supabase_request(
+        "GET", "bird_records", params=f"select=id,{column}&id=in.({ids})&{column}=neq.",
+    )
+    if not isinstance(result, list):
+        return {}
+    return {row["id"]: row[column] for row in result if row.get(column)}
 
-    url = f"{base_url}/rest/v1/{endpoint}"
-    if params:
-        url += f"?{params}"
 
-    headers = {
-        "apikey": api_key,
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json",
-        "Prefer": "return=representation",
-    }
+def record_image_srcs(records: list, kind: str = "thumbnail") -> list:
+    """一组记录的 <img src>（kind 为 thumbnail / image）。
 
-    data = json.dumps(body).encode("utf-8") if body else None
-    req = urllib.request.Request(url, data=data, headers=headers, method=method)
+    优先从图片存储读取；没有 key、或 key 指向的图片不在当前存储中时，回退到旧版 base64 列。
+    """
+    srcs = [image_src(record.get(f"{kind}_key") or "") for record in records]
+    missing = tuple(
+        record["id"] for record, src in zip(records, srcs)
+        if not src and record.get("id") is not None
+    )
+    if not missing:
+        return srcs
+    legacy = _legacy_inline_images(missing, f"{kind}_base64")
+    return [
+        src or (f"data:image/jpeg;base64,{legacy[record['id']]}" if record.get("id") in legacy else "")
+        for record, src in zip(records, srcs)
+    ]
 
-    try:
-        with urllib.request.urlopen(req, timeout=30) as resp:
-            status_code = resp.status
-            response_body = resp.read().decode("utf-8")
-            print(f"[Supabase] {method} {endpoint} 状态码: {status_code} 响应长度: {len(response_body)}")
-            # POST 插入成功时返回 201，即使响应体为空也视为成功
-            if method == "POST" and status_code in (200, 201):
-                if response_body:
-                    return json.loads(response_body)
-                return {"_inserted": True}
-            if response_body:
-                return json.loads(response_body)
-            return None
-    except urllib.error.HTTPError as http_err:
-        error_body = ""
-        try:
-            error_body = http_err.read().decode("utf-8")
-        except Exception:
-            pass
-        print(f"[Supabase] {method} {endpoint} 失败: {http_err.code} {error_body[:200]}")
-        return None
-    except Exception as exc:
-        print(f"[Supabase] {method} {endpoint} 异常: {type(exc).__name__}: {exc}")
-        return None
 
-def get_supabase_client():
-    """检查 Supabase 是否可用，返回 True/False（兼容原有调用方式）。
-    同时在主线程中预加载配置到缓存。
+def _stored_copy_confirmed(store, key: str, data: bytes = None) -> bool:
+    """回读确认图片已完整写入存储（data 为 None 时只确认对象存在且非空）"""
+    stored = store.get(key) if key else None
+    return bool(stored) and (data is None or stored == data)
+
+
+@st.cache_resource(show_spinner=False)
+def _migrate_inline_images() -> bool:
+    """把旧版内联在 bird_records 中的 base64 图片迁移到图片存储（需设置 BIRDEYE_MIGRATE_INLINE_IMAGES=1）。
+
+    只在配置了持久的对象存储（IMAGE_STORE=s3）时运行：本地存储在临时 / 多实例部署中会丢失，
+    而旧列是图片唯一的持久副本。每张图片上传后回读比对，确认无误才回写 key 并清空对应旧列。
+    在后台线程中分批处理，旧列中已没有数据（或已按 schema.sql 删除）时立即结束。
     """
+    if os.environ.get("BIRDEYE_MIGRATE_INLINE_IMAGES") != "1":
+        return False
+    store = get_image_store()
+    if not isinstance(store, S3ImageStore):
+        print("[图片迁移] 未配置对象存储（IMAGE_STORE=s3），跳过迁移以保留旧列中的图片")
+        return False
     base_url, api_key = _supabase_config()
-    return True if (base_url and api_key) else None
+
+    def _run():
+        migrated = 0
+        while True:
+            rows = _supabase_request(
+                "GET", "bird_records",
+                params="select=id,thumbnail_base64,image_base64,thumbnail_key,image_key"
+                       "&or=(thumbnail_base64.neq.,image_base64.neq.)&limit=50",
+                override_url=base_url, override_key=api_key,
+            )
+            if not rows:
+                break
+            for row in rows:
+                update = {}
+                try:
+                    for column, key_column in (("thumbnail_base64", "thumbnail_key"), ("image_base64", "image_key")):
+                        if not row.get(column):
+                            continue
+                        if row.get(key_column):
+                            # 已有 key：确认对象确实在存储中，才清空旧数据
+                            confirmed = _stored_copy_confirmed(store, row[key_column])
+                        else:
+                            data = base64.b64decode(row[column])
+                            key = store.put(data, "jpg")
+                            confirmed = _stored_copy_confirmed(store, key, data)
+                            if confirmed:
+                                update[key_column] = key
+                        if not confirmed:
+                            print(f"[图片迁移] 记录 {row.get('id')} 的 {column} 回读校验失败，停止迁移")
+                            return
+                        update[column] = ""
+                except Exception as exc:
+                    print(f"[图片迁移] 记录 {row.get('id')} 失败: {type(exc).__name__}: {exc}")
+                    return
+                result = _supabase_request(
+                    "PATCH", "bird_records", update, params=f"id=eq.{row['id']}",
+                    override_url=base_url, override_key=api_key,
+                )
+                if not result:
+                    print(f"[图片迁移] 回写记录 {row.get('id')} 失败，停止迁移")
+                    return
+                migrated += 1
+        print(f"[图片迁移] 完成，共迁移 {migrated} 条记录")
+
+    threading.Thread(target=_run, daemon=True, name="image-migration").start()
+    return True
 
 
 def generate_thumbnail_base64(image_bytes: bytes, filename: str = "",
                               bird_bbox: list = None, max_width: int = 480) -> str:
     """生成缩略图的 base64 字符串（保留完整画面，压缩到 480px 宽）"""
-    img = image_bytes_to_pil(image_bytes, filename)
-    if img is None:
-        return ""
-    try:
-        if img.mode not in ("RGB", "L"):
-            img = img.convert("RGB")
-        # 不裁剪，保留完整的鸟的形象
-        width, height = img.size
-        if width > max_width:
-            ratio = max_width / width
-            new_size = (max_width, int(height * ratio))
-            img = img.resize(new_size, Image.LANCZOS)
-        buffer = io.BytesIO()
-        img.save(buffer, format="JPEG", quality=80)
-        return base64.b64encode(buffer.getvalue()).decode("utf-8")
-    except Exception:
-        return ""
+    return ImageContext(image_bytes, filename).thumbnail_base64(max_width)
 
 
-def save_record_to_db(supabase_client, user_nickname: str, result: dict,
-                      thumbnail_b64: str, image_b64: str = "",
+def save_record_to_db(user_nickname: str, result: dict,
+                      thumbnail_key: str, image_key: str = "",
                       supabase_url: str = None, supabase_key: str = None,
                       shoot_city: str = "") -> tuple:
     """将一条识别记录保存到 Supabase 数据库（完全线程安全，自包含 HTTP 请求）。
-    返回 (success: bool, error_msg: str)。
+    返回 (success: bool, error_msg: str, record_id)。
     必须通过 supabase_url/supabase_key 直接传入配置。
+    图片本身已写入图片存储，这里只保存 thumbnail_key / image_key。
     """
     db_url = supabase_url
     db_key = supabase_key
     if not db_url or not db_key:
-        return False, "Supabase URL 或 Key 未传入"
+        return False, "Supabase URL 或 Key 未传入", None
 
     record = {
         "user_nickname": user_nickname,
@@ -2588,58 +5245,42 @@ def save_record_to_db(supabase_client, user_nickname: str, result: dict,
         "identification_basis": result.get("identification_basis", ""),
         "bird_description": result.get("bird_description", ""),
         "shoot_date": result.get("shoot_date", ""),
-        "thumbnail_base64": thumbnail_b64,
-        "image_base64": image_b64,
+        "thumbnail_key": thumbnail_key,
+        "image_key": image_key,
         "shoot_city": shoot_city,
     }
 
-    url = f"{db_url}/rest/v1/bird_records"
-    headers = {
-        "apikey": db_key,
-        "Authorization": f"Bearer {db_key}",
-        "Content-Type": "application/json",
-        "Prefer": "return=representation",
-    }
-    data = json.dumps(record).encode("utf-8")
-    req = urllib.request.Request(url, data=data, headers=headers, method="POST")
-
     def _do_post(payload):
-        post_data = json.dumps(payload).encode("utf-8")
-        post_req = urllib.request.Request(url, data=post_data, headers=headers, method="POST")
-        with urllib.request.urlopen(post_req, timeout=60) as resp:
-            status_code = resp.status
-            resp_body = resp.read().decode("utf-8", errors="replace")
-            record_id = None
-            try:
-                resp_data = json.loads(resp_body)
-                if isinstance(resp_data, list) and resp_data:
-                    record_id = resp_data[0].get("id")
-                elif isinstance(resp_data, dict):
-                    record_id = resp_data.get("id")
-            except (json.JSONDecodeError, ValueError):
-                pass
-            return status_code, record_id
+        resp = supabase_http("POST", "bird_records", body=payload, timeout=60,
+                             override_url=db_url, override_key=db_key)
+        resp.raise_for_status()
+        record_id = None
+        try:
+            resp_data = resp.json()
+            if isinstance(resp_data, list) and resp_data:
+                record_id = resp_data[0].get("id")
+            elif isinstance(resp_data, dict):
+                record_id = resp_data.get("id")
+        except ValueError:
+            pass
+        return resp.status_code, record_id
 
     try:
         status_code, record_id = _do_post(record)
         print(f"[Supabase] 保存成功: {user_nickname} - {result.get('chinese_name', '未知')} (HTTP {status_code}, id={record_id})")
         return True, "", record_id
-    except urllib.error.HTTPError as http_err:
-        error_body = ""
-        try:
-            error_body = http_err.read().decode("utf-8")
-        except Exception:
-            pass
-        # 如果写入失败且包含 image_base64，可能是字段不存在，去掉后重试
-        if "image_base64" in record and record["image_base64"]:
+    except httpx.HTTPStatusError as http_err:
+        error_body = http_err.response.text
+        # 如果写入失败且包含 image_key，可能是字段不存在（未按 schema.sql 升级），去掉后重试
+        if record.get("image_key"):
             try:
-                fallback_record = {k: v for k, v in record.items() if k != "image_base64"}
+                fallback_record = {k: v for k, v in record.items() if k != "image_key"}
                 status_code, record_id = _do_post(fallback_record)
-                print(f"[Supabase] 降级保存成功(无image_base64): {user_nickname} (HTTP {status_code}, id={record_id})")
+                print(f"[Supabase] 降级保存成功(无image_key): {user_nickname} (HTTP {status_code}, id={record_id})")
                 return True, "", record_id
             except Exception:
                 pass
-        msg = f"HTTP {http_err.code}: {error_body[:200]}"
+        msg = f"HTTP {http_err.response.status_code}: {error_body[:200]}"
         print(f"[Supabase] 保存失败: {msg}")
         return False, msg, None
     except Exception as exc:
@@ -2648,29 +5289,190 @@ def save_record_to_db(supabase_client, user_nickname: str, result: dict,
         return False, msg, None
 
 
+HISTORY_PAGE_SIZE = 24          # 观鸟记录每页卡片数
+HISTORY_SCAN_PAGE_SIZE = 1000   # 全量投影（鸟种集合 / 统计）按此大小分页拉取，与 PostgREST 默认 max-rows 一致
+_PHOTO_RECORD_FILTER = "or=(confidence.is.null,confidence.neq.imported)"
+
+
+def _history_cursor_filter(cursor) -> str:
+    """keyset 分页条件：(created_at, id) 严格小于上一页最后一条，对应 idx_bird_records_user 索引顺序"""
+    if not cursor:
+        return ""
+    created_at, record_id = cursor
+    tree = f'(or(created_at.lt."{created_at}",and(created_at.eq."{created_at}",id.lt.{int(record_id)})))'
+    return "&and=" + urllib.parse.quote(tree, safe='(),."')
+
+
+def _fetch_user_records_page(user_nickname: str, select: str, filters: str = "",
+                             cursor=None, limit: int = HISTORY_PAGE_SIZE) -> list:
+    """按 created_at DESC, id DESC 取一页用户记录，只返回 select 指定的列"""
+    columns = select.split(",")
+    for key in ("id", "created_at"):
+        if key not in columns:
+            columns.append(key)
+    params = (
+        f"user_nickname=eq.{urllib.parse.quote(user_nickname)}"
+        f"{'&' + filters if filters else ''}"
+        f"{_history_cursor_filter(cursor)}"
+        f"&order=created_at.desc,id.desc"
+        f"&limit={limit}"
+        f"&select={','.join(columns)}"
+    )
+    result = _supabase_request("GET", "bird_records", params=params)
+    return result if isinstance(result, list) else []
+
+
+def _scan_user_records(user_nickname: str, select: str, filters: str = "") -> list:
+    """用 keyset 分页遍历用户的全部记录（只取轻量列），不受单次 limit 截断"""
+    rows = []
+    cursor = None
+    while True:
+        page = _fetch_user_records_page(user_nickname, select, filters, cursor, HISTORY_SCAN_PAGE_SIZE)
+        rows.extend(page)
+        if len(page) < HISTORY_SCAN_PAGE_SIZE:
+            return rows
+        cursor = (page[-1]["created_at"], page[-1]["id"])
+
+
+def _fetch_user_species_rows(user_nickname: str):
+    """读取触发器维护的 user_species_stats（每个鸟种一行）；表不存在（未按 schema.sql 升级）时返回 None"""
+    rows = []
+    while True:
+        params = (
+            f"user_nickname=eq.{urllib.parse.quote(user_nickname)}"
+            f"&select=chinese_name,english_name"
+            f"&order=chinese_name&limit={HISTORY_SCAN_PAGE_SIZE}&offset={len(rows)}"
+        )
+        page = _supabase_request("GET", "user_species_stats", params=params)
+        if not isinstance(page, list):
+            return None if not rows else rows
+        rows.extend(page)
+        if len(page) < HISTORY_SCAN_PAGE_SIZE:
+            return rows
+
+
+def _fetch_user_stats_row(user_nickname: str):
+    """读取触发器维护的 user_stats 单行；用户无记录时返回空 dict，表不存在时返回 None"""
+    params = (
+        f"user_nickname=eq.{urllib.parse.quote(user_nickname)}"
+        f"&select=total_records,imported_records,species,imported_species,"
+        f"score_sum,score_count,best_score,last_import_at"
+    )
+    result = _supabase_request("GET", "user_stats", params=params)
+    if not isinstance(result, list):
+        return None
+    return result[0] if result else {}
+
+
+@st.cache_data(ttl=30, show_spinner=False)
+def fetch_user_species_set(_supabase_client, user_nickname: str) -> set:
+    """用户记录过的鸟种名集合（中文名 + 英文名），供探索页标注"新鸟种"。
+
+    优先读取每个鸟种一行的 user_species_stats，数据库未升级时按记录分页只拉名称列。
+    """
+    if not _supabase_client or not user_nickname:
+        return set()
+    try:
+        rows = _fetch_user_species_rows(user_nickname)
+        if rows is None:
+            rows = _scan_user_records(user_nickname, "chinese_name,english_name")
+        species = set()
+        for record in rows:
+            if record.get("chinese_name"):
+                species.add(record["chinese_name"])
+            if record.get("english_name"):
+                species.add(record["english_name"])
+        return species
+    except Exception as exc:
+        print(f"[历史记录] 鸟种集合查询失败: {exc}")
+        return set()
+
+
+@st.cache_data(ttl=30, show_spinner=False)
+def fetch_user_stats(_supabase_client, user_nickname: str) -> dict:
+    """用户统计数据（缓存 30 秒）。
+
+    优先读取触发器增量维护的 user_stats 单行（额外带 last_import 最后导入时间）；
+    数据库未升级时按记录分页只拉统计所需的列，在客户端计算。
+    """
+    if not _supabase_client or not user_nickname:
+        return fetch_user_stats_from_records([])
+    try:
+        row = _fetch_user_stats_row(user_nickname)
+        if row is not None:
+            total = row.get("total_records") or 0
+            score_count = row.get("score_count") or 0
+            return {
+                "total": total,
+                "photo_total": total - (row.get("imported_records") or 0),
+                "species": row.get("species") or 0,
+                "imported_species": row.get("imported_species") or 0,
+                "avg_score": round((row.get("score_sum") or 0) / score_count, 1) if score_count else 0,
+                "best_score": row.get("best_score") or 0,
+                "last_import": row.get("last_import_at") or "",
+            }
+        records = _scan_user_records(user_nickname, "chinese_name,score,confidence")
+    except Exception as exc:
+        print(f"[历史记录] 统计查询失败: {exc}")
+        records = []
+    return fetch_user_stats_from_records(records)
+
+
+@st.cache_data(ttl=30, show_spinner=False)
+def fetch_user_history_page(_supabase_client, user_nickname: str, cursor=None,
+                            page_size: int = HISTORY_PAGE_SIZE) -> tuple:
+    """查询一页拍照识别记录卡片（缓存 30 秒）。
+
+    cursor 为上一页最后一条的 (created_at, id)，None 表示第一页。
+    返回 (records, next_cursor)；没有更多记录时 next_cursor 为 None。
+    """
+    if not _supabase_client or not user_nickname:
+        return [], None
+    try:
+        rows = _fetch_user_records_page(
+            user_nickname, "chinese_name,score,thumbnail_key",
+            _PHOTO_RECORD_FILTER, cursor, page_size + 1,
+        )
+    except Exception as exc:
+        print(f"[历史记录] 分页查询失败: {exc}")
+        return [], None
+    records = rows[:page_size]
+    next_cursor = None
+    if len(rows) > page_size and records:
+        next_cursor = (records[-1]["created_at"], records[-1]["id"])
+    return records, next_cursor
+
+
 @st.cache_data(ttl=30, show_spinner=False)
-def fetch_user_history(_supabase_client, user_nickname: str, limit: int = 1000) -> list:
-    """查询用户的历史识别记录（缓存 30 秒）。limit 默认 1000 以容纳导入记录。"""
-    if not _supabase_client:
+def fetch_user_imported_records(_supabase_client, user_nickname: str) -> list:
+    """查询用户导入的观鸟记录（只取鸟种标签需要的列）。"""
+    if not _supabase_client or not user_nickname:
         return []
     try:
-        encoded_nickname = urllib.parse.quote(user_nickname)
-        params = (
-            f"user_nickname=eq.{encoded_nickname}"
-            f"&order=created_at.desc"
-            f"&limit={limit}"
-            f"&select=id,chinese_name,english_name,score,created_at,thumbnail_base64,confidence,identification_basis"
+        return _scan_user_records(
+            user_nickname, "chinese_name,english_name,identification_basis",
+            "confidence=eq.imported",
         )
-        result = _supabase_request("GET", "bird_records", params=params)
-        return result if isinstance(result, list) else []
-    except Exception:
+    except Exception as exc:
+        print(f"[历史记录] 导入记录查询失败: {exc}")
         return []
 
 
+def clear_user_history_cache():
+    """记录增删改后清空各历史记录投影的缓存"""
+    fetch_user_species_set.clear()
+    fetch_user_stats.clear()
+    fetch_user_history_page.clear()
+    fetch_user_imported_records.clear()
+
+
 def _get_import_sync_info(supabase_client, user_nickname: str) -> dict:
-    """获取用户导入记录的同步信息（鸟种数和最后同步时间）。"""
+    """获取用户导入记录的同步信息（鸟种数和最后同步时间），优先取自 user_stats。"""
     if not supabase_client or not user_nickname:
         return {"count": 0, "last_sync": ""}
+    user_stats = fetch_user_stats(supabase_client, user_nickname)
+    if "last_import" in user_stats:
+        return {"count": user_stats["imported_species"], "last_sync": user_stats["last_import"][:10]}
     try:
         encoded_nickname = urllib.parse.quote(user_nickname)
         params = (
@@ -2709,24 +5511,11 @@ def delete_record_from_db(record_id: int) -> bool:
     if not base_url or not api_key:
         return False
     try:
-        import http.client
-        from urllib.parse import urlparse
-        parsed = urlparse(base_url)
-        conn = http.client.HTTPSConnection(parsed.hostname, timeout=15)
-        path = f"/rest/v1/bird_records?id=eq.{record_id}"
-        headers = {
-            "apikey": api_key,
-            "Authorization": f"Bearer {api_key}",
-            "Prefer": "return=minimal",
-        }
-        conn.request("DELETE", path, body=None, headers=headers)
-        resp = conn.getresponse()
-        status = resp.status
-        body = resp.read().decode("utf-8", errors="replace")
-        conn.close()
-        if status in (200, 204):
+        resp = supabase_http("DELETE", "bird_records", params=f"id=eq.{record_id}",
+                             prefer="return=minimal", timeout=15)
+        if resp.status_code in (200, 204):
             return True
-        st.error(f"删除失败 ({status}): {body[:200]}")
+        st.error(f"删除失败 ({resp.status_code}): {resp.text[:200]}")
         return False
     except Exception as exc:
         st.error(f"删除失败: {exc}")
@@ -2740,7 +5529,7 @@ def update_record_name_in_db(record_id: int, new_chinese_name: str, new_english_
 
     优先通过 record_id 定位记录；如果 record_id 为 None，
     则通过 user_nickname + old_chinese_name + shoot_date 组合定位。
-    使用与 fetch_user_history 相同的 _supabase_request 通道确保一致性。
+    与其他数据库函数一样通过 supabase_http 共享的连接池发送请求。
     """
     base_url, api_key = _supabase_config()
     if not base_url or not api_key:
@@ -2764,34 +5553,30 @@ def update_record_name_in_db(record_id: int, new_chinese_name: str, new_english_
     if new_english_name:
         update_data["english_name"] = new_english_name
 
-    # 使用 urllib 直接发 PATCH 请求（与 _supabase_request 相同的方式）
-    url = f"{base_url}/rest/v1/bird_records?{query_params}"
-    headers = {
-        "apikey": api_key,
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json",
-        "Prefer": "return=minimal",
-    }
-    data = json.dumps(update_data).encode("utf-8")
-    req = urllib.request.Request(url, data=data, headers=headers, method="PATCH")
-
     try:
-        with urllib.request.urlopen(req, timeout=30) as resp:
-            status_code = resp.status
-            print(f"[Supabase] 更新鸟名成功: {old_chinese_name} -> {new_chinese_name} (HTTP {status_code})")
-            return status_code in (200, 204)
-    except urllib.error.HTTPError as http_err:
-        error_body = ""
-        try:
-            error_body = http_err.read().decode("utf-8")
-        except Exception:
-            pass
-        print(f"[Supabase] 更新鸟名失败: HTTP {http_err.code} {error_body[:200]}")
+        resp = supabase_http("PATCH", "bird_records", params=query_params, body=update_data,
+                             prefer="return=minimal")
+        if resp.status_code in (200, 204):
+            print(f"[Supabase] 更新鸟名成功: {old_chinese_name} -> {new_chinese_name} (HTTP {resp.status_code})")
+            return True
+        print(f"[Supabase] 更新鸟名失败: HTTP {resp.status_code} {resp.text[:200]}")
         return False
     except Exception as exc:
         print(f"[Supabase] 更新鸟名异常: {type(exc).__name__}: {exc}")
         return False
 
+def update_record_detail_in_db(record_id: int, detail: dict) -> bool:
+    """把按需获取的鸟种介绍 / 识别依据补写到已保存的识别记录"""
+    if not record_id or not detail:
+        return False
+    update_data = {
+        key: detail[key] for key in ("bird_description", "identification_basis") if detail.get(key)
+    }
+    if not update_data:
+        return False
+    result = _supabase_request("PATCH", "bird_records", update_data, params=f"id=eq.{record_id}")
+    return bool(result)
+
 def fetch_user_stats_from_records(records: list) -> dict:
     """从已有的历史记录中计算统计数据（避免额外的数据库请求）。
 
@@ -2832,35 +5617,41 @@ def fetch_user_stats_from_records(records: list) -> dict:
     }
 
 
+# 有缩略图的记录：已迁移到图片存储，或仍内联在旧列中；旧列已删除（查询失败）时只按 key 过滤
+_THUMBNAIL_FILTERS = ("or=(thumbnail_key.gt.,thumbnail_base64.gt.)", "thumbnail_key=gt.")
+
+
 @st.cache_data(ttl=300, show_spinner=False)
 def fetch_user_photos_by_species(chinese_names: tuple, city: str = "") -> dict:
     """按鸟种中文名批量查询用户上传的最新缩略图。
 
     优先查询同城市的照片，无结果时降级为全国查询。
-    返回 {chinese_name: thumbnail_base64} 映射，缓存 5 分钟。
+    返回 {chinese_name: 记录（id / thumbnail_key，交给 record_image_srcs 取图）} 映射，缓存 5 分钟。
     """
     if not chinese_names:
         return {}
 
     def _query(extra_filter: str = "") -> dict:
         names_filter = ",".join(urllib.parse.quote(n) for n in chinese_names)
-        params = (
-            f"select=chinese_name,thumbnail_base64"
-            f"&chinese_name=in.({names_filter})"
-            f"&thumbnail_base64=gt."
-            f"{extra_filter}"
-            f"&order=created_at.desc"
-            f"&limit=100"
-        )
-        result = _supabase_request("GET", "bird_records", params=params)
-        if not isinstance(result, list):
+        for image_filter in _THUMBNAIL_FILTERS:
+            params = (
+                f"select=id,chinese_name,thumbnail_key"
+                f"&chinese_name=in.({names_filter})"
+                f"&{image_filter}"
+                f"{extra_filter}"
+                f"&order=created_at.desc"
+                f"&limit=100"
+            )
+            result = _supabase_request("GET", "bird_records", params=params)
+            if isinstance(result, list):
+                break
+        else:
             return {}
         species_photo_map = {}
         for record in result:
             name = record.get("chinese_name", "")
-            thumb = record.get("thumbnail_base64", "")
-            if name and thumb and name not in species_photo_map:
-                species_photo_map[name] = thumb
+            if name and name not in species_photo_map:
+                species_photo_map[name] = record
         return species_photo_map
 
     try:
@@ -2880,9 +5671,10 @@ def fetch_user_photos_by_species(chinese_names: tuple, city: str = "") -> dict:
 def fetch_top_photos(limit: int = 10) -> list:
     """查询全局评分最高的照片（缓存 60 秒）"""
     try:
+        # 只取图片 key，图片本身由 image_src 单独获取（可被浏览器 / 缓存复用）
         params = (
             f"select=id,user_nickname,chinese_name,english_name,score,"
-            f"image_base64,thumbnail_base64,shoot_date,identification_basis,bird_description,"
+            f"image_key,thumbnail_key,shoot_date,identification_basis,bird_description,"
             f"score_sharpness,score_composition,score_lighting,"
             f"score_background,score_pose,score_artistry,"
             f"order_chinese,family_chinese"
@@ -2891,30 +5683,40 @@ def fetch_top_photos(limit: int = 10) -> list:
             f"&score=gt.0"
         )
         result = _supabase_request("GET", "bird_records", params=params)
-        if isinstance(result, list):
-            return result
-        # 如果查询失败（可能 image_base64 字段不存在），降级查询不含该字段
-        params_fallback = (
-            f"select=id,user_nickname,chinese_name,english_name,score,"
-            f"thumbnail_base64,shoot_date,identification_basis,bird_description,"
-            f"score_sharpness,score_composition,score_lighting,"
-            f"score_background,score_pose,score_artistry,"
-            f"order_chinese,family_chinese"
-            f"&order=score.desc"
-            f"&limit={limit}"
-            f"&score=gt.0"
-        )
-        result_fallback = _supabase_request("GET", "bird_records", params=params_fallback)
-        return result_fallback if isinstance(result_fallback, list) else []
+        return result if isinstance(result, list) else []
     except Exception:
         return []
 
 
 @st.cache_data(ttl=60, show_spinner=False)
 def fetch_leaderboard(limit: int = 20) -> list:
-    """查询所有用户的排行榜数据，按鸟种数降序排列（缓存 60 秒）"""
+    """查询排行榜，按鸟种数降序排列（缓存 60 秒）。
+
+    聚合在数据库中完成：get_leaderboard RPC 读取触发器增量维护的 user_species_stats，
+    只返回前 limit 名，传输量与记录总数无关。数据库尚未按 schema.sql 升级时降级为客户端聚合。
+    """
     try:
-        params = "select=user_nickname,chinese_name,score,confidence&limit=2000"
+        result = _supabase_request("POST", "rpc/get_leaderboard", {"limit_count": limit})
+        if isinstance(result, list):
+            return [
+                {
+                    "nickname": row.get("nickname", ""),
+                    "species": int(row.get("species") or 0),
+                    "total": int(row.get("total") or 0),
+                    "avg_score": float(row.get("avg_score") or 0),
+                    "best_score": int(row.get("best_score") or 0),
+                }
+                for row in result
+            ]
+    except Exception as exc:
+        print(f"[排行榜] RPC 查询失败: {exc}")
+    return _fetch_leaderboard_legacy(limit)
+
+
+def _fetch_leaderboard_legacy(limit: int) -> list:
+    """旧版客户端聚合（最多读取 2000 条记录），仅在数据库缺少 get_leaderboard 时使用"""
+    try:
+        params = "select=user_nickname,chinese_name,score&limit=2000"
         result = _supabase_request("GET", "bird_records", params=params)
         records = result if isinstance(result, list) else []
         if not records:
@@ -2938,16 +5740,12 @@ def fetch_leaderboard(limit: int = 20) -> list:
         leaderboard = []
         for nickname, data in user_data.items():
             scores = data["scores"]
-            avg_score = round(sum(scores) / len(scores), 1) if scores else 0
-            best_score = max(scores) if scores else 0
-            species_list = sorted(data["species"])
             leaderboard.append({
                 "nickname": nickname,
-                "species": len(species_list),
-                "species_list": species_list,
+                "species": len(data["species"]),
                 "total": data["total"],
-                "avg_score": avg_score,
-                "best_score": best_score,
+                "avg_score": round(sum(scores) / len(scores), 1) if scores else 0,
+                "best_score": max(scores) if scores else 0,
             })
         leaderboard.sort(key=lambda x: (x["species"], x["total"], x["avg_score"]), reverse=True)
         return leaderboard[:limit]
@@ -2986,6 +5784,27 @@ def get_confidence_emoji(confidence: str) -> str:
     return {"high": "🟢", "medium": "🟡", "low": "🔴"}.get(confidence, "⚪")
 
 
+# 流式识别中一完整就推送到结果卡片占位的字段（介绍和评分继续在后台生成）
+PARTIAL_CARD_FIELDS = ("chinese_name", "english_name", "candidates", "bird_bbox")
+
+
+def partial_card_markdown(file_name: str, fields: dict) -> str:
+    """识别尚未完成时结果卡片占位的内容：已生成的鸟种名、候选种和鸟的位置"""
+    lines = [f"**{file_name}**"]
+    if fields.get("chinese_name"):
+        english = f"　{fields['english_name']}" if fields.get("english_name") else ""
+        lines.append(f"🐦 **{fields['chinese_name']}**{english}")
+    candidates = [c for c in fields.get("candidates") or [] if isinstance(c, dict) and c.get("chinese_name")]
+    if candidates:
+        lines.append("候选：" + " / ".join(
+            f"{c['chinese_name']}（{c.get('similarity', 0)}%）" for c in candidates))
+    area = bbox_area_fraction(fields.get("bird_bbox"))
+    if area is not None:
+        lines.append(f"📍 已定位鸟的位置（约占画面 {area:.0%}）")
+    lines.append("⏳ 生成评分与介绍中…")
+    return "　\n".join(lines)
+
+
 def build_filename(result: dict) -> str:
     """根据识别结果构建文件名"""
     parts = [sanitize_filename(result.get("chinese_name", "未知鸟类"))]
@@ -3039,6 +5858,214 @@ def create_organized_zip(results_with_bytes: list) -> bytes:
     return zip_buffer.getvalue()
 
 
+# ============================================================
+# 识别流水线（后台事件循环 + 有界并发）
+# ============================================================
+def _preflight_image(name: str, image_bytes: bytes) -> ImageContext:
+    """预检：读取 EXIF 并计算感知哈希，用于连拍相似帧聚类"""
+    # 同一张照片只解析/解码一次，EXIF、AI 编码图、缩略图、预览图都从这里派生
+    image_ctx = ImageContext(image_bytes, name)
+    image_ctx.exif_info()
+    image_ctx.dhash()
+    return image_ctx
+
+
+async def _pipeline_process_file(job: dict, image_ctx: ImageContext, leader_task, config: dict,
+                                 emit, batcher: IdentifyBatcher = None) -> dict:
+    """处理单张照片：EXIF → 拍摄地点 → 编码 → AI 识别（进程级限流）→ 保存数据库。
+
+    CPU 密集的图片处理放到图片线程池，阻塞式网络请求放到默认线程池，
+    事件循环只负责调度。leader_task 不为空时，该照片是连拍序列中的相似帧：
+    只调用评分，鸟种识别沿用代表帧的结果。batcher 不为空时与其他照片合并批量识别。
+    """
+    loop = asyncio.get_running_loop()
+    executor = get_image_executor()
+    fname = job["name"]
+    suffix = Path(fname).suffix.lower()
+
+    emit("step", fname, "📷 提取 EXIF 数据…")
+    exif_info = await loop.run_in_executor(executor, image_ctx.exif_info)
+
+    if exif_info.get("gps_lat") and exif_info.get("gps_lon"):
+        emit("step", fname, "🗺️ 解析拍摄地点…")
+        geocoded_location = await asyncio.to_thread(
+            reverse_geocode, exif_info["gps_lat"], exif_info["gps_lon"]
+        )
+        if geocoded_location:
+            exif_info["geocoded_location"] = geocoded_location
+
+    emit("step", fname, "🔄 压缩编码图片…")
+    image_base64 = await loop.run_in_executor(executor, image_ctx.ai_data_url)
+
+    result = None
+    if leader_task is not None:
+        emit("step", fname, "🔁 连拍相似帧，仅评分中…")
+        frame_scores = await score_bird_photo_async(image_base64, config["api_key"])
+        # 等待代表帧时不占用限流器的并发名额
+        try:
+            leader_result = (await leader_task)["result"]
+        except Exception:
+            leader_result = None
+        # 代表帧识别失败或本帧评分失败时，退回完整识别
+        if frame_scores and leader_result and leader_result.get("chinese_name") != "未知鸟类":
+            result = merge_burst_result(leader_result, frame_scores)
+    if result is None and batcher is not None:
+        emit("step", fname, "🤖 AI 批量识别鸟种中…（耗时较长）")
+        result = await batcher.identify(image_base64, exif_info)
+    if result is None:
+        emit("step", fname, "🤖 AI 识别鸟种中…（耗时较长）")
+
+        def on_field(key, value):
+            # 鸟种名/候选种/位置一生成就推送到结果卡片占位，介绍和评分继续在后台生成
+            if key in PARTIAL_CARD_FIELDS:
+                emit("partial", fname, key, value)
+            if key == "chinese_name" and value:
+                emit("step", fname, f"🐦 初步识别：**{value}**，生成评分与介绍中…")
+            elif key == "candidates" and isinstance(value, list):
+                names = " / ".join(str(c.get("chinese_name", "")) for c in value if isinstance(c, dict))
+                if names:
+                    emit("step", fname, f"🐦 候选：{names}，生成评分与介绍中…")
+
+        result = await identify_bird_async(image_base64, config["api_key"], exif_info, on_field=on_field)
+    if leader_task is None and needs_refinement(result):
+        emit("step", fname, "🔍 置信度较低，发送鸟的局部放大图复核…")
+        result = await refine_with_bird_crop_async(result, image_ctx, config["api_key"], exif_info)
+
+    shoot_date = ""
+    if exif_info.get("shoot_time"):
+        shoot_date = exif_info["shoot_time"][:8]
+    result["shoot_date"] = shoot_date
+    result["original_name"] = fname
+
+    # 分布先验：GPS 解析出的省份优先，否则用用户选择的拍摄省份
+    geocoded = exif_info.get("geocoded_location")
+    gps_province = match_province_in_data(geocoded.get("province", "")) if isinstance(geocoded, dict) else ""
+    shoot_month = int(shoot_date[4:6]) if shoot_date[4:6].isdigit() else None
+    range_province = gps_province or config.get("shoot_province", "")
+    if range_province:
+        try:
+            await asyncio.to_thread(apply_range_prior, [result], range_province, shoot_month)
+        except Exception as exc:
+            # 先验只是辅助排序，失败时保留原始识别结果，不能让已识别的照片变成失败
+            print(f"[分布先验] 打分失败: {type(exc).__name__}: {exc}")
+        # 只有 GPS 定位、较高置信度的识别才作为出现记录，避免用户手选地点带来的噪声
+        if (gps_province and shoot_month and result.get("confidence") in ("high", "medium")
+                and result.get("chinese_name") != "未知鸟类"):
+            await asyncio.to_thread(
+                record_range_observations,
+                [(result.get("chinese_name", ""), gps_province, shoot_month, 1)], "photo",
+            )
+
+    # 生成缩略图并保存到数据库（URL/Key 由主线程传入，不依赖 st.secrets）
+    db_saved = False
+    db_error = ""
+    db_record_id = None
+    if config["db_enabled"]:
+        emit("step", fname, "💾 保存识别记录…")
+        # 缩略图（480px）和大图（800px）写入图片存储，数据库只保存 key；大图失败不影响保存
+        image_keys = {}
+        for name, max_width in (("thumbnail", 480), ("image", 800)):
+            data = await loop.run_in_executor(executor, image_ctx.thumbnail_bytes, max_width)
+            try:
+                image_keys[name] = await asyncio.to_thread(
+                    config["image_store"].put, data, IMAGE_STORE_EXTENSION,
+                ) if data else ""
+            except Exception as exc:
+                print(f"[图片存储] 写入失败: {type(exc).__name__}: {exc}")
+                image_keys[name] = ""
+        db_saved, db_error, db_record_id = await asyncio.to_thread(
+            save_record_to_db, config["nickname"], result, image_keys["thumbnail"],
+            image_key=image_keys["image"],
+            supabase_url=config["supabase_url"], supabase_key=config["supabase_key"],
+            shoot_city=config["shoot_city"],
+        )
+    elif config["db_config_missing"]:
+        db_error = "Supabase 配置在主线程中读取失败"
+    result["_db_saved"] = db_saved
+    result["_db_error"] = db_error
+    result["_db_record_id"] = db_record_id if db_saved else None
+
+    # 保留小尺寸预览图和鸟区域预览图供结果卡片使用，释放解码像素
+    await loop.run_in_executor(executor, image_ctx.bird_preview, result.get("bird_bbox"))
+    await loop.run_in_executor(executor, image_ctx.release)
+    emit("step", fname, "✅ 完成")
+    return {
+        "result": result,
+        "image_bytes": job["bytes"],
+        "image_ctx": image_ctx,
+        "suffix": suffix,
+    }
+
+
+async def run_identification_pipeline(jobs: list, config: dict, events: queue.Queue) -> None:
+    """批量识别流水线（在后台事件循环中运行）。
+
+    jobs: [{"name": 文件名, "bytes": 文件字节}]
+    进度通过 events 队列推送：("stage", 文本)、("step", 文件名, 文本)、
+    ("partial", 文件名, 字段名, 字段值)（流式识别中已完整的卡片字段）、
+    ("done", 下标, cache_entry)、("error", 下标, 错误信息)，最后总是推送 ("finished",)。
+    """
+    def emit(kind, *payload):
+        events.put((kind, *payload))
+
+    loop = asyncio.get_running_loop()
+    executor = get_image_executor()
+    started = time.monotonic()
+    try:
+        emit("stage", "🔍 预检照片，检测连拍相似帧…")
+        image_ctxs = await asyncio.gather(*(
+            loop.run_in_executor(executor, _preflight_image, job["name"], job["bytes"])
+            for job in jobs
+        ))
+        frame_exifs = [ctx.exif_info() for ctx in image_ctxs]
+        burst_leaders = cluster_burst_frames(
+            [ctx.dhash() for ctx in image_ctxs],
+            [exif.get("shoot_timestamp") for exif in frame_exifs],
+            [exif.get("camera", "") for exif in frame_exifs],
+        )
+
+        # 多个代表帧且开启批量识别时，代表帧的识别请求攒批发送
+        leader_count = sum(1 for index, leader in enumerate(burst_leaders) if leader == index)
+        batcher = None
+        if IDENTIFY_BATCH_SIZE > 1 and leader_count > 1:
+            batcher = IdentifyBatcher(config["api_key"], min(IDENTIFY_BATCH_SIZE, leader_count))
+
+        # 每个连拍序列只对代表帧识别鸟种，相似帧等待代表帧的任务结果
+        tasks = {}
+        for index, job in enumerate(jobs):
+            if burst_leaders[index] == index:
+                tasks[index] = asyncio.create_task(_pipeline_process_file(
+                    job, image_ctxs[index], None, config, emit, batcher,
+                ))
+        for index, job in enumerate(jobs):
+            if burst_leaders[index] != index:
+                tasks[index] = asyncio.create_task(_pipeline_process_file(
+                    job, image_ctxs[index], tasks[burst_leaders[index]], config, emit,
+                ))
+
+        async def _report(index, task):
+            try:
+                emit("done", index, await task)
+            except Exception as exc:
+                emit("error", index, f"{type(exc).__name__}: {exc}")
+
+        await asyncio.gather(*(_report(index, task) for index, task in tasks.items()))
+        print(f"[流水线] {len(jobs)} 张照片耗时 {time.monotonic() - started:.1f}s"
+              f"（批量识别 {'开启' if batcher else '关闭'}）")
+        print(f"[限流] 批次完成：{get_ai_rate_limiter().metrics()}")
+    finally:
+        emit("finished")
+
+
+def start_identification_pipeline(jobs: list, config: dict) -> tuple:
+    """把识别流水线提交到后台事件循环，立即返回 (进度事件队列, concurrent.futures.Future)"""
+    events = queue.Queue()
+    future = asyncio.run_coroutine_threadsafe(
+        run_identification_pipeline(jobs, config, events), get_ai_loop(),
+    )
+    return events, future
+
+
 # ============================================================
 # API Key & Supabase 初始化
 # ============================================================
@@ -3054,7 +6081,11 @@ if not api_key:
     st.error("服务暂不可用，请联系管理员配置 API Key。")
     st.stop()
 
+start_species_knowledge_seed()
+
 supabase_client = get_supabase_client()
+if supabase_client:
+    _migrate_inline_images()
 
 # ============================================================
 # 用户昵称 session 初始化（从 URL 参数恢复）
@@ -3344,17 +6375,11 @@ with tab_explore:
 
             if bird_species:
                 name_translations = translate_ebird_species(bird_species, ebird_api_key)
+                record_ebird_range_observations(bird_species, selected_province, name_translations)
 
-                user_species_set = set()
-                if supabase_client and st.session_state.get("user_nickname"):
-                    user_history = fetch_user_history(
-                        supabase_client, st.session_state["user_nickname"]
-                    )
-                    for record in user_history:
-                        if record.get("chinese_name"):
-                            user_species_set.add(record["chinese_name"])
-                        if record.get("english_name"):
-                            user_species_set.add(record["english_name"])
+                user_species_set = fetch_user_species_set(
+                    supabase_client, st.session_state.get("user_nickname", "")
+                )
 
                 recommendations = build_birding_recommendations(
                     bird_species, user_species_set, name_translations,
@@ -3375,6 +6400,7 @@ with tab_explore:
                 user_photo_map = fetch_user_photos_by_species(
                     chinese_names_for_photos, city=selected_city
                 )
+                user_thumb_srcs = dict(zip(user_photo_map, record_image_srcs(list(user_photo_map.values()))))
 
                 # 批量逆地理编码，把英文地点名转为中文
                 location_coords_for_geocode = tuple(
@@ -3420,13 +6446,13 @@ with tab_explore:
                     count_str = f" · {how_many}只" if how_many and how_many > 1 else ""
 
                     bird_photo_url = photo_urls.get(bird.get("species_code", ""), "")
-                    user_thumb_b64 = user_photo_map.get(bird.get("chinese_name", ""), "")
+                    user_thumb_src = user_thumb_srcs.get(bird.get("chinese_name", ""), "")
 
-                    if user_thumb_b64:
+                    if user_thumb_src:
                         # 优先展示用户实拍照片，带"用户实拍"角标
                         card_img_html = (
                             f'<div style="position:relative;">'
-                            f'<img src="data:image/jpeg;base64,{user_thumb_b64}" '
+                            f'<img src="{user_thumb_src}" '
                             f'style="width:100%;height:140px;object-fit:cover;'
                             f'border-radius:10px 10px 0 0;" loading="lazy" />'
                             f'<span style="position:absolute;bottom:6px;left:6px;'
@@ -3706,7 +6732,7 @@ with tab_upload:
                                     f"✅ 成功导入 **{imported}** 个新鸟种！"
                                     f"{'（' + str(skipped) + ' 个已存在）' if skipped > 0 else ''}"
                                 )
-                                fetch_user_history.clear()
+                                clear_user_history_cache()
                                 st.rerun()
                             else:
                                 st.info("数据已是最新 👍")
@@ -3741,121 +6767,80 @@ with tab_upload:
                 )
                 progress_bar = st.progress(0)
                 progress_text = st.empty()
+                # 识别完成前的结果卡片占位：鸟种名、候选种、位置一生成就显示
+                partial_area = st.container()
     
                 current_nickname = st.session_state.get("user_nickname", "")
-                # 在主线程中读取 Supabase 配置，通过闭包传入子线程（彻底避免子线程访问 st.secrets）
+                # 在主线程中读取 Supabase 配置，传入后台流水线（彻底避免后台线程访问 st.secrets / session_state）
                 _sb_url, _sb_key = _supabase_config()
+                pipeline_config = {
+                    "api_key": api_key,
+                    "nickname": current_nickname,
+                    "db_enabled": bool(supabase_client and current_nickname and _sb_url and _sb_key),
+                    "db_config_missing": not _sb_url or not _sb_key,
+                    "supabase_url": _sb_url,
+                    "supabase_key": _sb_key,
+                    "shoot_city": st.session_state.get("loc_city", ""),
+                    "shoot_province": st.session_state.get("loc_province", ""),
+                    "image_store": get_image_store(),
+                }
+                pipeline_jobs = [{"name": f.name, "bytes": f.getvalue()} for f in new_files]
+                pipeline_events, pipeline_future = start_identification_pipeline(pipeline_jobs, pipeline_config)
     
-                # 用于子线程向主线程报告当前步骤的共享状态
-                import threading
-                _file_progress_lock = threading.Lock()
-                _file_progress = {}  # {file_name: "当前步骤描述"}
-    
-                def _update_file_step(file_name: str, step: str):
-                    with _file_progress_lock:
-                        _file_progress[file_name] = step
-    
-                def _process_single_file(uploaded_file):
-                    """在线程中处理单张照片：EXIF提取 + 编码 + AI识别 + 保存数据库"""
-                    fname = uploaded_file.name
-                    _update_file_step(fname, "📂 读取图片信息…")
-                    image_bytes = uploaded_file.getvalue()
-                    suffix = Path(fname).suffix.lower()
-    
-                    _update_file_step(fname, "📷 提取 EXIF 数据…")
-                    exif_info = extract_exif_info(image_bytes, fname)
-    
-                    if exif_info.get("gps_lat") and exif_info.get("gps_lon"):
-                        _update_file_step(fname, "🗺️ 解析拍摄地点…")
-                        geocoded_location = reverse_geocode(exif_info["gps_lat"], exif_info["gps_lon"])
-                        if geocoded_location:
-                            exif_info["geocoded_location"] = geocoded_location
-    
-                    _update_file_step(fname, "🔄 压缩编码图片…")
-                    image_base64 = encode_image_to_base64(image_bytes, filename=fname)
-    
-                    _update_file_step(fname, "🤖 AI 识别鸟种中…（耗时较长）")
-                    result = identify_bird(image_base64, api_key, exif_info)
-    
-                    shoot_date = ""
-                    if exif_info.get("shoot_time"):
-                        shoot_date = exif_info["shoot_time"][:8]
-                    result["shoot_date"] = shoot_date
-                    result["original_name"] = fname
-    
-                    # 生成缩略图并保存到数据库（通过闭包传入 URL/Key，不依赖 st.secrets）
-                    db_saved = False
-                    db_error = ""
-                    db_record_id = None
-                    if supabase_client and current_nickname and _sb_url and _sb_key:
-                        _update_file_step(fname, "💾 保存识别记录…")
-                        thumb_b64 = generate_thumbnail_base64(image_bytes, fname)
-                        # 生成大图 base64（1200px 宽），如果失败不影响上传
-                        try:
-                            full_img_b64 = generate_thumbnail_base64(image_bytes, fname, max_width=800)
-                        except Exception:
-                            full_img_b64 = ""
-                        db_saved, db_error, db_record_id = save_record_to_db(
-                            supabase_client, current_nickname, result, thumb_b64,
-                            image_b64=full_img_b64,
-                            supabase_url=_sb_url, supabase_key=_sb_key,
-                            shoot_city=st.session_state.get("loc_city", ""),
-                        )
-                    elif not _sb_url or not _sb_key:
-                        db_error = "Supabase 配置在主线程中读取失败"
-                    result["_db_saved"] = db_saved
-                    result["_db_error"] = db_error
-                    result["_db_record_id"] = db_record_id if db_saved else None
-    
-                    _update_file_step(fname, "✅ 完成")
-                    return uploaded_file, {
-                        "result": result,
-                        "image_bytes": image_bytes,
-                        "suffix": suffix,
-                    }
-    
-                # 并发识别（最多 3 个线程，避免 API 限流）
-                max_workers = min(3, len(new_files))
                 completed_count = 0
                 db_save_failures = []
+                file_steps = {}  # {file_name: "当前步骤描述"}
+                partial_cards = {}  # {file_name: (占位, 已生成的字段)}
+                progress_text.markdown("⏳ 准备中…")
     
-                with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-                    future_to_file = {
-                        executor.submit(_process_single_file, f): f
-                        for f in new_files
-                    }
-                    pending_futures = set(future_to_file.keys())
-                    while pending_futures:
-                        # 每 0.3 秒轮询一次，更新进度显示
-                        done_batch, pending_futures = concurrent.futures.wait(
-                            pending_futures, timeout=0.3,
-                            return_when=concurrent.futures.FIRST_COMPLETED,
+                # 后台流水线通过队列推送进度事件，主线程收到事件才重绘
+                while True:
+                    try:
+                        event_kind, *event_payload = pipeline_events.get(timeout=1.0)
+                    except queue.Empty:
+                        if pipeline_future.done():
+                            break
+                        continue
+                    if event_kind == "finished":
+                        break
+                    if event_kind == "stage":
+                        progress_text.markdown(event_payload[0])
+                    elif event_kind == "step":
+                        step_name, step_desc = event_payload
+                        file_steps[step_name] = step_desc
+                        step_lines = []
+                        for fname_key, desc in file_steps.items():
+                            short_name = fname_key if len(fname_key) <= 20 else fname_key[:17] + "…"
+                            step_lines.append(f"**{short_name}**　{desc}")
+                        progress_text.markdown("　\n".join(step_lines))
+                    elif event_kind == "partial":
+                        partial_name, field_key, field_value = event_payload
+                        if partial_name not in partial_cards:
+                            partial_cards[partial_name] = (partial_area.empty(), {})
+                        card_placeholder, card_fields = partial_cards[partial_name]
+                        card_fields[field_key] = field_value
+                        card_placeholder.info(partial_card_markdown(partial_name, card_fields))
+                    elif event_kind in ("done", "error"):
+                        file_index, event_data = event_payload
+                        done_file = new_files[file_index]
+                        if done_file.name in partial_cards:
+                            # 完整结果在下方的结果卡片中展示
+                            partial_cards.pop(done_file.name)[0].empty()
+                        completed_count += 1
+                        progress_bar.progress(
+                            completed_count / len(new_files),
+                            text=f"🔍 已完成 {completed_count}/{len(new_files)}",
                         )
-                        # 构建当前所有文件的进度摘要
-                        with _file_progress_lock:
-                            step_lines = []
-                            for fname_key, step_desc in _file_progress.items():
-                                short_name = fname_key if len(fname_key) <= 20 else fname_key[:17] + "…"
-                                step_lines.append(f"**{short_name}**　{step_desc}")
-                        progress_text.markdown("　\n".join(step_lines) if step_lines else "⏳ 准备中…")
-    
-                        for future in done_batch:
-                            completed_count += 1
-                            progress_bar.progress(
-                                completed_count / len(new_files),
-                                text=f"🔍 已完成 {completed_count}/{len(new_files)}",
-                            )
-                            try:
-                                done_file, cache_entry = future.result()
-                                fkey = make_file_key(done_file)
-                                st.session_state["identified_cache"][fkey] = cache_entry
-                                if not cache_entry["result"].get("_db_saved", False):
-                                    db_save_failures.append(done_file.name)
-                            except Exception as exc:
-                                failed_name = future_to_file[future].name
-                                st.toast(f"⚠️ {failed_name} 识别失败: {exc}", icon="⚠️")
+                        if event_kind == "done":
+                            st.session_state["identified_cache"][make_file_key(done_file)] = event_data
+                            if not event_data["result"].get("_db_saved", False):
+                                db_save_failures.append(done_file.name)
+                        else:
+                            st.toast(f"⚠️ {done_file.name} 识别失败: {event_data}", icon="⚠️")
     
                 progress_text.empty()
+                for card_placeholder, _ in partial_cards.values():
+                    card_placeholder.empty()
     
                 if db_save_failures:
                     # 收集具体的错误原因
@@ -3870,7 +6855,7 @@ with tab_upload:
                     )
     
                 # 新增记录后清除缓存，确保历史记录和排行榜刷新
-                fetch_user_history.clear()
+                clear_user_history_cache()
                 fetch_leaderboard.clear()
                 fetch_top_photos.clear()
     
@@ -3942,6 +6927,11 @@ with tab_upload:
                             unsafe_allow_html=True,
                         )
     
+            call_stats = ai_call_stats_summary()
+            if call_stats:
+                with st.expander("⏱️ AI 调用统计（各档位 token 用量、缓存命中与耗时）"):
+                    st.dataframe(call_stats, hide_index=True, use_container_width=True)
+
             # 逐张展示 - 一行3个卡片网格（右栏空间适配）
             for row_start in range(0, len(results_with_bytes), 3):
                 row_items = results_with_bytes[row_start:row_start + 3]
@@ -3958,20 +6948,13 @@ with tab_upload:
     
                     with card_cols[col_idx]:
                         original_name = result.get("original_name", "")
-                        preview_img = image_bytes_to_pil(image_bytes, original_name)
+                        image_ctx = item.get("image_ctx")
+                        if image_ctx is None:
+                            image_ctx = item["image_ctx"] = ImageContext(image_bytes, original_name)
+                        # 聚焦到鸟的区域并高亮 AI 识别框（从原图裁剪后再缩小，不放大预览图）
+                        preview_img = image_ctx.bird_preview(result.get("bird_bbox"))
                         if preview_img is not None:
-                            bird_bbox = result.get("bird_bbox")
-                            if bird_bbox and len(bird_bbox) == 4:
-                                try:
-                                    # 在原图上绘制 AI 识别区域高亮框
-                                    annotated_img = draw_bird_bbox(preview_img.copy(), bird_bbox)
-                                    # 裁剪聚焦到鸟的区域用于展示
-                                    cropped_img = crop_to_bird(annotated_img.copy(), bird_bbox)
-                                    st.image(cropped_img, use_container_width=True)
-                                except Exception:
-                                    st.image(preview_img, use_container_width=True)
-                            else:
-                                st.image(preview_img, use_container_width=True)
+                            st.image(preview_img, use_container_width=True)
                         else:
                             st.text("无法预览")
     
@@ -3987,6 +6970,17 @@ with tab_upload:
                                     '⚠️ AI 不太确定，建议人工确认或提供更清晰的照片</div>',
                                     unsafe_allow_html=True,
                                 )
+                        # 分布先验提示：首选鸟种在拍摄地/月份少有记录
+                        if result.get("range_warning"):
+                            st.markdown(
+                                '<div style="background:rgba(255,149,0,0.12); color:#cc7700; '
+                                'padding:6px 10px; border-radius:8px; font-size:12px; '
+                                'margin-bottom:6px; text-align:center;">'
+                                f'🧭 {result["range_warning"]}</div>',
+                                unsafe_allow_html=True,
+                            )
+                        if result.get("refined") == "crop":
+                            st.caption("🔍 首轮置信度较低，已用鸟的局部放大图复核鸟种")
     
                         # 候选鸟种选择（带相似度百分比）
                         card_index = row_start + col_idx
@@ -4002,6 +6996,8 @@ with tab_upload:
                                 similarity = candidate.get("similarity", 0)
                                 reason = candidate.get("reason", "")
                                 label = f"{cname}（{similarity}%）- {reason}" if reason else f"{cname}（{similarity}%）"
+                                if candidate.get("range_prior", 1) < RANGE_PRIOR_FLAG_THRESHOLD:
+                                    label += " · 当地少见"
                                 option_labels.append(label)
                                 option_names.append(cname)
     
@@ -4062,7 +7058,7 @@ with tab_upload:
                                         )
                                         if not db_updated:
                                             st.warning("⚠️ 数据库更新失败，请检查网络连接")
-                                    fetch_user_history.clear()
+                                    clear_user_history_cache()
                                     fetch_leaderboard.clear()
                                     fetch_top_photos.clear()
                                     st.toast(f"✅ 已修改为「{selected_name}」", icon="✏️")
@@ -4077,9 +7073,15 @@ with tab_upload:
                                 label_visibility="collapsed",
                                 placeholder="输入鸟种中文名",
                             )
+                            # 手动输入的名称（含俗名、英文名）先用离线分类索引规范化
+                            name_entry = lookup_species(new_name)
+                            if name_entry:
+                                new_name = name_entry["chinese_name"]
                             if new_name and new_name != current_name:
                                 old_name = current_name
                                 result["chinese_name"] = new_name
+                                if name_entry:
+                                    canonicalize_species_result(result)
                                 if card_index < len(results_with_bytes):
                                     results_with_bytes[card_index]["result"]["chinese_name"] = new_name
                                 # 同步写回 session_state
@@ -4094,14 +7096,14 @@ with tab_upload:
                                     db_record_id = result.get("_db_record_id")
                                     record_shoot_date = result.get("shoot_date", "")
                                     db_updated = update_record_name_in_db(
-                                        db_record_id, new_name,
+                                        db_record_id, new_name, result.get("english_name", "") if name_entry else "",
                                         user_nickname=current_user,
                                         old_chinese_name=old_name,
                                         shoot_date=record_shoot_date,
                                     )
                                     if not db_updated:
                                         st.warning("⚠️ 数据库更新失败，请检查网络连接")
-                                fetch_user_history.clear()
+                                clear_user_history_cache()
                                 fetch_leaderboard.clear()
                                 fetch_top_photos.clear()
                                 st.toast(f"✅ 已修改为「{new_name}」", icon="✏️")
@@ -4142,6 +7144,23 @@ with tab_upload:
                                     f'{bird_desc}</div>',
                                     unsafe_allow_html=True,
                                 )
+                        elif current_name not in ("未知", "未知鸟类"):
+                            # fast 档位的识别结果不含介绍，展开卡片时按需获取（同一鸟种只请求一次）
+                            with st.expander("🐦 鸟类介绍"):
+                                if st.button("✨ 获取介绍与识别要点", key=f"load_detail_{card_index}"):
+                                    try:
+                                        with st.spinner("正在获取鸟类介绍…"):
+                                            detail = fetch_species_detail(
+                                                current_name, result.get("english_name", ""), api_key,
+                                            )
+                                    except Exception as exc:
+                                        st.warning(f"⚠️ 获取失败，请稍后重试（{exc}）")
+                                    else:
+                                        result.update(detail)
+                                        if result.get("_db_record_id"):
+                                            update_record_detail_in_db(result["_db_record_id"], detail)
+                                            clear_user_history_cache()
+                                        st.rerun()
     
                         shoot_date = result.get("shoot_date", "")
                         if shoot_date and len(shoot_date) >= 8:
@@ -4220,7 +7239,9 @@ with tab_gallery:
 
             # 构建每张佳作的数据（供 JS modal 使用）
             gallery_data_list = []
-            for photo in top_photos:
+            gallery_thumbs = record_image_srcs(top_photos, "thumbnail")
+            gallery_full_imgs = record_image_srcs(top_photos, "image")
+            for photo_index, photo in enumerate(top_photos):
                 sp_score = photo.get("score", 0)
                 sp_date_raw = photo.get("shoot_date", "")
                 formatted_date = ""
@@ -4258,8 +7279,8 @@ with tab_gallery:
                         )
 
                 gallery_data_list.append({
-                    "thumb": photo.get("thumbnail_base64", ""),
-                    "fullImg": photo.get("image_base64", ""),
+                    "thumb": gallery_thumbs[photo_index],
+                    "fullImg": gallery_full_imgs[photo_index],
                     "name": photo.get("chinese_name", "未知"),
                     "enName": photo.get("english_name", ""),
                     "score": sp_score,
@@ -4279,7 +7300,7 @@ with tab_gallery:
             for idx, gd in enumerate(gallery_data_list):
                 if gd["thumb"]:
                     img_tag = (
-                        f'<img src="data:image/jpeg;base64,{gd["thumb"]}" '
+                        f'<img src="{gd["thumb"]}" '
                         f'style="width:100%;object-fit:contain;'
                         f'border-radius:8px 8px 0 0;display:block;" loading="lazy" alt="{gd["name"]}">'
                     )
@@ -4436,7 +7457,7 @@ with tab_gallery:
                     var content = parentDoc.getElementById('galleryModalContent');
 
                     var imgHtml = imgSrc
-                        ? '<img class="modal-main-img" src="data:image/jpeg;base64,' + imgSrc + '">'
+                        ? '<img class="modal-main-img" src="' + imgSrc + '">'
                         : '<div style="width:100%;height:300px;background:linear-gradient(135deg,#1a3a5c,#2d6a4f);display:flex;align-items:center;justify-content:center;font-size:60px;">📷</div>';
 
                     var taxonomyHtml = '';
@@ -4509,15 +7530,14 @@ with tab_history:
         if pending_delete_key in st.session_state:
             delete_id = st.session_state.pop(pending_delete_key)
             if delete_record_from_db(delete_id):
-                fetch_user_history.clear()
+                clear_user_history_cache()
                 fetch_leaderboard.clear()
                 fetch_top_photos.clear()
                 st.toast("✅ 已删除", icon="✅")
             else:
                 st.toast("⚠️ 删除失败，请检查数据库权限", icon="⚠️")
 
-        history_records = fetch_user_history(supabase_client, user_nickname)
-        user_stats = fetch_user_stats_from_records(history_records)
+        user_stats = fetch_user_stats(supabase_client, user_nickname)
         if user_stats and user_stats.get("total", 0) > 0:
             imported_count = user_stats.get("imported_species", 0)
             photo_total = user_stats.get("photo_total", 0)
@@ -4551,67 +7571,92 @@ with tab_history:
 
             st.markdown("<br>", unsafe_allow_html=True)
 
-            # 历史记录列表
-            photo_records = [r for r in history_records if r.get("confidence") != "imported"]
-            imported_records = [r for r in history_records if r.get("confidence") == "imported"]
-
-            if history_records:
-                # 拍照识别记录
-                if photo_records:
-                    with st.expander(f"📷 拍摄识别记录（{len(photo_records)} 条）", expanded=True):
-                        for row_start in range(0, len(photo_records), 4):
-                            row_items = photo_records[row_start:row_start + 4]
-                            hist_cols = st.columns(4)
-                            for col_idx, record in enumerate(row_items):
-                                with hist_cols[col_idx]:
-                                    thumb_b64 = record.get("thumbnail_base64", "")
-                                    if thumb_b64:
-                                        st.markdown(
-                                            f'<img src="data:image/jpeg;base64,{thumb_b64}" '
-                                            f'style="width:100%; border-radius:10px; object-fit:contain;" '
-                                            f'loading="lazy" alt="bird">',
-                                            unsafe_allow_html=True,
-                                        )
-                                    else:
+            # 历史记录列表：拍照记录按 (created_at, id) keyset 分页，只加载当前页的卡片和缩略图
+            if photo_total:
+                with st.expander(f"📷 拍摄识别记录（{photo_total} 条）", expanded=True):
+                    page_cursors = st.session_state.setdefault(f"_history_cursors_{user_nickname}", [None])
+                    page_records, next_cursor = fetch_user_history_page(
+                        supabase_client, user_nickname, page_cursors[-1]
+                    )
+                    if not page_records and len(page_cursors) > 1:
+                        # 当前页的记录都被删除了，退回上一页
+                        page_cursors.pop()
+                        st.rerun()
+                    page_thumbs = record_image_srcs(page_records)
+                    for row_start in range(0, len(page_records), 4):
+                        row_items = page_records[row_start:row_start + 4]
+                        hist_cols = st.columns(4)
+                        for col_idx, record in enumerate(row_items):
+                            with hist_cols[col_idx]:
+                                thumb_src = page_thumbs[row_start + col_idx]
+                                if thumb_src:
+                                    st.markdown(
+                                        f'<img src="{thumb_src}" '
+                                        f'style="width:100%; border-radius:10px; object-fit:contain;" '
+                                        f'loading="lazy" alt="bird">',
+                                        unsafe_allow_html=True,
+                                    )
+                                else:
+                                    st.markdown(
+                                        '<div style="height:80px; background:rgba(0,0,0,0.04); '
+                                        'border-radius:10px; display:flex; align-items:center; '
+                                        'justify-content:center; color:#888; font-size:20px;">🐦</div>',
+                                        unsafe_allow_html=True,
+                                    )
+
+                                hist_score = record.get("score", 0)
+                                hist_score_color = get_score_color(hist_score)
+                                st.markdown(
+                                    f'<p style="font-size:13px; font-weight:600; color:#1a3a5c; '
+                                    f'margin:4px 0 2px; line-height:1.2;">{record.get("chinese_name", "未知")}</p>'
+                                    f'<span class="score-pill score-{hist_score_color}" '
+                                    f'style="font-size:11px; padding:2px 8px;">'
+                                    f'{get_score_emoji(hist_score)} {hist_score}</span>',
+                                    unsafe_allow_html=True,
+                                )
+
+                                created_at = record.get("created_at", "")
+                                if created_at:
+                                    try:
+                                        date_display = created_at[:10]
                                         st.markdown(
-                                            '<div style="height:80px; background:rgba(0,0,0,0.04); '
-                                            'border-radius:10px; display:flex; align-items:center; '
-                                            'justify-content:center; color:#888; font-size:20px;">🐦</div>',
+                                            f'<p style="font-size:11px; color:#888; margin:2px 0 8px;">'
+                                            f'📅 {date_display}</p>',
                                             unsafe_allow_html=True,
                                         )
+                                    except Exception:
+                                        pass
 
-                                    hist_score = record.get("score", 0)
-                                    hist_score_color = get_score_color(hist_score)
-                                    st.markdown(
-                                        f'<p style="font-size:13px; font-weight:600; color:#1a3a5c; '
-                                        f'margin:4px 0 2px; line-height:1.2;">{record.get("chinese_name", "未知")}</p>'
-                                        f'<span class="score-pill score-{hist_score_color}" '
-                                        f'style="font-size:11px; padding:2px 8px;">'
-                                        f'{get_score_emoji(hist_score)} {hist_score}</span>',
-                                        unsafe_allow_html=True,
-                                    )
+                                record_id = record.get("id")
+                                if record_id:
+                                    if st.button("🗑️", key=f"del_{record_id}",
+                                                 help="删除这条记录",
+                                                 use_container_width=True):
+                                        st.session_state[pending_delete_key] = record_id
+                                        st.rerun()
+
+                    if len(page_cursors) > 1 or next_cursor:
+                        nav_prev, nav_label, nav_next = st.columns([1, 2, 1])
+                        with nav_prev:
+                            if st.button("⬅️ 上一页", key="history_prev", disabled=len(page_cursors) <= 1,
+                                         use_container_width=True):
+                                page_cursors.pop()
+                                st.rerun()
+                        with nav_label:
+                            st.markdown(
+                                f'<p style="text-align:center; color:#888; font-size:13px; margin-top:8px;">'
+                                f'第 {len(page_cursors)} 页</p>',
+                                unsafe_allow_html=True,
+                            )
+                        with nav_next:
+                            if st.button("下一页 ➡️", key="history_next", disabled=not next_cursor,
+                                         use_container_width=True):
+                                page_cursors.append(next_cursor)
+                                st.rerun()
 
-                                    created_at = record.get("created_at", "")
-                                    if created_at:
-                                        try:
-                                            date_display = created_at[:10]
-                                            st.markdown(
-                                                f'<p style="font-size:11px; color:#888; margin:2px 0 8px;">'
-                                                f'📅 {date_display}</p>',
-                                                unsafe_allow_html=True,
-                                            )
-                                        except Exception:
-                                            pass
-
-                                    record_id = record.get("id")
-                                    if record_id:
-                                        if st.button("🗑️", key=f"del_{record_id}",
-                                                     help="删除这条记录",
-                                                     use_container_width=True):
-                                            st.session_state[pending_delete_key] = record_id
-                                            st.rerun()
-
-                # 导入的观鸟记录
+            # 导入的观鸟记录
+            if imported_count > 0:
+                imported_records = fetch_user_imported_records(supabase_client, user_nickname)
                 if imported_records:
                     seen_imported = set()
                     unique_imported = []
@@ -4663,16 +7708,16 @@ with tab_history:
                                 if record_id and delete_record_from_db(record_id):
                                     cleared_count += 1
                             if cleared_count > 0:
-                                fetch_user_history.clear()
+                                clear_user_history_cache()
                                 fetch_leaderboard.clear()
                                 st.toast(f"✅ 已清除 {cleared_count} 条导入记录", icon="✅")
                                 st.rerun()
-            else:
-                st.markdown(
-                    '<p style="text-align:center; color:#888; font-size:14px; padding:20px 0;">'
-                    '还没有识别记录，上传照片开始你的观鸟之旅吧 🐦</p>',
-                    unsafe_allow_html=True,
-                )
+        else:
+            st.markdown(
+                '<p style="text-align:center; color:#888; font-size:14px; padding:20px 0;">'
+                '还没有识别记录，上传照片开始你的观鸟之旅吧 🐦</p>',
+                unsafe_allow_html=True,
+            )
 
     else:
         st.info("📚 请先设置昵称，即可查看观鸟记录")
@@ -20,8 +20,9 @@ CREATE TABLE IF NOT EXISTS bird_records (
     identification_basis TEXT DEFAULT '',
     bird_description TEXT DEFAULT '',
     shoot_date TEXT DEFAULT '',
-    thumbnail_base64 TEXT DEFAULT '',
-    image_base64 TEXT DEFAULT '',
+    -- 图片存放在图片存储（本地 static/images 或 S3 兼容对象存储）中，这里只保存内容寻址的 key
+    thumbnail_key TEXT DEFAULT '',
+    image_key TEXT DEFAULT '',
     original_ai_name TEXT DEFAULT '',
     user_corrected_name TEXT DEFAULT '',
     shoot_city TEXT DEFAULT '',
@@ -31,12 +32,30 @@ CREATE TABLE IF NOT EXISTS bird_records (
 -- 新增 shoot_city 字段（已有数据库执行此语句）
 -- ALTER TABLE bird_records ADD COLUMN IF NOT EXISTS shoot_city TEXT DEFAULT '';
 
--- 索引：按用户查询历史记录
-CREATE INDEX IF NOT EXISTS idx_bird_records_user ON bird_records (user_nickname, created_at DESC);
+-- 图片移出数据库（已有数据库执行）：
+-- 1. 新增 key 字段
+-- ALTER TABLE bird_records ADD COLUMN IF NOT EXISTS thumbnail_key TEXT DEFAULT '';
+-- ALTER TABLE bird_records ADD COLUMN IF NOT EXISTS image_key TEXT DEFAULT '';
+-- 2. 配置对象存储（IMAGE_STORE=s3）并设置 BIRDEYE_MIGRATE_INLINE_IMAGES=1 启动应用，
+--    后台把旧的 base64 图片上传并回读校验后清空旧列（日志出现"[图片迁移] 完成"）；
+--    只用本地存储时不要迁移，旧列是图片唯一的持久副本，应用会直接读取旧列显示
+-- 3. 确认两个旧字段都已清空后再删除：
+--    SELECT count(*) FROM bird_records WHERE thumbnail_base64 <> '' OR image_base64 <> '';
+-- ALTER TABLE bird_records DROP COLUMN IF EXISTS thumbnail_base64;
+-- ALTER TABLE bird_records DROP COLUMN IF EXISTS image_base64;
+
+-- 索引：按用户查询历史记录（keyset 分页按 created_at DESC, id DESC 排序）
+CREATE INDEX IF NOT EXISTS idx_bird_records_user ON bird_records (user_nickname, created_at DESC, id DESC);
+-- 已有数据库执行以下语句重建索引：
+-- DROP INDEX IF EXISTS idx_bird_records_user;
+-- CREATE INDEX idx_bird_records_user ON bird_records (user_nickname, created_at DESC, id DESC);
 
 -- 索引：按鸟种统计
 CREATE INDEX IF NOT EXISTS idx_bird_records_species ON bird_records (chinese_name);
 
+-- 索引：删除 / 更正某鸟种的最高分记录时，触发器按 (用户, 鸟种) 重新取最高分
+CREATE INDEX IF NOT EXISTS idx_bird_records_user_species_score ON bird_records (user_nickname, chinese_name, score);
+
 -- 开启 RLS（行级安全策略）
 ALTER TABLE bird_records ENABLE ROW LEVEL SECURITY;
 
@@ -56,3 +75,263 @@ CREATE POLICY "允许所有人删除记录" ON bird_records
 DROP POLICY IF EXISTS "允许所有人更新记录" ON bird_records;
 CREATE POLICY "允许所有人更新记录" ON bird_records
     FOR UPDATE USING (true) WITH CHECK (true);
+
+-- ============================================================
+-- 统计聚合：触发器在每次插入 / 更新 / 删除记录时增量维护
+--   user_species_stats  每个 (用户, 鸟种) 一行，供排行榜、"新鸟种"判断使用
+--   user_stats          每个用户一行，供观鸟记录页头部统计、导入同步信息使用
+-- 排行榜与统计查询不再扫描 bird_records，应用端只读取少量聚合行。
+-- ============================================================
+
+CREATE TABLE IF NOT EXISTS user_species_stats (
+    user_nickname TEXT NOT NULL,
+    chinese_name TEXT NOT NULL,
+    english_name TEXT NOT NULL DEFAULT '',
+    record_count INTEGER NOT NULL DEFAULT 0,
+    imported_count INTEGER NOT NULL DEFAULT 0,
+    score_sum BIGINT NOT NULL DEFAULT 0,
+    score_count INTEGER NOT NULL DEFAULT 0,
+    best_score INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_nickname, chinese_name)
+);
+-- 已有 user_species_stats 表执行：
+-- ALTER TABLE user_species_stats ADD COLUMN IF NOT EXISTS english_name TEXT NOT NULL DEFAULT '';
+
+CREATE TABLE IF NOT EXISTS user_stats (
+    user_nickname TEXT PRIMARY KEY,
+    total_records INTEGER NOT NULL DEFAULT 0,
+    imported_records INTEGER NOT NULL DEFAULT 0,
+    species INTEGER NOT NULL DEFAULT 0,           -- 不含"未知鸟类"
+    imported_species INTEGER NOT NULL DEFAULT 0,
+    score_sum BIGINT NOT NULL DEFAULT 0,
+    score_count INTEGER NOT NULL DEFAULT 0,
+    best_score INTEGER NOT NULL DEFAULT 0,
+    last_import_at TIMESTAMPTZ,
+    updated_at TIMESTAMPTZ DEFAULT NOW()
+);
+
+-- 索引：排行榜按鸟种数、记录数取前 N 名
+CREATE INDEX IF NOT EXISTS idx_user_stats_rank ON user_stats (species DESC, total_records DESC);
+
+ALTER TABLE user_species_stats ENABLE ROW LEVEL SECURITY;
+ALTER TABLE user_stats ENABLE ROW LEVEL SECURITY;
+
+DROP POLICY IF EXISTS "允许所有人查询鸟种统计" ON user_species_stats;
+CREATE POLICY "允许所有人查询鸟种统计" ON user_species_stats
+    FOR SELECT USING (true);
+
+DROP POLICY IF EXISTS "允许所有人查询用户统计" ON user_stats;
+CREATE POLICY "允许所有人查询用户统计" ON user_stats
+    FOR SELECT USING (true);
+
+-- 由某个用户的 user_species_stats 全量汇总出 user_stats 行（只用于回填，触发器中按增量更新）
+CREATE OR REPLACE FUNCTION refresh_user_stats(p_user TEXT)
+RETURNS void
+LANGUAGE plpgsql SECURITY DEFINER SET search_path = public AS $$
+BEGIN
+    INSERT INTO user_stats AS u
+        (user_nickname, total_records, imported_records, species, imported_species,
+         score_sum, score_count, best_score, updated_at)
+    SELECT p_user,
+           COALESCE(sum(record_count), 0),
+           COALESCE(sum(imported_count), 0),
+           count(*) FILTER (WHERE chinese_name NOT IN ('', '未知鸟类')),
+           count(*) FILTER (WHERE imported_count > 0),
+           COALESCE(sum(score_sum), 0),
+           COALESCE(sum(score_count), 0),
+           COALESCE(max(best_score), 0),
+           NOW()
+    FROM user_species_stats
+    WHERE user_nickname = p_user
+    ON CONFLICT (user_nickname) DO UPDATE SET
+        total_records = EXCLUDED.total_records,
+        imported_records = EXCLUDED.imported_records,
+        species = EXCLUDED.species,
+        imported_species = EXCLUDED.imported_species,
+        score_sum = EXCLUDED.score_sum,
+        score_count = EXCLUDED.score_count,
+        best_score = EXCLUDED.best_score,
+        updated_at = EXCLUDED.updated_at;
+
+    DELETE FROM user_stats WHERE user_nickname = p_user AND total_records <= 0;
+END;
+$$;
+
+-- 把一条记录计入（p_sign = 1）或移出（p_sign = -1）两张聚合表，都只做带符号的增量更新；
+-- 评分为 0 的记录不参与平均分 / 最高分
+CREATE OR REPLACE FUNCTION bird_records_rollup_apply(p_user TEXT, p_name TEXT, p_score INTEGER,
+                                                     p_confidence TEXT, p_sign INTEGER)
+RETURNS void
+LANGUAGE plpgsql SECURITY DEFINER SET search_path = public AS $$
+DECLARE
+    v_score INTEGER := GREATEST(COALESCE(p_score, 0), 0);
+    v_imported INTEGER := CASE WHEN p_confidence = 'imported' THEN p_sign ELSE 0 END;
+    v_record_count INTEGER;
+    v_imported_count INTEGER;
+    v_species_delta INTEGER := 0;
+    v_imported_species_delta INTEGER := 0;
+BEGIN
+    INSERT INTO user_species_stats AS s
+        (user_nickname, chinese_name, record_count, imported_count, score_sum, score_count, best_score)
+    VALUES (
+        p_user, p_name, p_sign, v_imported,
+        p_sign * v_score,
+        CASE WHEN v_score > 0 THEN p_sign ELSE 0 END,
+        v_score
+    )
+    ON CONFLICT (user_nickname, chinese_name) DO UPDATE SET
+        record_count = s.record_count + EXCLUDED.record_count,
+        imported_count = s.imported_count + EXCLUDED.imported_count,
+        score_sum = s.score_sum + EXCLUDED.score_sum,
+        score_count = s.score_count + EXCLUDED.score_count,
+        best_score = CASE WHEN p_sign > 0 THEN GREATEST(s.best_score, EXCLUDED.best_score)
+                          ELSE s.best_score END
+    RETURNING record_count, imported_count INTO v_record_count, v_imported_count;
+
+    -- 鸟种数只在该鸟种的第一条记录计入 / 最后一条记录移出时变化
+    IF p_name NOT IN ('', '未知鸟类') THEN
+        IF p_sign > 0 AND v_record_count = 1 THEN
+            v_species_delta := 1;
+        ELSIF p_sign < 0 AND v_record_count <= 0 THEN
+            v_species_delta := -1;
+        END IF;
+    END IF;
+    IF v_imported > 0 AND v_imported_count = 1 THEN
+        v_imported_species_delta := 1;
+    ELSIF v_imported < 0 AND v_imported_count <= 0 THEN
+        v_imported_species_delta := -1;
+    END IF;
+
+    IF p_sign < 0 THEN
+        DELETE FROM user_species_stats
+        WHERE user_nickname = p_user AND chinese_name = p_name AND record_count <= 0;
+        -- 最高分无法做减法：移出的正是最高分时，从该用户该鸟种的记录中重新取最大值
+        IF v_score > 0 THEN
+            UPDATE user_species_stats
+            SET best_score = COALESCE((SELECT max(score) FROM bird_records
+                                       WHERE user_nickname = p_user AND chinese_name = p_name), 0)
+            WHERE user_nickname = p_user AND chinese_name = p_name AND best_score <= v_score;
+        END IF;
+    END IF;
+
+    INSERT INTO user_stats AS u
+        (user_nickname, total_records, imported_records, species, imported_species,
+         score_sum, score_count, best_score, updated_at)
+    VALUES (
+        p_user, p_sign, v_imported, v_species_delta, v_imported_species_delta,
+        p_sign * v_score,
+        CASE WHEN v_score > 0 THEN p_sign ELSE 0 END,
+        v_score,
+        NOW()
+    )
+    ON CONFLICT (user_nickname) DO UPDATE SET
+        total_records = u.total_records + EXCLUDED.total_records,
+        imported_records = u.imported_records + EXCLUDED.imported_records,
+        species = u.species + EXCLUDED.species,
+        imported_species = u.imported_species + EXCLUDED.imported_species,
+        score_sum = u.score_sum + EXCLUDED.score_sum,
+        score_count = u.score_count + EXCLUDED.score_count,
+        best_score = CASE WHEN p_sign > 0 THEN GREATEST(u.best_score, EXCLUDED.best_score)
+                          ELSE u.best_score END,
+        updated_at = EXCLUDED.updated_at;
+
+    IF p_sign < 0 THEN
+        DELETE FROM user_stats WHERE user_nickname = p_user AND total_records <= 0;
+        -- 同理，移出用户最高分时才从该用户的鸟种聚合行中重新取最大值
+        IF v_score > 0 THEN
+            UPDATE user_stats
+            SET best_score = COALESCE((SELECT max(best_score) FROM user_species_stats
+                                       WHERE user_nickname = p_user), 0)
+            WHERE user_nickname = p_user AND best_score <= v_score;
+        END IF;
+    END IF;
+END;
+$$;
+
+CREATE OR REPLACE FUNCTION bird_records_rollup()
+RETURNS trigger
+LANGUAGE plpgsql SECURITY DEFINER SET search_path = public AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        PERFORM bird_records_rollup_apply(OLD.user_nickname, OLD.chinese_name, OLD.score, OLD.confidence, -1);
+        -- 移出的正是最后一次导入时才重新查找（按 idx_bird_records_user 倒序找到第一条导入记录即可）
+        IF OLD.confidence = 'imported' THEN
+            UPDATE user_stats SET last_import_at = (
+                SELECT max(created_at) FROM bird_records
+                WHERE user_nickname = OLD.user_nickname AND confidence = 'imported'
+            )
+            WHERE user_nickname = OLD.user_nickname AND last_import_at <= OLD.created_at;
+        END IF;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        PERFORM bird_records_rollup_apply(NEW.user_nickname, NEW.chinese_name, NEW.score, NEW.confidence, 1);
+        IF COALESCE(NEW.english_name, '') <> '' THEN
+            UPDATE user_species_stats SET english_name = NEW.english_name
+            WHERE user_nickname = NEW.user_nickname AND chinese_name = NEW.chinese_name
+              AND english_name <> NEW.english_name;
+        END IF;
+        IF NEW.confidence = 'imported' THEN
+            UPDATE user_stats SET last_import_at = GREATEST(last_import_at, NEW.created_at)
+            WHERE user_nickname = NEW.user_nickname;
+        END IF;
+    END IF;
+    RETURN NULL;
+END;
+$$;
+
+-- 以上三个函数以表所有者身份运行，只供触发器和回填使用：
+-- 收回 PostgREST 角色的执行权限，避免通过 /rest/v1/rpc/ 直接调用篡改统计
+REVOKE EXECUTE ON FUNCTION refresh_user_stats(TEXT) FROM PUBLIC, anon, authenticated;
+REVOKE EXECUTE ON FUNCTION bird_records_rollup_apply(TEXT, TEXT, INTEGER, TEXT, INTEGER) FROM PUBLIC, anon, authenticated;
+REVOKE EXECUTE ON FUNCTION bird_records_rollup() FROM PUBLIC, anon, authenticated;
+
+DROP TRIGGER IF EXISTS trg_bird_records_rollup ON bird_records;
+CREATE TRIGGER trg_bird_records_rollup
+    AFTER INSERT OR DELETE OR UPDATE OF user_nickname, chinese_name, english_name, score, confidence
+    ON bird_records
+    FOR EACH ROW EXECUTE FUNCTION bird_records_rollup();
+
+-- 回填已有数据（首次创建聚合表时执行一次；重复执行会用全量结果覆盖）
+INSERT INTO user_species_stats
+    (user_nickname, chinese_name, english_name, record_count, imported_count, score_sum, score_count, best_score)
+SELECT user_nickname, chinese_name,
+       COALESCE(max(english_name), ''),
+       count(*),
+       count(*) FILTER (WHERE confidence = 'imported'),
+       COALESCE(sum(score) FILTER (WHERE score > 0), 0),
+       count(*) FILTER (WHERE score > 0),
+       COALESCE(max(score) FILTER (WHERE score > 0), 0)
+FROM bird_records
+GROUP BY user_nickname, chinese_name
+ON CONFLICT (user_nickname, chinese_name) DO UPDATE SET
+    english_name = EXCLUDED.english_name,
+    record_count = EXCLUDED.record_count,
+    imported_count = EXCLUDED.imported_count,
+    score_sum = EXCLUDED.score_sum,
+    score_count = EXCLUDED.score_count,
+    best_score = EXCLUDED.best_score;
+
+SELECT refresh_user_stats(user_nickname) FROM (SELECT DISTINCT user_nickname FROM user_species_stats) AS users;
+
+UPDATE user_stats SET last_import_at = imported.last_import_at
+FROM (
+    SELECT user_nickname, max(created_at) AS last_import_at
+    FROM bird_records WHERE confidence = 'imported'
+    GROUP BY user_nickname
+) AS imported
+WHERE user_stats.user_nickname = imported.user_nickname;
+
+-- 排行榜：鸟种数（不含"未知鸟类"）> 记录数 > 平均分，直接读取 user_stats 的前 N 行
+CREATE OR REPLACE FUNCTION get_leaderboard(limit_count INTEGER DEFAULT 20)
+RETURNS TABLE (nickname TEXT, species BIGINT, total BIGINT, avg_score NUMERIC, best_score INTEGER)
+LANGUAGE sql STABLE AS $$
+    SELECT u.user_nickname,
+           u.species::BIGINT,
+           u.total_records::BIGINT,
+           COALESCE(round(u.score_sum::NUMERIC / NULLIF(u.score_count, 0), 1), 0),
+           u.best_score
+    FROM user_stats AS u
+    WHERE u.user_nickname <> ''
+    ORDER BY u.species DESC, u.total_records DESC, 4 DESC
+    LIMIT limit_count;
+$$;
@@ -0,0 +1,495 @@
+"""测试公共夹具：app.py 是 Streamlit 脚本，在 bare 模式下整体执行一次，取出其中的函数和类。"""
+import base64
+import binascii
+import json
+import logging
+import os
+import runpy
+import tempfile
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import pytest
+
+APP_PATH = Path(__file__).resolve().parent.parent / "app.py"
+
+
+@pytest.fixture(scope="session")
+def app():
+    """执行 app.py 并返回函数所在的全局命名空间（修改它会影响 app 中的函数）"""
+    os.environ.setdefault("DASHSCOPE_API_KEY", "sk-test")
+    os.environ.setdefault("BIRDEYE_CACHE_DIR", tempfile.mkdtemp(prefix="birdeye-test-"))
+    logging.disable(logging.WARNING)  # bare 模式下 Streamlit 的 ScriptRunContext 警告
+    try:
+        namespace = runpy.run_path(str(APP_PATH), run_name="birdeye_app")
+    finally:
+        logging.disable(logging.NOTSET)
+    # run_path 返回的是副本，取函数真正引用的全局字典
+    return namespace["resilient_chat_completion"].__globals__
+
+
+def _completion_body(content: str) -> bytes:
+    return json.dumps({
+        "id": "chatcmpl-test",
+        "object": "chat.completion",
+        "created": 0,
+        "model": "fake",
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": content},
+            "finish_reason": "stop",
+        }],
+        "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2},
+    }).encode("utf-8")
+
+
+class FakeOpenAIServer:
+    """进程内的 OpenAI 兼容 /chat/completions 假服务。
+
+    按请求到达顺序依次取 script 中的动作：
+      ("ok", 内容)            立即返回 200
+      ("status", 状态码)       返回错误状态码
+      ("delay", 秒数, 内容)    等待后返回 200（用于超时和对冲）
+    script 用完后一律返回 ("ok", "default")。connections 记录建立过的 TCP 连接数。
+    """
+
+    def __init__(self):
+        self.script = []
+        self.requests = 0
+        self.connections = 0
+        self._lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True  # 头和正文分两次写，避免 Nagle + 延迟 ACK 的 40ms 停顿
+
+            def log_message(self, *args):
+                pass
+
+            def setup(self):
+                super().setup()
+                with server._lock:
+                    server.connections += 1
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                with server._lock:
+                    server.requests += 1
+                    action = server.script.pop(0) if server.script else ("ok", "default")
+                if action[0] == "status":
+                    body = json.dumps({"error": {"message": "fake error", "type": "fake"}}).encode()
+                    self._send(action[1], body)
+                    return
+                if action[0] == "delay":
+                    threading.Event().wait(action[1])
+                self._send(200, _completion_body(action[-1]))
+
+            def _send(self, status, body):
+                try:
+                    self.send_response(status)
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass  # 客户端已取消（对冲落败 / 超时）
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        self.base_url = f"http://127.0.0.1:{self.httpd.server_port}/v1"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture
+def fake_server():
+    server = FakeOpenAIServer()
+    yield server
+    server.close()
+
+
+class FakeVisionModel:
+    """进程内的假视觉模型（OpenAI 兼容 /chat/completions，支持 stream=True 的 SSE 输出）。
+
+    按 prompt 判断调用类型并生成对应的 JSON：单张识别（有无介绍字段由任务说明决定）、
+    批量识别 {"results": [...]}、只评分、纯文本鸟种介绍。图片内容为 b"photo-N" 时识别为
+    SPECIES[N % len(SPECIES)]，便于构造不同鸟种。
+    token 按字符数近似：输入 = 全部文本字符 + 每张图片 IMAGE_TOKENS；输出 = 返回内容字符数。
+    延迟 = request_overhead + 输出字符数 × seconds_per_output_token，模拟生成时间随输出长度增长；
+    流式请求按生成进度逐块发送（chunked），先生成的字段先到达。
+    batch_mode: "ok" 正常；"drop_last" 少返回最后一张；"broken" 返回无法解析的文本。
+    calls 记录每次调用的 {"kind", "images", "prompt_tokens", "completion_tokens"}。
+    """
+
+    SPECIES = ("白头鹎", "麻雀", "喜鹊", "白鹭", "珠颈斑鸠", "乌鸫", "红嘴蓝鹊", "八哥", "戴胜", "普通翠鸟")
+    IMAGE_TOKENS = 1000
+
+    def __init__(self, request_overhead: float = 0.01, seconds_per_output_token: float = 0.0001):
+        self.request_overhead = request_overhead
+        self.seconds_per_output_token = seconds_per_output_token
+        self.batch_mode = "ok"
+        self.calls = []
+        self._lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                content, usage = server._respond(request)
+                try:
+                    if request.get("stream"):
+                        self._stream(content, usage)
+                    else:
+                        self._complete(content, usage)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass  # 客户端提前结束流式接收
+
+            def _complete(self, content: str, usage: dict) -> None:
+                threading.Event().wait(
+                    server.request_overhead + usage["completion_tokens"] * server.seconds_per_output_token
+                )
+                body = json.dumps({
+                    "id": "chatcmpl-vision", "object": "chat.completion", "created": 0, "model": "fake",
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": content},
+                                 "finish_reason": "stop"}],
+                    "usage": usage,
+                }, ensure_ascii=False).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _stream(self, content: str, usage: dict) -> None:
+                threading.Event().wait(server.request_overhead)
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                for event, characters in server._sse_events(content, usage):
+                    threading.Event().wait(characters * server.seconds_per_output_token)
+                    self.wfile.write(f"{len(event):x}\r\n".encode() + event + b"\r\n")
+                self.wfile.write(b"0\r\n\r\n")
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        self.base_url = f"http://127.0.0.1:{self.httpd.server_port}/v1"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def _species_for(self, url: str) -> str:
+        try:
+            data = base64.b64decode(url.split(",", 1)[-1])
+        except (ValueError, binascii.Error):
+            data = b""
+        if data.startswith(b"photo-") and data[6:].isdigit():
+            return self.SPECIES[int(data[6:]) % len(self.SPECIES)]
+        return self.SPECIES[0]
+
+    @staticmethod
+    def _identify_object(species: str, detail: bool) -> dict:
+        result = {
+            "chinese_name": species,
+            "english_name": "",
+            "confidence": "high",
+            "candidates": [
+                {"chinese_name": species, "english_name": "", "similarity": 88, "reason": "整体羽色与体型吻合"},
+                {"chinese_name": "白头鹎" if species != "白头鹎" else "麻雀", "english_name": "",
+                 "similarity": 35, "reason": "体型相近但羽色不符"},
+            ],
+            "bird_bbox": [30, 25, 62, 70],
+        }
+        if detail:
+            result["identification_basis"] = f"头部和背部羽色符合{species}，排除体型相近的其他候选种"
+            result["excluded_similar_species"] = "排除易混淆种：关键部位羽色不符"
+        result.update({
+            "score": 70, "score_sharpness": 14, "score_composition": 12, "score_lighting": 12,
+            "score_background": 11, "score_pose": 11, "score_artistry": 10,
+            "score_comment": "主体清晰，背景略杂",
+            "order_chinese": "雀形目", "order_english": "Passeriformes",
+            "family_chinese": "鹎科", "family_english": "Pycnonotidae",
+        })
+        if detail:
+            result["bird_description"] = (
+                f"{species}是中国常见的鸟类，体型中等，羽色层次分明。常见于城市公园、农田、林缘和灌丛，"
+                "多成对或集小群活动，性情活泼，鸣声响亮多变。以昆虫和植物果实为食，繁殖期筑杯状巢于"
+                "灌丛或树枝间。分布广泛，是观鸟入门的常见种类之一，四季均可观察。"
+            )
+        return result
+
+    def _respond(self, request: dict) -> tuple:
+        system = ""
+        texts, images = [], []
+        for message in request.get("messages", []):
+            parts = message.get("content")
+            if isinstance(parts, str):
+                if message.get("role") == "system":
+                    system = parts
+                else:
+                    texts.append(parts)
+                continue
+            for part in parts or []:
+                if part.get("type") == "text":
+                    texts.append(part["text"])
+                elif part.get("type") == "image_url":
+                    images.append(part["image_url"]["url"])
+        task = texts[0] if texts else ""
+        detail = '"bird_description"' in task
+        if not images:
+            kind = "detail"
+            content = json.dumps({
+                "bird_description": self._identify_object("白头鹎", True)["bird_description"],
+                "identification_basis": "头顶黑色，枕部白斑明显",
+            }, ensure_ascii=False)
+        elif "无需识别鸟种" in task:
+            kind = "score-only"
+            full = self._identify_object(self.SPECIES[0], False)
+            content = json.dumps({key: full[key] for key in full if key.startswith("score_") or key == "bird_bbox"},
+                                 ensure_ascii=False)
+        elif '"results"' in task:
+            kind = "batch"
+            results = [dict(image_index=number, **self._identify_object(self._species_for(url), detail))
+                       for number, url in enumerate(images, 1)]
+            if self.batch_mode == "drop_last":
+                results = results[:-1]
+            content = ("抱歉，这批照片我无法逐张给出结果。" if self.batch_mode == "broken"
+                       else "```json\n" + json.dumps({"results": results}, ensure_ascii=False, indent=2) + "\n```")
+        else:
+            kind = "identify"
+            content = "```json\n" + json.dumps(self._identify_object(self._species_for(images[0]), detail),
+                                                ensure_ascii=False, indent=2) + "\n```"
+        usage = {
+            "prompt_tokens": len(system) + sum(len(text) for text in texts) + self.IMAGE_TOKENS * len(images),
+            "completion_tokens": len(content),
+        }
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        with self._lock:
+            self.calls.append({"kind": kind, "detail": detail, "images": len(images), **usage})
+        return content, usage
+
+    @staticmethod
+    def _sse_events(content: str, usage: dict):
+        """SSE 事件（字节）和每个事件包含的输出字符数"""
+        for start in range(0, len(content), 16):
+            delta = content[start:start + 16]
+            event = {
+                "id": "chatcmpl-vision", "object": "chat.completion.chunk", "created": 0, "model": "fake",
+                "choices": [{"index": 0, "delta": {"content": delta}, "finish_reason": None}],
+            }
+            yield f"data: {json.dumps(event, ensure_ascii=False)}\n\n".encode("utf-8"), len(delta)
+        event = {"id": "chatcmpl-vision", "object": "chat.completion.chunk", "created": 0, "model": "fake",
+                 "choices": [], "usage": usage}
+        yield f"data: {json.dumps(event, ensure_ascii=False)}\n\n".encode("utf-8"), 0
+        yield b"data: [DONE]\n\n", 0
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture
+def vision_model():
+    server = FakeVisionModel()
+    yield server
+    server.close()
+
+
+@pytest.fixture
+def ai_harness(app, monkeypatch, vision_model, tmp_path):
+    """把识别流程接到假视觉模型上：独立的本地缓存库、宽松的限流器、清空的 AI 调用统计"""
+    import openai
+
+    monkeypatch.setitem(app, "LOCAL_CACHE_DIR", tmp_path)
+    monkeypatch.setitem(app, "LOCAL_CACHE_DB", tmp_path / "birdeye_cache.sqlite3")
+    limiter = app["AdaptiveRateLimiter"](rate=1000.0, burst=100, initial_limit=4, min_limit=1, max_limit=8)
+    monkeypatch.setitem(app, "get_ai_rate_limiter", lambda: limiter)
+    monkeypatch.setitem(app, "get_async_ai_client", lambda api_key, base_url=None: openai.AsyncOpenAI(
+        api_key=api_key, base_url=vision_model.base_url, max_retries=0,
+    ))
+    app["get_ai_call_stats"]()["tiers"].clear()
+    return vision_model
+
+
+def _coerce(value: str, like):
+    """把查询串中的值转成与列值相同的类型再比较"""
+    if isinstance(like, bool):
+        return value == "true"
+    if isinstance(like, (int, float)):
+        try:
+            return type(like)(value)
+        except ValueError:
+            return value
+    return value
+
+
+def _match(row: dict, column: str, expr: str) -> bool:
+    """PostgREST 过滤表达式的最小实现：eq / neq / gt / gte / lt / lte / is / in"""
+    op, _, value = expr.partition(".")
+    cell = row.get(column)
+    if op == "is":
+        return cell is None if value == "null" else cell == (value == "true")
+    if op == "in":
+        options = [v.strip('"') for v in value.strip("()").split(",")]
+        return str(cell) in options
+    if cell is None:
+        return False
+    value = _coerce(value, cell)
+    return {
+        "eq": cell == value, "neq": cell != value,
+        "gt": cell > value, "gte": cell >= value,
+        "lt": cell < value, "lte": cell <= value,
+    }[op]
+
+
+def _split_or(expr: str) -> list:
+    """or=(a.eq.1,b.neq.) → [("a", "eq.1"), ("b", "neq.")]"""
+    conditions = []
+    for part in expr.strip("()").split(","):
+        column, _, rest = part.partition(".")
+        conditions.append((column, rest))
+    return conditions
+
+
+class FakePostgREST:
+    """进程内的 PostgREST（Supabase /rest/v1）假服务，数据保存在内存中。
+
+    tables: {表名: [行 dict]}，支持 select / 过滤 / or / order / limit 的 GET、POST 插入、
+    PATCH 和 DELETE；rpc: {函数名: callable(body) -> JSON}。
+    fail_next 中的状态码按顺序用于接下来的请求（模拟网关错误）。
+    requests 记录 (方法, 路径, 查询串)，connections 记录建立过的 TCP 连接数。
+    """
+
+    def __init__(self):
+        self.tables = {}
+        self.rpc = {}
+        self.fail_next = []
+        self.requests = []
+        self.connections = 0
+        self._lock = threading.Lock()
+        self._next_id = 1
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True  # 头和正文分两次写，避免 Nagle + 延迟 ACK 的 40ms 停顿
+
+            def log_message(self, *args):
+                pass
+
+            def setup(self):
+                super().setup()
+                with server._lock:
+                    server.connections += 1
+
+            def _handle(self):
+                url = urllib.parse.urlsplit(self.path)
+                length = int(self.headers.get("Content-Length", 0))
+                body = json.loads(self.rfile.read(length)) if length else None
+                with server._lock:
+                    server.requests.append((self.command, url.path, url.query))
+                    status = server.fail_next.pop(0) if server.fail_next else None
+                if status:
+                    self._send(status, {"message": "fake failure"})
+                    return
+                name = url.path.split("/rest/v1/", 1)[-1]
+                params = urllib.parse.parse_qsl(url.query, keep_blank_values=True)
+                with server._lock:
+                    status, payload = server._dispatch(self.command, name, params, body)
+                self._send(status, payload)
+
+            do_GET = do_POST = do_PATCH = do_DELETE = _handle
+
+            def _send(self, status, payload):
+                data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        self.base_url = f"http://127.0.0.1:{self.httpd.server_port}"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def _dispatch(self, method, name, params, body):
+        if name.startswith("rpc/"):
+            handler = self.rpc.get(name[4:])
+            if handler is None:
+                return 404, {"message": f"function {name[4:]} not found"}
+            return 200, handler(body or {})
+        rows = self.tables.setdefault(name, [])
+        if method == "POST":
+            inserted = []
+            for row in body if isinstance(body, list) else [body]:
+                row = {"id": self._next_id, **row}
+                self._next_id += 1
+                rows.append(row)
+                inserted.append(row)
+            return 201, inserted
+
+        select, order, limit, filters = None, None, None, []
+        for key, value in params:
+            if key == "select":
+                select = value.split(",")
+            elif key == "order":
+                order = value
+            elif key == "limit":
+                limit = int(value)
+            elif key == "or":
+                filters.append(_split_or(value))
+            else:
+                filters.append([(key, value)])
+        for conditions in filters:
+            for column, _ in conditions:
+                if column not in ("id",) and rows and all(column not in row for row in rows):
+                    return 400, {"message": f"column {column} does not exist"}
+        matched = [
+            row for row in rows
+            if all(any(_match(row, column, expr) for column, expr in conditions) for conditions in filters)
+        ]
+        if method == "PATCH":
+            for row in matched:
+                row.update(body)
+            return 200, matched
+        if method == "DELETE":
+            self.tables[name] = [row for row in rows if row not in matched]
+            return 200, matched
+        if order:
+            for part in reversed(order.split(",")):
+                column, _, direction = part.partition(".")
+                matched.sort(key=lambda row: (row.get(column) is None, row.get(column)),
+                             reverse=direction == "desc")
+        if limit is not None:
+            matched = matched[:limit]
+        if select and select != ["*"]:
+            for column in select:
+                if rows and all(column not in row for row in rows):
+                    return 400, {"message": f"column {column} does not exist"}
+            matched = [{column: row.get(column) for column in select} for row in matched]
+        return 200, matched
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture
+def fake_postgrest(app, monkeypatch):
+    """假 PostgREST 服务，并把 app 的 Supabase 配置指向它"""
+    server = FakePostgREST()
+    monkeypatch.setitem(app, "_SUPABASE_URL_CACHE", server.base_url)
+    monkeypatch.setitem(app, "_SUPABASE_KEY_CACHE", "test-key")
+    yield server
+    server.close()
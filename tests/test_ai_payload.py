@@ -0,0 +1,26 @@
+"""发送给 AI 的图片尺寸策略：二次识别的裁剪图尺寸由首轮 bird_bbox 的面积决定，
+以及 AI 调用统计中与图片大小并列的识别准确度（高置信度率、平均最高相似度）。
+"""
+import asyncio
+import base64
+
+
+def test_payload_size_follows_first_pass_bbox(app):
+    size = app["ImageContext"].ai_payload_size
+    assert size() == size(None) == app["AI_IMAGE_MAX_SIZE"]
+    assert size([10, 10, 60, 70]) == app["AI_IMAGE_MAX_SIZE"]      # 占画面 30%
+    assert size([40, 40, 50, 50]) == app["AI_IMAGE_DETAIL_MAX_SIZE"]  # 占画面 1%
+    assert size([50, 50, 40, 40]) == app["AI_IMAGE_MAX_SIZE"]      # 无效坐标
+    assert app["bbox_area_fraction"]([-10, 0, 20, 110]) == 0.2     # 超出画面的部分不计
+    assert app["AI_IMAGE_QUALITY"] == 85
+
+
+def test_accuracy_is_recorded_next_to_payload_bytes(app, ai_harness):
+    image = app["DATA_URL_PREFIX"] + base64.b64encode(b"photo-accuracy").decode()
+    result = asyncio.run(app["identify_bird_async"](image, "sk-test", {}, tier="fast"))
+    assert result["chinese_name"]
+
+    row = next(row for row in app["ai_call_stats_summary"]() if row["档位"] == "identify-fast")
+    assert row["每张图片 KB"] >= 0
+    assert row["高置信度率"] == "100%"
+    assert row["平均最高相似度"] == 88
@@ -0,0 +1,86 @@
+"""resilient_chat_completion 的重试和对冲策略（对进程内的假 OpenAI 服务发请求）"""
+import asyncio
+import time
+
+import openai
+import pytest
+
+
+@pytest.fixture
+def resilience(app, monkeypatch):
+    """每个用例使用独立的限流器，并把退避 / 对冲时间缩短到毫秒级"""
+    limiter = app["AdaptiveRateLimiter"](rate=100.0, burst=10, initial_limit=4, min_limit=1, max_limit=8)
+    monkeypatch.setitem(app, "get_ai_rate_limiter", lambda: limiter)
+    monkeypatch.setitem(app, "AI_RETRY_MAX_ATTEMPTS", 3)
+    monkeypatch.setitem(app, "AI_RETRY_BASE_DELAY", 0.01)
+    monkeypatch.setitem(app, "AI_RETRY_MAX_DELAY", 0.05)
+    monkeypatch.setitem(app, "AI_HEDGE_ENABLED", True)
+    monkeypatch.setitem(app, "AI_HEDGE_MIN_DELAY", 0.1)
+    return limiter
+
+
+def _call(app, server, timeout=5.0):
+    async def _run():
+        client = openai.AsyncOpenAI(api_key="sk-test", base_url=server.base_url,
+                                    max_retries=0, timeout=timeout)
+        try:
+            response = await app["resilient_chat_completion"](
+                client, model="fake", messages=[{"role": "user", "content": "hi"}],
+            )
+            return response.choices[0].message.content
+        finally:
+            await client.close()
+    return asyncio.run(_run())
+
+
+@pytest.mark.parametrize("status", [429, 500, 503])
+def test_retries_on_throttling_and_server_errors(app, resilience, fake_server, status):
+    fake_server.script = [("status", status), ("ok", "recovered")]
+    assert _call(app, fake_server) == "recovered"
+    assert fake_server.requests == 2
+    assert resilience.metrics()["backoff_count"] == 1
+
+
+def test_retries_on_timeout(app, resilience, fake_server):
+    fake_server.script = [("delay", 1.0, "too late"), ("ok", "recovered")]
+    assert _call(app, fake_server, timeout=0.3) == "recovered"
+    assert fake_server.requests == 2
+
+
+@pytest.mark.parametrize("status", [400, 401, 404])
+def test_does_not_retry_client_errors(app, resilience, fake_server, status):
+    fake_server.script = [("status", status)]
+    with pytest.raises(openai.APIStatusError) as excinfo:
+        _call(app, fake_server)
+    assert excinfo.value.status_code == status
+    assert fake_server.requests == 1
+    assert resilience.metrics()["backoff_count"] == 0
+
+
+def test_gives_up_after_max_attempts(app, resilience, fake_server):
+    fake_server.script = [("status", 503)] * 5
+    with pytest.raises(openai.InternalServerError):
+        _call(app, fake_server)
+    assert fake_server.requests == 3
+
+
+def test_no_hedge_without_latency_history(app, resilience, fake_server):
+    fake_server.script = [("delay", 0.3, "slow")]
+    assert _call(app, fake_server) == "slow"
+    assert fake_server.requests == 1
+
+
+def test_hedge_fires_after_p95_and_cancels_loser(app, resilience, fake_server):
+    # 历史延迟 p95 约 0.05s，对冲阈值取 AI_HEDGE_MIN_DELAY（0.1s）
+    for _ in range(app["AI_HEDGE_MIN_SAMPLES"]):
+        resilience._latencies.append(0.05)
+    fake_server.script = [("delay", 3.0, "slow"), ("ok", "hedged")]
+
+    started = time.monotonic()
+    assert _call(app, fake_server) == "hedged"
+    elapsed = time.monotonic() - started
+
+    assert fake_server.requests == 2
+    # 没有等慢请求返回；落败的请求被取消并归还了并发名额
+    assert elapsed < 1.5
+    assert resilience.metrics()["in_flight"] == 0
@@ -0,0 +1,53 @@
+"""连拍相似帧聚类：画面相似之外还要求同一台相机、拍摄时间相近"""
+import io
+
+import pytest
+from PIL import Image
+
+HASH = 0x0F0F_F0F0_0F0F_F0F0
+NEAR = HASH ^ 0b111  # 汉明距离 3
+FAR = ~HASH & (2 ** 64 - 1)
+
+
+@pytest.mark.parametrize("hashes, times, cameras, expected", [
+    # 同一台相机、1 秒内、画面相似：并入同一序列
+    ([HASH, NEAR, HASH], [100.0, 101.0, 102.0], ["Canon EOS R5"] * 3, [0, 0, 0]),
+    # 画面不同
+    ([HASH, FAR], [100.0, 100.5], ["Canon EOS R5"] * 2, [0, 1]),
+    # 时间间隔过长（很可能换了一只鸟）
+    ([HASH, NEAR], [100.0, 160.0], ["Canon EOS R5"] * 2, [0, 1]),
+    # 两台相机同时拍到相似画面
+    ([HASH, NEAR], [100.0, 100.0], ["Canon EOS R5", "Nikon Z 9"], [0, 1]),
+    # 缺少拍摄时间或相机型号：不聚类，宁可重新识别
+    ([HASH, NEAR], [100.0, None], ["Canon EOS R5"] * 2, [0, 1]),
+    ([HASH, NEAR], [None, None], ["Canon EOS R5"] * 2, [0, 1]),
+    ([HASH, NEAR], [100.0, 100.0], ["", ""], [0, 1]),
+    # 解码失败
+    ([None, None], [100.0, 100.0], ["Canon EOS R5"] * 2, [0, 1]),
+])
+def test_cluster_rules(app, hashes, times, cameras, expected):
+    assert app["cluster_burst_frames"](hashes, times, cameras) == expected
+
+
+def test_long_burst_chains_by_neighbouring_frames(app):
+    # 连续 10 秒的连拍：相邻帧间隔 1 秒，序列跨度超过 BURST_MAX_INTERVAL 也不断开
+    times = [100.0 + second for second in range(10)]
+    assert app["cluster_burst_frames"]([HASH] * 10, times, ["Sony ILCE-1"] * 10) == [0] * 10
+
+
+def _jpeg_with_exif(when: str, make: str, model: str) -> bytes:
+    image = Image.new("RGB", (64, 48), (120, 140, 90))
+    exif = Image.Exif()
+    exif[271], exif[272], exif[306] = make, model, when
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", exif=exif)
+    return buffer.getvalue()
+
+
+def test_exif_provides_seconds_and_camera(app):
+    ctx = app["ImageContext"](_jpeg_with_exif("2024:05:01 07:30:15", "Canon", "Canon EOS R5"), "a.jpg")
+    info = ctx.exif_info()
+    other = app["ImageContext"](_jpeg_with_exif("2024:05:01 07:30:17", "Canon", "Canon EOS R5"), "b.jpg").exif_info()
+    assert info["camera"] == "Canon EOS R5"
+    assert info["shoot_time"] == "20240501_0730"
+    assert other["shoot_timestamp"] - info["shoot_timestamp"] == 2.0
@@ -0,0 +1,101 @@
+"""基准：大尺寸 JPEG 的 DCT 域缩放解码（draft）与完整解码对比墙钟时间和峰值 RSS。
+
+每条路径在 fork 出的子进程中执行，峰值 RSS 取子进程 VmHWM 相对开始时 VmRSS 的增量，
+互不干扰。用 pytest -s 可看到实测数字。
+"""
+import io
+import multiprocessing
+import sys
+import time
+from pathlib import Path
+
+import pytest
+from PIL import Image
+
+pytestmark = pytest.mark.skipif(not Path("/proc/self/status").exists() or sys.platform != "linux",
+                                reason="峰值 RSS 读取 /proc，仅支持 Linux")
+
+CAMERA_SIZE = (6000, 4000)  # 2400 万像素
+
+
+@pytest.fixture(scope="module")
+def camera_jpeg():
+    """带纹理的 2400 万像素 JPEG（纯色图的解码开销不具代表性）"""
+    noise = Image.effect_noise((CAMERA_SIZE[0] // 4, CAMERA_SIZE[1] // 4), 40)
+    gradient = Image.linear_gradient("L").resize(noise.size)
+    image = Image.merge("RGB", (noise, gradient, noise.transpose(Image.FLIP_LEFT_RIGHT)))
+    image = image.resize(CAMERA_SIZE, Image.BICUBIC)
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=90)
+    return buffer.getvalue()
+
+
+def _rss_kb(field: str) -> int:
+    for line in Path("/proc/self/status").read_text().splitlines():
+        if line.startswith(field + ":"):
+            return int(line.split()[1])
+    return 0
+
+
+def _measure(work) -> tuple:
+    """在子进程中执行 work()，返回 (墙钟秒数, 峰值 RSS 增量 MB)"""
+    context = multiprocessing.get_context("fork")
+    receiver, sender = context.Pipe(duplex=False)
+
+    def run():
+        baseline = _rss_kb("VmRSS")
+        started = time.perf_counter()
+        work()
+        sender.send((time.perf_counter() - started, (_rss_kb("VmHWM") - baseline) / 1024))
+
+    process = context.Process(target=run)
+    process.start()
+    result = receiver.recv()
+    process.join()
+    return result
+
+
+def test_draft_decode_beats_full_decode(app, camera_jpeg):
+    def renditions(decode_max_size):
+        def work():
+            # 流水线对每张照片派生的全部产物：AI 载荷、存储缩略图、卡片预览图
+            ctx = app["ImageContext"](camera_jpeg, "camera.jpg", decode_max_size=decode_max_size)
+            assert ctx.ai_data_url(app["AI_IMAGE_MAX_SIZE"])
+            assert ctx.thumbnail_bytes(800)
+            assert ctx.preview() is not None
+        return work
+
+    full_time, full_rss = _measure(renditions(0))
+    draft_time, draft_rss = _measure(renditions(2048))
+    print(f"\n[基准] 解码 {CAMERA_SIZE[0]}x{CAMERA_SIZE[1]} JPEG（{len(camera_jpeg) // 1024}KB）："
+          f"完整解码 {full_time * 1000:.0f}ms / 峰值 +{full_rss:.0f}MB，"
+          f"DCT 缩放 {draft_time * 1000:.0f}ms / 峰值 +{draft_rss:.0f}MB")
+    assert draft_time < full_time
+    assert draft_rss < full_rss * 0.6
+
+
+def test_draft_decode_keeps_target_resolution(app, camera_jpeg):
+    ctx = app["ImageContext"](camera_jpeg, "camera.jpg", decode_max_size=2048)
+    # DCT 缩放只缩到不小于目标尺寸的 1/2，之后仍由 LANCZOS 精确缩放
+    assert max(ctx.image().size) >= 2048
+    assert max(ctx.preview().size) == ctx.PREVIEW_MAX_SIZE
+
+
+def test_card_crop_comes_from_source_resolution(app, camera_jpeg):
+    ctx = app["ImageContext"](camera_jpeg, "camera.jpg")
+    bbox = [45, 40, 57, 55]  # 远处的小鸟
+    # 原先的做法：在 1200px 预览图上裁剪，展示时被拉伸放大
+    upscaled = app["crop_to_bird"](ctx.preview(), bbox)
+
+    started = time.perf_counter()
+    card = ctx.bird_preview(bbox)
+    elapsed = time.perf_counter() - started
+    print(f"\n[基准] 卡片裁剪图：预览图上裁剪 {upscaled.size}，原图裁剪后缩小 {card.size}（{elapsed * 1000:.0f}ms）")
+    assert max(card.size) <= ctx.PREVIEW_MAX_SIZE
+    assert max(card.size) > 4 * max(upscaled.size)
+
+    ctx.release()
+    assert ctx.bird_preview(bbox) is card  # release() 后仍保留，不再重新解码
+    assert ctx.bird_preview(None) is ctx.preview()
+    # 鸟已占满画面时不裁剪，在预览图上标注
+    assert ctx.bird_preview([2, 2, 98, 98]).size == ctx.preview().size
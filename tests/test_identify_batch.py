@@ -0,0 +1,74 @@
+"""基准：批量识别（一次请求多张照片）与逐张识别对比总输入 token、墙钟时间和失败率，
+以及批量输出无法解析或缺少结果时退回逐张识别。
+
+对假视觉模型发请求；用 pytest -s 可看到实测数字。
+"""
+import asyncio
+import base64
+import time
+
+import pytest
+
+PHOTOS = range(10)
+
+
+def _items(app, offset: int = 0) -> list:
+    prefix = app["DATA_URL_PREFIX"]
+    return [(prefix + base64.b64encode(f"photo-{number + offset}".encode()).decode(), {}) for number in PHOTOS]
+
+
+def _run(coro) -> tuple:
+    started = time.perf_counter()
+    result = asyncio.run(coro)
+    return result, time.perf_counter() - started
+
+
+def _single(app, items):
+    async def run():
+        return await asyncio.gather(*(
+            app["identify_bird_async"](image, "sk-test", exif, tier="fast") for image, exif in items
+        ))
+    return _run(run())
+
+
+def test_batch_vs_single(app, ai_harness):
+    # 两组照片鸟种相同、内容不同，互不命中识别缓存
+    single_results, single_time = _single(app, _items(app))
+    single_calls = list(ai_harness.calls)
+    ai_harness.calls.clear()
+    batch_results, batch_time = _run(app["identify_birds_batch_async"](_items(app, 10), "sk-test", tier="fast"))
+    batch_calls = list(ai_harness.calls)
+
+    assert [r["chinese_name"] for r in batch_results] == [r["chinese_name"] for r in single_results]
+    assert [c["kind"] for c in batch_calls] == ["batch"]
+
+    single_input = sum(c["prompt_tokens"] for c in single_calls)
+    batch_input = sum(c["prompt_tokens"] for c in batch_calls)
+    stats = {row["档位"]: row for row in app["ai_call_stats_summary"]()}
+    print(f"\n[基准] {len(PHOTOS)} 张照片：逐张 {len(single_calls)} 次请求、输入 {single_input} token、"
+          f"{single_time * 1000:.0f}ms、失败率 {stats['identify-fast']['失败率']}；"
+          f"批量 1 次请求、输入 {batch_input} token、{batch_time * 1000:.0f}ms、失败率 {stats['batch-fast']['失败率']}")
+    # 任务说明只发送一次；图片本身的 token 两种方式相同
+    image_tokens = ai_harness.IMAGE_TOKENS * len(PHOTOS)
+    assert batch_input - image_tokens < (single_input - image_tokens) / 3
+    assert stats["batch-fast"]["失败率"] == "0%"
+
+
+@pytest.mark.parametrize("mode, fallbacks", [("drop_last", 1), ("broken", len(PHOTOS))])
+def test_batch_falls_back_to_single_calls(app, ai_harness, mode, fallbacks):
+    ai_harness.batch_mode = mode
+    results, _ = _run(app["identify_birds_batch_async"](_items(app, 20), "sk-test", tier="fast"))
+
+    expected = [ai_harness.SPECIES[(number + 20) % len(ai_harness.SPECIES)] for number in PHOTOS]
+    assert [r["chinese_name"] for r in results] == expected
+    assert [c["kind"] for c in ai_harness.calls].count("identify") == fallbacks
+    stats = {row["档位"]: row for row in app["ai_call_stats_summary"]()}
+    assert stats["batch-fast"]["失败率"] == "100%"
+
+
+def test_batch_reuses_identify_cache(app, ai_harness):
+    items = _items(app, 30)
+    _run(app["identify_birds_batch_async"](items, "sk-test", tier="fast"))
+    ai_harness.calls.clear()
+    results, _ = _run(app["identify_birds_batch_async"](items, "sk-test", tier="fast"))
+    assert len(results) == len(PHOTOS) and not ai_harness.calls
@@ -0,0 +1,90 @@
+"""基准：fast 档位（只识别 + 评分）与 full 档位（含介绍和识别依据）的输出 token 和延迟，
+以及 fast 档位按需获取介绍（fetch_species_detail）的开销。
+
+对假视觉模型发请求，延迟随输出长度线性增长；数字取自 app 自己的 AI 调用统计。
+用 pytest -s 可看到实测数字。
+"""
+import asyncio
+import base64
+import time
+
+PHOTOS = range(8)  # 8 个不同鸟种，避免鸟种知识缓存提前结束生成
+
+
+def photo_data_url(app, number: int) -> str:
+    return app["DATA_URL_PREFIX"] + base64.b64encode(f"photo-{number}".encode()).decode()
+
+
+def _identify_all(app, tier: str) -> tuple:
+    async def run():
+        return [await app["identify_bird_async"](photo_data_url(app, number), "sk-test", {}, tier=tier)
+                for number in PHOTOS]
+    started = time.perf_counter()
+    results = asyncio.run(run())
+    return results, time.perf_counter() - started
+
+
+def _summary_row(app, tier: str) -> dict:
+    return next(row for row in app["ai_call_stats_summary"]() if row["档位"] == tier)
+
+
+def test_fast_tier_vs_full_tier(app, ai_harness):
+    ai_harness.seconds_per_output_token = 0.0005
+    fast_results, fast_time = _identify_all(app, "fast")
+    full_results, full_time = _identify_all(app, "full")
+
+    assert [r["chinese_name"] for r in fast_results] == [r["chinese_name"] for r in full_results]
+    assert all(r["bird_bbox"] and r["candidates"] for r in fast_results)
+    assert not any(r.get("bird_description") for r in fast_results)
+    assert all(r.get("bird_description") and r.get("identification_basis") for r in full_results)
+
+    fast, full = _summary_row(app, "identify-fast"), _summary_row(app, "identify-full")
+    print(f"\n[基准] {len(PHOTOS)} 张照片：fast 每张输出 {fast['每张输出 token']} token、{fast_time / len(PHOTOS) * 1000:.0f}ms；"
+          f"full 每张输出 {full['每张输出 token']} token、{full_time / len(PHOTOS) * 1000:.0f}ms；"
+          f"输入 {fast['每张输入 token']} / {full['每张输入 token']} token")
+    assert fast["每张输出 token"] < full["每张输出 token"] * 0.8
+    assert fast_time < full_time
+
+
+def test_detail_fetched_on_demand_once_per_species(app, ai_harness):
+    app["fetch_species_detail"].clear()
+    fast_results, _ = _identify_all(app, "fast")
+    first = fast_results[0]
+
+    # 卡片展开时才请求介绍；同一鸟种再次展开走缓存，不再调用模型
+    for _ in range(3):
+        detail = app["fetch_species_detail"](first["chinese_name"], first.get("english_name", ""), "sk-test")
+        assert detail["bird_description"]
+    detail_calls = [call for call in ai_harness.calls if call["kind"] == "detail"]
+    assert len(detail_calls) == 1
+
+    # 介绍写入鸟种知识缓存后，新进程（清空 st.cache_data）也不必再请求
+    app["fetch_species_detail"].clear()
+    app["fetch_species_detail"](first["chinese_name"], first.get("english_name", ""), "sk-test")
+    assert len([call for call in ai_harness.calls if call["kind"] == "detail"]) == 1
+
+    identify_calls = [call for call in ai_harness.calls if call["kind"] == "identify"]
+    print(f"\n[基准] 按需介绍：识别每张输出 "
+          f"{sum(c['completion_tokens'] for c in identify_calls) // len(identify_calls)} token，"
+          f"介绍每次输出 {detail_calls[0]['completion_tokens']} token（每个鸟种只请求一次）")
+
+
+def test_card_fields_arrive_before_completion(app, ai_harness):
+    ai_harness.seconds_per_output_token = 0.0005
+    arrived = {}
+    started = time.perf_counter()
+
+    def on_field(key, value):
+        if key in app["PARTIAL_CARD_FIELDS"]:
+            arrived[key] = (time.perf_counter() - started, value)
+
+    result = asyncio.run(app["identify_bird_async"](photo_data_url(app, 40), "sk-test", {}, on_field=on_field,
+                                                    tier="full"))
+    total = time.perf_counter() - started
+    assert set(arrived) == set(app["PARTIAL_CARD_FIELDS"])
+    first_card = max(seconds for seconds, _ in arrived.values())
+    print(f"\n[基准] 卡片字段（鸟种名、候选种、位置）{first_card * 1000:.0f}ms 到达，完整结果 {total * 1000:.0f}ms")
+    assert first_card < total * 0.6  # 介绍和评分约占输出的一半
+
+    card = app["partial_card_markdown"]("photo.jpg", {key: value for key, (_, value) in arrived.items()})
+    assert result["chinese_name"] in card and "候选" in card and "已定位" in card
@@ -0,0 +1,109 @@
+"""旧版内联图片的迁移（只在持久存储上、回读确认后才清空旧列）和渲染时的旧列回退"""
+import base64
+import threading
+
+import pytest
+
+THUMB = b"\xff\xd8thumbnail-bytes"
+FULL = b"\xff\xd8full-image-bytes"
+
+
+@pytest.fixture
+def durable_store(app):
+    """内存版对象存储：继承 S3ImageStore，不需要 boto3 和网络"""
+
+    class MemoryObjectStore(app["S3ImageStore"]):
+        def __init__(self):
+            self.bucket = "test"
+            self.public_url = ""
+            self.objects = {}
+            self.corrupt_reads = False
+
+        def put(self, data, extension):
+            key = app["image_content_key"](data, extension)
+            self.objects[key] = data
+            return key
+
+        def get(self, key):
+            data = self.objects.get(key)
+            return data[:-1] if data and self.corrupt_reads else data
+
+    return MemoryObjectStore()
+
+
+@pytest.fixture
+def legacy_rows(fake_postgrest):
+    fake_postgrest.tables["bird_records"] = [
+        {"id": 1, "chinese_name": "麻雀", "thumbnail_key": "", "image_key": "",
+         "thumbnail_base64": base64.b64encode(THUMB).decode(), "image_base64": base64.b64encode(FULL).decode()},
+        {"id": 2, "chinese_name": "喜鹊", "thumbnail_key": "", "image_key": "",
+         "thumbnail_base64": base64.b64encode(THUMB + b"2").decode(), "image_base64": ""},
+    ]
+    return fake_postgrest.tables["bird_records"]
+
+
+def _run_migration(app, monkeypatch, store, enabled=True):
+    monkeypatch.setitem(app, "get_image_store", lambda: store)
+    if enabled:
+        monkeypatch.setenv("BIRDEYE_MIGRATE_INLINE_IMAGES", "1")
+    else:
+        monkeypatch.delenv("BIRDEYE_MIGRATE_INLINE_IMAGES", raising=False)
+    app["_migrate_inline_images"].clear()
+    started = app["_migrate_inline_images"]()
+    for thread in threading.enumerate():
+        if thread.name == "image-migration":
+            thread.join(timeout=10)
+    return started
+
+
+def test_migration_is_opt_in(app, monkeypatch, durable_store, legacy_rows):
+    assert _run_migration(app, monkeypatch, durable_store, enabled=False) is False
+    assert legacy_rows[0]["thumbnail_base64"] and not durable_store.objects
+
+
+def test_migration_refuses_local_store(app, monkeypatch, tmp_path, legacy_rows):
+    local_store = app["LocalImageStore"](tmp_path, "app/static/images")
+    assert _run_migration(app, monkeypatch, local_store) is False
+    assert legacy_rows[0]["thumbnail_base64"] and legacy_rows[0]["image_base64"]
+    assert not any(tmp_path.iterdir())
+
+
+def test_migration_blanks_columns_after_confirmed_upload(app, monkeypatch, durable_store, legacy_rows):
+    assert _run_migration(app, monkeypatch, durable_store) is True
+    first, second = legacy_rows
+    assert durable_store.objects[first["thumbnail_key"]] == THUMB
+    assert durable_store.objects[first["image_key"]] == FULL
+    assert durable_store.objects[second["thumbnail_key"]] == THUMB + b"2"
+    assert first["thumbnail_base64"] == first["image_base64"] == second["thumbnail_base64"] == ""
+
+
+def test_migration_keeps_columns_when_readback_differs(app, monkeypatch, durable_store, legacy_rows):
+    durable_store.corrupt_reads = True
+    _run_migration(app, monkeypatch, durable_store)
+    assert legacy_rows[0]["thumbnail_base64"] == base64.b64encode(THUMB).decode()
+    assert legacy_rows[0]["thumbnail_key"] == ""
+
+
+def test_render_falls_back_to_legacy_columns(app, monkeypatch, tmp_path, legacy_rows):
+    local_store = app["LocalImageStore"](tmp_path, "app/static/images")
+    stored_key = local_store.put(b"stored", "jpg")
+    # 第 2 条记录的 key 由其他实例写入，本实例的本地存储里没有这张图
+    legacy_rows[1]["thumbnail_key"] = "ab/missing-on-this-instance.jpg"
+    legacy_rows.append({"id": 3, "thumbnail_key": stored_key, "thumbnail_base64": ""})
+    monkeypatch.setitem(app, "get_image_store", lambda: local_store)
+    app["_legacy_inline_images"].clear()
+    app["_stored_image_data_url"].clear()
+
+    srcs = app["record_image_srcs"]([{"id": row["id"], "thumbnail_key": row["thumbnail_key"]} for row in legacy_rows])
+
+    assert srcs[0] == "data:image/jpeg;base64," + base64.b64encode(THUMB).decode()
+    assert srcs[1] == "data:image/jpeg;base64," + base64.b64encode(THUMB + b"2").decode()
+    assert srcs[2] == f"app/static/images/{stored_key}"
+
+
+def test_render_without_legacy_columns(app, monkeypatch, tmp_path, fake_postgrest):
+    # 旧列已按 schema.sql 删除：回退查询失败时只返回空地址，不抛异常
+    fake_postgrest.tables["bird_records"] = [{"id": 1, "thumbnail_key": ""}]
+    monkeypatch.setitem(app, "get_image_store", lambda: app["LocalImageStore"](tmp_path, "app/static/images"))
+    app["_legacy_inline_images"].clear()
+    assert app["record_image_srcs"]([{"id": 1, "thumbnail_key": ""}]) == [""]
@@ -0,0 +1,128 @@
+"""AI 输出的 JSON 提取（_extract_json_from_text 严格解析 + 修复）和流式解析器的模糊测试与基准。
+
+模型输出常见的问题：代码块包裹、前后说明文字、多余逗号、输出被截断、一次给出两个 JSON 块。
+不论输入多坏，提取都不能抛异常，能恢复的字段必须恢复。
+"""
+import json
+import random
+import time
+
+import pytest
+
+RESPONSE = {
+    "chinese_name": "白头鹎",
+    "english_name": "Light-vented Bulbul",
+    "candidates": [
+        {"chinese_name": "白头鹎", "confidence": 0.86, "reason": "头顶黑色，枕部白斑 {明显}"},
+        {"chinese_name": "黄臀鹎", "confidence": 0.1, "reason": "臀部 \"黄色\" 不明显"},
+    ],
+    "bird_bbox": [0.31, 0.22, 0.58, 0.61],
+    "score": 82,
+    "bird_description": "常见留鸟，喜集群，鸣声嘈杂。",
+}
+BODY = json.dumps(RESPONSE, ensure_ascii=False, indent=2)
+COMPACT = json.dumps(RESPONSE, ensure_ascii=False)
+
+
+@pytest.mark.parametrize("text", [
+    BODY,
+    f"```json\n{BODY}\n```",
+    f"```\n{BODY}\n```\n以上是识别结果。",
+    f"好的，下面是结果：\n{BODY}\n希望对你有帮助。",
+    f"{BODY}\n\n补充：{{\"chinese_name\": \"麻雀\"}}",
+    COMPACT.replace('"score": 82,', '"score": 82,,').replace("0.61]", "0.61,]"),
+    "```json\n" + COMPACT.replace("0.61]", "0.61,]").replace("嘈杂。\"", "嘈杂。\",") + "\n```",
+    COMPACT.replace("[{", "[,{"),
+])
+def test_recovers_all_fields(app, text):
+    assert app["_extract_json_from_text"](text) == RESPONSE
+
+
+@pytest.mark.parametrize("text, expected", [
+    # 截断在字符串中、冒号后、逗号后、嵌套数组中
+    ('{"chinese_name": "白头鹎", "english_name": "Light-ven', {"chinese_name": "白头鹎", "english_name": "Light-ven"}),
+    ('{"chinese_name": "白头鹎", "score":', {"chinese_name": "白头鹎", "score": None}),
+    ('```json\n{"chinese_name": "白头鹎", "score": 82,', {"chinese_name": "白头鹎", "score": 82}),
+    ('{"chinese_name": "白头鹎", "bird_bbox": [0.31, 0.2', {"chinese_name": "白头鹎", "bird_bbox": [0.31, 0.2]}),
+    ('{"chinese_name": "白\\"头鹎', {"chinese_name": '白"头鹎'}),
+])
+def test_repairs_truncated_output(app, text, expected):
+    assert app["_extract_json_from_text"](text) == expected
+
+
+@pytest.mark.parametrize("text", ["", "无法识别", "```json\n```", "}{", "[1, 2]", '{"a" 1}', "{" * 50, '"{"'])
+def test_garbage_yields_nothing(app, text):
+    # 调用方按真值判断，None 和空对象都视为无结果
+    assert not app["_extract_json_from_text"](text)
+
+
+def test_list_mode(app):
+    text = '```json\n[{"name": "麻雀"}, {"name": "喜鹊"},]\n```'
+    assert app["_extract_json_from_text"](text, expect=list) == [{"name": "麻雀"}, {"name": "喜鹊"}]
+
+
+def test_fuzz_truncation_never_raises(app):
+    # 在每个位置截断：永不抛异常；chinese_name 的值已完整输出时必须能取回
+    extract = app["_extract_json_from_text"]
+    fenced = f"```json\n{BODY}\n```"
+    name_end = fenced.index('"白头鹎"') + len('"白头鹎"')
+    for cut in range(len(fenced) + 1):
+        parsed = extract(fenced[:cut])
+        assert parsed is None or isinstance(parsed, dict)
+        if cut >= name_end:
+            assert parsed is not None and parsed["chinese_name"] == "白头鹎", cut
+
+
+def test_fuzz_mutations_never_raise(app):
+    extract = app["_extract_json_from_text"]
+    rng = random.Random(20240501)
+    noise = list('{}[]",:\\ \n`') + ["null", "```", "，"]
+    for _ in range(3000):
+        chars = list(BODY)
+        for _ in range(rng.randint(1, 6)):
+            position = rng.randrange(len(chars))
+            action = rng.random()
+            if action < 0.4:
+                del chars[position]
+            elif action < 0.8:
+                chars.insert(position, rng.choice(noise))
+            else:
+                chars[position] = rng.choice(noise)
+        parsed = extract("".join(chars))
+        assert parsed is None or isinstance(parsed, dict)
+
+
+def test_streaming_parser_matches_extractor(app):
+    # 任意切块喂入流式解析器，结果与一次性提取一致，且字段逐个完整回调
+    rng = random.Random(7)
+    fenced = f"```json\n{BODY}\n```"
+    for _ in range(200):
+        seen = []
+        parser = app["IncrementalJSONParser"](lambda key, value: seen.append(key))
+        position = 0
+        while position < len(fenced):
+            step = rng.randint(1, 40)
+            parser.feed(fenced[position:position + step])
+            position += step
+        assert parser.result() == RESPONSE
+        assert seen == list(RESPONSE)
+
+
+def test_benchmark_extraction(app):
+    """基准：长输出（100 个候选种）的严格解析路径和修复路径都应在毫秒级完成"""
+    extract = app["_extract_json_from_text"]
+    big = dict(RESPONSE, candidates=RESPONSE["candidates"] * 50)
+    clean = "```json\n" + json.dumps(big, ensure_ascii=False) + "\n```"
+    broken = clean.replace("}]", "},]", 1)[: len(clean) * 9 // 10]  # 多余逗号 + 截断，走修复路径
+
+    timings = {}
+    for label, text in (("strict", clean), ("repair", broken)):
+        started = time.perf_counter()
+        for _ in range(20):
+            parsed = extract(text)
+        timings[label] = (time.perf_counter() - started) / 20
+        assert parsed["chinese_name"] == "白头鹎"
+    print(f"\n[基准] JSON 提取 {len(clean) // 1024}KB：严格 {timings['strict'] * 1000:.2f}ms，"
+          f"修复 {timings['repair'] * 1000:.2f}ms")
+    assert timings["strict"] < 0.05
+    assert timings["repair"] < 0.5
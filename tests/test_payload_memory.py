@@ -0,0 +1,67 @@
+"""基准：AI 载荷（JPEG → base64 data URL）组装的 Python 堆峰值（tracemalloc）。
+
+对比 _encode_jpeg_base64（在 getbuffer() 上分块编码、按最终长度一次分配）与原先的
+getvalue() → b64encode → decode → f-string 拼接。用 pytest -s 可看到实测数字。
+"""
+import base64
+import io
+import tracemalloc
+
+import pytest
+from PIL import Image
+
+
+def _naive_data_url(img, quality: int) -> str:
+    """原先的做法：每一步都复制一份完整载荷"""
+    buffer = io.BytesIO()
+    img.save(buffer, format="JPEG", quality=quality)
+    encoded = base64.b64encode(buffer.getvalue()).decode("utf-8")
+    return f"data:image/jpeg;base64,{encoded}"
+
+
+def _peak(func, *args) -> tuple:
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        baseline, _ = tracemalloc.get_traced_memory()
+        result = func(*args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, peak - baseline
+
+
+@pytest.fixture(scope="module")
+def payload_image():
+    """2048px 带噪声的图片，JPEG 约 1-2MB（与真实照片的载荷量级相当）"""
+    return Image.effect_noise((2048, 1365), 60).convert("RGB")
+
+
+@pytest.mark.parametrize("max_size, max_ratio", [
+    (2048, 0.75),  # 大载荷：省掉 getvalue/b64encode/f-string 的多份副本
+    (800, 1.0),    # 小载荷：峰值主要来自 JPEG 编码本身，至少不比原做法高
+    (480, 1.0),
+])
+def test_encode_peak_memory(app, payload_image, max_size, max_ratio):
+    img = payload_image if max_size == 2048 else payload_image.resize(
+        (max_size, max_size * payload_image.height // payload_image.width))
+    quality = app["AI_IMAGE_QUALITY"]
+
+    naive, naive_peak = _peak(_naive_data_url, img, quality)
+    encoded, encode_peak = _peak(app["_encode_jpeg_base64"], img, quality, app["DATA_URL_PREFIX"])
+
+    assert encoded == naive
+    print(f"\n[基准] {img.width}px 载荷 {len(encoded) // 1024}KB：原做法峰值 {naive_peak / 2 ** 20:.2f}MB，"
+          f"_encode_jpeg_base64 峰值 {encode_peak / 2 ** 20:.2f}MB")
+    assert encode_peak <= naive_peak * max_ratio
+
+
+def test_image_context_encodes_payload_once(app):
+    buffer = io.BytesIO()
+    Image.effect_noise((1600, 1200), 40).convert("RGB").save(buffer, format="JPEG")
+    ctx = app["ImageContext"](buffer.getvalue(), "photo.jpg")
+    data_url = ctx.ai_data_url(1280)
+    # 同一尺寸只编码一次，ai_base64 由同一份缓存的 data URL 去掉前缀得到
+    assert ctx.ai_data_url(1280) is data_url
+    assert data_url.startswith(app["DATA_URL_PREFIX"])
+    assert base64.b64decode(ctx.ai_base64(1280))[:2] == b"\xff\xd8"
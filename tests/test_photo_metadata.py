@@ -0,0 +1,85 @@
+"""只读文件头的 EXIF/GPS 读取（read_photo_metadata）：Exif / GPS IFD 位于初始读取窗口之外时
+按需扩大窗口，而不是只在整组 IFD 都没读到时才扩大。
+"""
+import io
+import struct
+
+import pytest
+
+
+def _ifd(entries: list, offset: int) -> tuple:
+    """entries: [(tag, type, count, 值字节)]，超过 4 字节的值紧跟在条目表之后。返回 (IFD 字节, 结束位置)"""
+    table = struct.pack("<H", len(entries))
+    data = b""
+    data_start = offset + 2 + 12 * len(entries) + 4
+    for tag, field_type, count, value in entries:
+        if len(value) <= 4:
+            table += struct.pack("<HHI", tag, field_type, count) + value.ljust(4, b"\0")
+        else:
+            table += struct.pack("<HHII", tag, field_type, count, data_start + len(data))
+            data += value + b"\0" * (len(value) % 2)
+    table += struct.pack("<I", 0)
+    return table + data, offset + len(table) + len(data)
+
+
+def _rational(*values) -> bytes:
+    return b"".join(struct.pack("<II", value, 1) for value in values)
+
+
+def _tiff(exif_offset: int, gps_offset: int) -> bytes:
+    ifd0, _ = _ifd([
+        (271, 2, 6, b"Canon\0"),
+        (272, 2, 14, b"Canon EOS R5\0\0"),
+        (34665, 4, 1, struct.pack("<I", exif_offset)),
+        (34853, 4, 1, struct.pack("<I", gps_offset)),
+    ], 8)
+    exif, _ = _ifd([(36867, 2, 20, b"2024:05:01 06:30:15\0")], exif_offset)
+    gps, gps_end = _ifd([
+        (1, 2, 2, b"N\0"), (2, 5, 3, _rational(31, 14, 24)),
+        (3, 2, 2, b"E\0"), (4, 5, 3, _rational(121, 28, 12)),
+    ], gps_offset)
+    data = bytearray(max(exif_offset, gps_end) + 4 * 1024 * 1024)  # 之后还有大块像素数据
+    data[:8] = b"II" + struct.pack("<HI", 42, 8)
+    data[8:8 + len(ifd0)] = ifd0
+    data[exif_offset:exif_offset + len(exif)] = exif
+    data[gps_offset:gps_offset + len(gps)] = gps
+    return bytes(data)
+
+
+class CountingStream(io.BytesIO):
+    def __init__(self, data: bytes):
+        super().__init__(data)
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        chunk = super().read(size)
+        self.bytes_read += len(chunk)
+        return chunk
+
+
+@pytest.mark.parametrize("exif_offset, gps_offset", [
+    (512, 300 * 1024),         # GPS IFD 超出 64KB 窗口
+    (200 * 1024, 1024),        # Exif IFD 超出 64KB 窗口
+    (700 * 1024, 900 * 1024),  # 都超出 512KB 的第二个窗口
+])
+def test_ifds_outside_window_are_read(app, exif_offset, gps_offset):
+    data = _tiff(exif_offset, gps_offset)
+    stream = CountingStream(data)
+    for source in (data, stream):
+        info = app["read_photo_metadata"](source)
+        assert info["camera"] == "Canon EOS R5"
+        assert info["shoot_time"] == "20240501_0630"
+        assert info["gps_lat"] == pytest.approx(31 + 14 / 60 + 24 / 3600)
+        assert info["gps_lon"] == pytest.approx(121 + 28 / 60 + 12 / 3600)
+    # 文件流只多读到覆盖 IFD 的位置，不读整个文件
+    assert stream.bytes_read < len(data) / 2
+    assert stream.tell() == 0
+
+
+def test_pointer_past_end_of_file_keeps_what_was_read(app):
+    data = bytearray(_tiff(512, 1024)[:64 * 1024 + 100])
+    gps_pointer = data.index(struct.pack("<HHI", 34853, 4, 1))
+    data[gps_pointer + 8:gps_pointer + 12] = struct.pack("<I", 10 * 1024 * 1024)
+    info = app["read_photo_metadata"](bytes(data))
+    assert info["camera"] == "Canon EOS R5" and info["shoot_time"] == "20240501_0630"
+    assert info["gps_lat"] is None
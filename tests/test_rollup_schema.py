@@ -0,0 +1,157 @@
+"""schema.sql 的统计聚合触发器：在真实 PostgreSQL 上执行，增量维护的结果必须与全量重算一致。
+
+需要 pip install pgserver psycopg2-binary（pgserver 自带 PostgreSQL 二进制），未安装时跳过。
+"""
+from pathlib import Path
+
+import pytest
+
+psycopg2 = pytest.importorskip("psycopg2")
+pgserver = pytest.importorskip("pgserver")
+from psycopg2 import errors  # noqa: E402
+
+SCHEMA_PATH = Path(__file__).resolve().parent.parent / "schema.sql"
+# english_name 是展示用标签，触发器只会用非空英文名覆盖，不参与全量比对
+SPECIES_COLUMNS = ("record_count", "imported_count", "score_sum", "score_count", "best_score")
+USER_COLUMNS = ("total_records", "imported_records", "species", "imported_species",
+                "score_sum", "score_count", "best_score")
+
+
+@pytest.fixture(scope="module")
+def pg_server(tmp_path_factory):
+    server = pgserver.get_server(tmp_path_factory.mktemp("pgdata"), cleanup_mode="stop")
+    yield server
+    server.cleanup()
+
+
+@pytest.fixture
+def db(pg_server):
+    """每个用例一个新数据库，按 Supabase 的做法预先建好 anon / authenticated 角色并授予表权限"""
+    admin = psycopg2.connect(pg_server.get_uri())
+    admin.autocommit = True
+    with admin.cursor() as cur:
+        cur.execute("DROP DATABASE IF EXISTS birdeye_test")
+        cur.execute("CREATE DATABASE birdeye_test")
+        for role in ("anon", "authenticated"):
+            cur.execute(f"SELECT 1 FROM pg_roles WHERE rolname = '{role}'")
+            if not cur.fetchone():
+                cur.execute(f"CREATE ROLE {role} NOLOGIN")
+    admin.close()
+
+    conn = psycopg2.connect(pg_server.get_uri("birdeye_test"))
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        cur.execute(SCHEMA_PATH.read_text(encoding="utf-8"))
+        cur.execute("GRANT USAGE ON SCHEMA public TO anon, authenticated")
+        cur.execute("GRANT ALL ON ALL TABLES IN SCHEMA public TO anon, authenticated")
+        cur.execute("GRANT ALL ON ALL SEQUENCES IN SCHEMA public TO anon, authenticated")
+    yield conn
+    conn.close()
+
+
+def _insert(cur, user, name, score, confidence="high", english=""):
+    cur.execute(
+        "INSERT INTO bird_records (user_nickname, chinese_name, english_name, score, confidence) "
+        "VALUES (%s, %s, %s, %s, %s) RETURNING id",
+        (user, name, english, score, confidence),
+    )
+    return cur.fetchone()[0]
+
+
+def _species_stats(cur):
+    cur.execute(f"SELECT user_nickname, chinese_name, {', '.join(SPECIES_COLUMNS)} FROM user_species_stats")
+    return {row[:2]: row[2:] for row in cur.fetchall()}
+
+
+def _user_stats(cur):
+    cur.execute(f"SELECT user_nickname, {', '.join(USER_COLUMNS)}, last_import_at FROM user_stats")
+    return {row[0]: row[1:] for row in cur.fetchall()}
+
+
+def assert_rollups_match_full_recompute(conn):
+    """触发器维护的两张聚合表 == 按 bird_records 全量重算（回填 SQL + refresh_user_stats）的结果"""
+    with conn.cursor() as cur:
+        incremental_species, incremental_users = _species_stats(cur), _user_stats(cur)
+        cur.execute("BEGIN")
+        cur.execute("ALTER TABLE bird_records DISABLE TRIGGER trg_bird_records_rollup")
+        cur.execute("DELETE FROM user_species_stats")
+        cur.execute("DELETE FROM user_stats")
+        cur.execute("""
+            INSERT INTO user_species_stats
+                (user_nickname, chinese_name, english_name, record_count, imported_count,
+                 score_sum, score_count, best_score)
+            SELECT user_nickname, chinese_name, COALESCE(max(english_name), ''), count(*),
+                   count(*) FILTER (WHERE confidence = 'imported'),
+                   COALESCE(sum(score) FILTER (WHERE score > 0), 0),
+                   count(*) FILTER (WHERE score > 0),
+                   COALESCE(max(score) FILTER (WHERE score > 0), 0)
+            FROM bird_records GROUP BY user_nickname, chinese_name
+        """)
+        cur.execute("SELECT refresh_user_stats(user_nickname) FROM (SELECT DISTINCT user_nickname FROM bird_records) AS u")
+        cur.execute("""
+            UPDATE user_stats SET last_import_at = i.last_import_at
+            FROM (SELECT user_nickname, max(created_at) AS last_import_at FROM bird_records
+                  WHERE confidence = 'imported' GROUP BY user_nickname) AS i
+            WHERE user_stats.user_nickname = i.user_nickname
+        """)
+        expected_species, expected_users = _species_stats(cur), _user_stats(cur)
+        cur.execute("ROLLBACK")
+    assert incremental_species == expected_species
+    assert incremental_users == expected_users
+
+
+def test_insert_correct_and_delete_keep_rollups_exact(db):
+    cur = db.cursor()
+    sparrow_best = _insert(cur, "alice", "麻雀", 92, english="Eurasian Tree Sparrow")
+    _insert(cur, "alice", "麻雀", 75)
+    _insert(cur, "alice", "麻雀", 0)
+    magpie = _insert(cur, "alice", "喜鹊", 60)
+    _insert(cur, "alice", "未知鸟类", 40)
+    imported = _insert(cur, "alice", "白鹭", 0, confidence="imported")
+    _insert(cur, "bob", "麻雀", 88)
+    assert_rollups_match_full_recompute(db)
+    assert _user_stats(cur)["alice"][USER_COLUMNS.index("species")] == 3  # 麻雀、喜鹊、白鹭，不含"未知鸟类"
+
+    # 更正鸟种：最高分记录从麻雀移到树麻雀
+    cur.execute("UPDATE bird_records SET chinese_name = '树麻雀', user_corrected_name = '树麻雀' WHERE id = %s",
+                (sparrow_best,))
+    assert_rollups_match_full_recompute(db)
+    assert _species_stats(cur)[("alice", "麻雀")][SPECIES_COLUMNS.index("best_score")] == 75
+
+    # 删除用户最高分记录
+    cur.execute("DELETE FROM bird_records WHERE id = %s", (sparrow_best,))
+    assert_rollups_match_full_recompute(db)
+    assert _user_stats(cur)["alice"][USER_COLUMNS.index("best_score")] == 75
+
+    # 删除某鸟种的最后一条记录（鸟种数、导入鸟种数、最后导入时间都要回退）
+    cur.execute("DELETE FROM bird_records WHERE id = ANY(%s)", ([magpie, imported],))
+    assert_rollups_match_full_recompute(db)
+    assert ("alice", "喜鹊") not in _species_stats(cur)
+    assert _user_stats(cur)["alice"][-1] is None
+
+    # 删除用户的全部记录后聚合行一并删除
+    cur.execute("DELETE FROM bird_records WHERE user_nickname = 'alice'")
+    assert_rollups_match_full_recompute(db)
+    assert "alice" not in _user_stats(cur)
+
+
+def test_security_definer_functions_not_callable_by_api_roles(db):
+    cur = db.cursor()
+    for role in ("anon", "authenticated"):
+        cur.execute(f"SET ROLE {role}")
+        try:
+            # 触发器照常以所有者身份维护聚合表
+            _insert(cur, role, "麻雀", 80)
+            for call in ("SELECT refresh_user_stats('x')",
+                         "SELECT bird_records_rollup_apply('x', '麻雀', 100, 'high', 1)"):
+                with pytest.raises(errors.InsufficientPrivilege):
+                    cur.execute(call)
+        finally:
+            cur.execute("RESET ROLE")
+    assert_rollups_match_full_recompute(db)
+
+
+def test_best_score_lookup_uses_index(db):
+    cur = db.cursor()
+    cur.execute("SELECT indexdef FROM pg_indexes WHERE indexname = 'idx_bird_records_user_species_score'")
+    assert "(user_nickname, chinese_name, score)" in cur.fetchone()[0]
@@ -0,0 +1,90 @@
+"""Supabase REST 客户端（supabase_http 共享连接池）对假 PostgREST 服务的基准和行为测试：
+连接复用、单次请求耗时、幂等请求重试、POST 不重试，以及保存 / 更正 / 删除记录的完整往返。
+
+用 pytest -s 可看到实测数字。
+"""
+import time
+
+import httpx
+import pytest
+
+REQUESTS = 50
+
+
+@pytest.fixture
+def postgrest(app, monkeypatch, fake_postgrest):
+    monkeypatch.setitem(app, "SUPABASE_RETRY_BACKOFF", 0.0)
+    fake_postgrest.tables["bird_records"] = [
+        {"id": number, "user_nickname": "alice", "chinese_name": "麻雀", "score": number}
+        for number in range(1, 21)
+    ]
+    fake_postgrest._next_id = 21
+    return fake_postgrest
+
+
+def test_pooled_client_vs_new_connection_per_request(app, postgrest):
+    params = "select=id,chinese_name&user_nickname=eq.alice&order=score.desc&limit=10"
+
+    started = time.perf_counter()
+    for _ in range(REQUESTS):
+        # 原先的做法：每次请求新建连接
+        with httpx.Client(base_url=f"{postgrest.base_url}/rest/v1/") as client:
+            assert len(client.get(f"bird_records?{params}").json()) == 10
+    fresh_time = (time.perf_counter() - started) / REQUESTS
+    fresh_connections = postgrest.connections
+
+    app["supabase_http"]("GET", "bird_records", params=params)  # 预热：建立连接
+    postgrest.connections = 0
+    started = time.perf_counter()
+    for _ in range(REQUESTS):
+        assert len(app["_supabase_request"]("GET", "bird_records", params=params)) == 10
+    pooled_time = (time.perf_counter() - started) / REQUESTS
+
+    print(f"\n[基准] {REQUESTS} 次查询：每次新建连接 {fresh_connections} 个连接、{fresh_time * 1000:.2f}ms/次；"
+          f"共享连接池 {postgrest.connections} 个新连接、{pooled_time * 1000:.2f}ms/次")
+    assert fresh_connections == REQUESTS
+    assert postgrest.connections == 0
+    assert pooled_time < fresh_time
+
+
+def test_idempotent_requests_retry_gateway_errors(app, postgrest):
+    postgrest.fail_next = [503, 502]
+    rows = app["_supabase_request"]("GET", "bird_records", params="id=eq.3")
+    assert rows == [postgrest.tables["bird_records"][2]]
+    assert len(postgrest.requests) == 3
+
+
+def test_retries_give_up_after_limit(app, postgrest):
+    postgrest.fail_next = [503] * (app["SUPABASE_MAX_RETRIES"] + 1)
+    assert app["_supabase_request"]("GET", "bird_records", params="id=eq.3") is None
+    assert len(postgrest.requests) == app["SUPABASE_MAX_RETRIES"] + 1
+
+
+def test_post_is_not_retried(app, postgrest):
+    postgrest.fail_next = [503]
+    ok, error, record_id = app["save_record_to_db"](
+        "alice", {"chinese_name": "喜鹊", "score": 80}, "thumb-key",
+        supabase_url=postgrest.base_url, supabase_key="test-key",
+    )
+    assert not ok and "503" in error and record_id is None
+    # 带 image_key 时才会降级重发，这里只应有一次 POST，避免重复插入
+    assert [method for method, _, _ in postgrest.requests] == ["POST"]
+    assert len(postgrest.tables["bird_records"]) == 20
+
+
+def test_save_correct_delete_round_trip_on_one_connection(app, postgrest):
+    postgrest.connections = 0
+    ok, _, record_id = app["save_record_to_db"](
+        "alice", {"chinese_name": "喜鹊", "english_name": "Oriental Magpie", "score": 80}, "thumb-key",
+        image_key="image-key", supabase_url=postgrest.base_url, supabase_key="test-key",
+    )
+    assert ok and record_id == 21
+    assert app["update_record_name_in_db"](record_id, "灰喜鹊", "Azure-winged Magpie")
+    row = next(row for row in postgrest.tables["bird_records"] if row["id"] == record_id)
+    assert row["chinese_name"] == row["user_corrected_name"] == "灰喜鹊"
+    assert row["original_ai_name"] == "喜鹊"
+
+    assert app["delete_record_from_db"](record_id)
+    assert all(row["id"] != record_id for row in postgrest.tables["bird_records"])
+    assert [method for method, _, _ in postgrest.requests] == ["POST", "PATCH", "DELETE"]
+    assert postgrest.connections <= 1